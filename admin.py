@@ -1,17 +1,23 @@
 #made by R SAI VEDANT
 import os
-import json
 import datetime
-import csv
-from collections import defaultdict
 import utils
+import health
+import metrics
+import readings
 
 load_json = utils.load_json
 save_json = utils.save_json
 gen_id = utils.gen_id
 print_table = utils.print_table
+backend = utils.get_backend
 safe_float = utils.safe_float
 find_by_id = utils.find_by_id
+find_record = utils.find_record
+insert_record = utils.insert_record
+insert_records = utils.insert_records
+update_record = utils.update_record
+delete_record = utils.delete_record
 ADMIN_CREDENTIALS = utils.ADMIN_CREDENTIALS
 
 
@@ -53,8 +59,8 @@ def admin_menu():
         else:
             print("Invalid choice.")
 
+@metrics.profiled
 def add_air_quality_record():
-    air = load_json("air")
     pollutants_list = load_json("pollutants")
     print("Add Air Quality Record")
     region = input("Region / City: ").strip()
@@ -75,13 +81,13 @@ def add_air_quality_record():
         "date": date,
         "AQI": int(aqi),
         "pollutants": pollutant_levels,
-        "health_risk": ""
+        "health_risk": health.classify(aqi)
     }
-    air.append(rec)
-    save_json("air", air)
+    insert_record("air", rec)
     print("Record added.")
 
 
+@metrics.profiled
 def update_delete_aq_record():
     air = load_json("air")
     if not air:
@@ -92,16 +98,18 @@ def update_delete_aq_record():
     rid = input("Enter record_id to update/delete (blank to cancel): ").strip()
     if not rid:
         return
-    rec = find_by_id(air, "record_id", rid)
+    rec = find_record("air", rid)
     if not rec:
         print("Record not found.")
         return
     action = input("Enter 'u' to update, 'd' to delete, anything else to cancel: ").strip().lower()
     if action == "d":
-        air = [r for r in air if r["record_id"] != rid]
-        save_json("air", air)
+        delete_record("air", rid)
         print("Deleted.")
     elif action == "u":
+        # the stored record is shared with the cache; edit a copy and write that
+        rec = dict(rec)
+        rec["pollutants"] = dict(rec.get("pollutants", {}))
         rec["region"] = input(f"Region [{rec['region']}]: ").strip() or rec['region']
         rec["date"] = input(f"Date [{rec['date']}]: ").strip() or rec['date']
         aqi_in = input(f"AQI [{rec['AQI']}]: ").strip()
@@ -111,12 +119,14 @@ def update_delete_aq_record():
             newv = input(f"{k} [{rec['pollutants'].get(k,'')}]: ").strip()
             if newv != "":
                 rec['pollutants'][k] = safe_float(newv)
-        save_json("air", air)
+        rec["health_risk"] = health.classify(rec["AQI"])
+        update_record("air", rec)
         print("Updated.")
     else:
         print("Cancelled.")
 
 
+@metrics.profiled
 def manage_pollutants():
     while True:
         pollutants = load_json("pollutants")
@@ -128,8 +138,7 @@ def manage_pollutants():
             name = input("Name: ").strip()
             desc = input("Description: ").strip()
             sl = input("Safe limit (numeric): ").strip()
-            pollutants.append({"pollutant_id": gen_id("pol"), "name": name, "description": desc, "safe_limit": safe_float(sl)})
-            save_json("pollutants", pollutants)
+            insert_record("pollutants", {"pollutant_id": gen_id("pol"), "name": name, "description": desc, "safe_limit": safe_float(sl)})
             print("Pollutant added.")
         elif ch == "2":
             pid = input("Pollutant ID to update: ").strip()
@@ -137,17 +146,17 @@ def manage_pollutants():
             if not p:
                 print("Not found.")
                 continue
+            p = dict(p)
             p["name"] = input(f"Name [{p['name']}]: ").strip() or p["name"]
             p["description"] = input(f"Description [{p.get('description','')}]: ").strip() or p.get("description","")
             sl = input(f"Safe limit [{p.get('safe_limit','')}]: ").strip()
             if sl != "":
                 p["safe_limit"] = safe_float(sl)
-            save_json("pollutants", pollutants)
+            update_record("pollutants", p)
             print("Updated.")
         elif ch == "3":
             pid = input("Pollutant ID to delete: ").strip()
-            pollutants = [x for x in pollutants if x["pollutant_id"] != pid]
-            save_json("pollutants", pollutants)
+            delete_record("pollutants", pid)
             print("Deleted if existed.")
         elif ch == "4":
             break
@@ -155,79 +164,84 @@ def manage_pollutants():
             print("Invalid choice.")
 
 
+@metrics.timed("bulk_import")
+def bulk_import(path, workers=None, progress=print, dedup=False):
+    """Import a file, directory or glob and scan the new records for exceedances.
+
+    With dedup, readings already stored are skipped or updated rather than
+    added again (see ingest.dedupe). Returns the import stats with the scan's
+    under "exceedance"; raises FileNotFoundError if path matches nothing and
+    ValueError for a bad file.
+    """
+    import ingest
+    import exceedance
+    if os.path.isfile(path):
+        stats = ingest.import_file(path, progress=progress, dedup=dedup)
+    elif ingest.expand_paths(path):
+        stats = ingest.import_many(path, workers, progress, dedup)
+    else:
+        raise FileNotFoundError(path)
+    if stats["imported"]:
+        # readings updated in place are behind the scan watermark
+        stats["exceedance"] = exceedance.run(full=bool(stats.get("updated")))
+    return stats
+
+
+@metrics.profiled
 def upload_bulk_data():
-    path = input("Enter path to JSON or CSV file: ").strip()
-    if not os.path.exists(path):
+    path = input("Enter path to JSON or CSV file, a directory, or a glob: ").strip()
+    dedup = input("Skip readings already stored (same region, date, station)? [Y/n]: ").strip().lower() != "n"
+    try:
+        stats = bulk_import(path, dedup=dedup)
+    except FileNotFoundError:
         print("File not found.")
         return
-    ext = os.path.splitext(path)[1].lower()
-    air = load_json("air")
-    if ext == ".json":
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if isinstance(data, list):
-            for rec in data:
-                if "record_id" not in rec:
-                    rec["record_id"] = gen_id("rec")
-                air.append(rec)
-            save_json("air", air)
-            print(f"Imported {len(data)} records.")
-        else:
-            print("JSON must be a list of records.")
-    elif ext == ".csv":
-        pollutants = [p["name"] for p in load_json("pollutants")]
-        with open(path, newline="", encoding="utf-8") as cf:
-            reader = csv.DictReader(cf)
-            added = 0
-            for row in reader:
-                rec = {
-                    "record_id": gen_id("rec"),
-                    "region": row.get("region", ""),
-                    "date": row.get("date", str(datetime.date.today())),
-                    "AQI": int(safe_float(row.get("AQI",0))),
-                    "pollutants": {},
-                    "health_risk": row.get("health_risk","")
-                }
-                for pn in pollutants:
-                    if pn in row and row[pn] != "":
-                        rec["pollutants"][pn] = safe_float(row[pn])
-                air.append(rec)
-                added += 1
-            save_json("air", air)
-            print(f"Imported {added} rows from CSV.")
-    else:
-        print("Unsupported file type. Use .json or .csv")
+    except ValueError as e:
+        print(e)
+        return
+    print(f"Imported {stats['imported']} records ({stats['rejected']} rejected) in {stats['seconds']}s.")
+    if dedup:
+        print(f"{stats['inserted']} new, {stats['updated']} updated, {stats['skipped']} already stored.")
+    if "exceedance" in stats:
+        print_scan(stats["exceedance"])
+
+
+def print_scan(stats):
+    print(f"Scanned {stats['scanned']} new records: {stats['issued']} alerts issued, {stats['refreshed']} refreshed.")
+
+
+@metrics.timed("report.region_averages", records=True)
+def region_averages():
+    rows = [[region, round(avg, 1), n] for region, avg, n in readings.region_averages()]
+    rows.sort(key=lambda x: x[1], reverse=True)
+    return rows
 
 
+@metrics.timed("report.monthly_trend", records=True)
+def monthly_trend(region):
+    return readings.monthly_means(region)
+
+
+@metrics.timed("report.pollutant_peaks")
+def pollutant_peaks():
+    return readings.pollutant_peaks()
+
+
+@metrics.profiled
 def generate_reports():
-    air = load_json("air")
-    if not air:
+    if not readings.exists():
         print("No data available.")
         return
-    print("Report options: 1.Top polluted regions (avg AQI) 2.Monthly trend for a region 3.Alerts summary 4.Back")
+    print("Report options: 1.Top polluted regions (avg AQI) 2.Monthly trend for a region 3.Alerts summary 4.Peak pollutant levels by region 5.Pollutant percentiles (all regions) 6.Region x month AQI heatmap 7.Back")
     ch = input("Choice: ").strip()
     if ch == "1":
-        region_map = defaultdict(list)
-        for r in air:
-            region_map[r["region"]].append(r.get("AQI",0))
-        rows = [[region, round(sum(vals)/len(vals),1), len(vals)] for region, vals in region_map.items()]
-        rows.sort(key=lambda x: x[1], reverse=True)
-        print_table(rows, headers=["Region", "Average AQI", "Records"])
+        print_table(region_averages(), headers=["Region", "Average AQI", "Records"])
     elif ch == "2":
         region = input("Region: ").strip()
-        rows = [r for r in air if r["region"].lower() == region.lower()]
-        if not rows:
+        data = monthly_trend(region)
+        if not data:
             print("No data for that region.")
             return
-        monthly = defaultdict(list)
-        for r in rows:
-            try:
-                d = datetime.datetime.strptime(r["date"], "%Y-%m-%d")
-                key = f"{d.year}-{d.month:02d}"
-            except Exception:
-                key = r["date"]
-            monthly[key].append(r.get("AQI",0))
-        data = sorted([(k, sum(v)/len(v)) for k,v in monthly.items()])
         print_table(data, headers=["Month", "Avg AQI"])
     elif ch == "3":
         alerts = load_json("alerts")
@@ -236,28 +250,54 @@ def generate_reports():
             return
         rows = [[a["alert_id"], a["region"], a["AQI_level"], a["status"], a["issue_date"]] for a in alerts]
         print_table(rows, headers=["ID","Region","AQI_level","Status","Issue date"])
+    elif ch == "4":
+        names = [p["name"] for p in load_json("pollutants")]
+        rows = [[region] + [peak.get(n, "") for n in names] for region, peak in pollutant_peaks().items()]
+        print_table(rows, headers=["Region"] + names)
+    elif ch in ("5", "6"):
+        # full passes over live and sealed readings, spread over all CPUs
+        import reports
+        agg = reports.aggregate()
+        if ch == "5":
+            print_table(reports.pollutant_table(agg), headers=["Measure", "Readings", "Min", "Mean", "P50", "P90", "P99", "Max"])
+        else:
+            months, rows = reports.heatmap(agg)
+            print_table(rows, headers=["Region"] + months)
     else:
         return
 
 
+def issue_alert(region, level, expiry=""):
+    alert = {"alert_id": gen_id("alert"), "region": region, "AQI_level": level, "status": "active", "issue_date": str(datetime.date.today()), "expiry_date": expiry}
+    insert_record("alerts", alert)
+    return alert
+
+
+def withdraw_alert(aid):
+    a = find_record("alerts", aid)
+    if not a:
+        return None
+    a = dict(a, status="withdrawn")
+    update_record("alerts", a)
+    return a
+
+
+@metrics.profiled
 def manage_alerts():
-    alerts = load_json("alerts")
-    print("1.Issue alert 2.Withdraw alert 3.Back")
+    print("1.Issue alert 2.Withdraw alert 3.Scan readings against safe limits 4.Back")
     ch = input("Choice: ").strip()
     if ch == "1":
         region = input("Region: ").strip()
         level = input("AQI level: ").strip()
-        issue_date = str(datetime.date.today())
         expiry = input("Expiry date (YYYY-MM-DD) or blank: ").strip()
-        alerts.append({"alert_id": gen_id("alert"), "region": region, "AQI_level": level, "status": "active", "issue_date": issue_date, "expiry_date": expiry})
-        save_json("alerts", alerts)
+        issue_alert(region, level, expiry)
         print("Alert issued.")
     elif ch == "2":
         aid = input("Alert ID to withdraw: ").strip()
-        a = find_by_id(alerts, "alert_id", aid)
-        if a:
-            a["status"] = "withdrawn"
-            save_json("alerts", alerts)
+        if withdraw_alert(aid):
             print("Alert withdrawn.")
+    elif ch == "3":
+        import exceedance
+        print_scan(exceedance.run())
     else:
         return
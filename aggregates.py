@@ -0,0 +1,149 @@
+import sys
+import utils
+from indexes import region_key
+
+month_key = utils.month_key
+
+
+class AirAggregates:
+    """Running report aggregates over the air records.
+
+    Keeps count and AQI sum per region, count and sum per month of each
+    case-folded region and the latest record per region, adjusted on every put/delete so reports
+    cost O(regions) rather than a pass over all records.
+    """
+
+    def __init__(self, records=()):
+        self._rows = {}
+        self._seq = 0
+        self.regions = {}
+        self.months = {}
+        self.members = {}
+        self._latest = {}
+        self._stale = set()
+        for rec in records:
+            self.put(rec)
+
+    def _bump(self, table, key, count, total):
+        cell = table.get(key)
+        if cell is None:
+            cell = table[key] = [0, 0]
+        cell[0] += count
+        cell[1] += total
+        if cell[0] == 0:
+            del table[key]
+
+    def _remove(self, rid):
+        row = self._rows.pop(rid, None)
+        if row is None:
+            return None
+        region, fold, month, aqi, date, seq = row
+        self._bump(self.regions, region, -1, -aqi)
+        months = self.months[fold]
+        self._bump(months, month, -1, -aqi)
+        if not months:
+            del self.months[fold]
+        ids = self.members[fold]
+        del ids[rid]
+        if not ids:
+            del self.members[fold]
+            self._latest.pop(fold, None)
+            self._stale.discard(fold)
+        elif self._latest.get(fold) == rid:
+            self._stale.add(fold)
+        return seq
+
+    def put(self, rec):
+        rid = rec.get("record_id")
+        seq = self._remove(rid)
+        if seq is None:
+            seq = self._seq
+            self._seq += 1
+        region = rec.get("region")
+        fold = region_key(region)
+        date = str(rec.get("date", ""))
+        aqi = rec.get("AQI", 0)
+        self._rows[rid] = (region, fold, month_key(date), aqi, date, seq)
+        self._bump(self.regions, region, 1, aqi)
+        self._bump(self.months.setdefault(fold, {}), month_key(date), 1, aqi)
+        self.members.setdefault(fold, {})[rid] = rec
+        if fold not in self._stale:
+            cur = self._latest.get(fold)
+            if cur is None or self._rank(rid) > self._rank(cur):
+                self._latest[fold] = rid
+
+    def delete(self, rid):
+        self._remove(rid)
+
+    def _rank(self, rid):
+        # latest date wins; on equal dates the earlier record does
+        row = self._rows[rid]
+        return (row[4], -row[5])
+
+    def latest(self, region):
+        fold = region_key(region)
+        if fold in self._stale:
+            self._latest[fold] = max(self.members[fold], key=self._rank)
+            self._stale.discard(fold)
+        rid = self._latest.get(fold)
+        return self.members[fold][rid] if rid is not None else None
+
+    def latest_per_region(self):
+        return [self.latest(fold) for fold in self.members]
+
+    def region_totals(self):
+        """[(region, AQI sum, count)] per region name."""
+        return [(region, total, count) for region, (count, total) in self.regions.items()]
+
+    def month_totals(self, region):
+        """[(month, AQI sum, count)] for one region (case-insensitive), by month."""
+        months = self.months.get(region_key(region), {})
+        return sorted((month, total, count) for month, (count, total) in months.items())
+
+    def snapshot(self):
+        return {
+            "regions": {r: list(v) for r, v in self.regions.items()},
+            "months": {f"{f}|{m}": list(v) for f, months in self.months.items() for m, v in months.items()},
+            "latest": {f: self.latest(f).get("record_id") for f in self.members},
+        }
+
+
+def check(records=None):
+    """Compare the live aggregates with a full recompute; returns mismatches."""
+    if records is None:
+        records = utils.load_json("air")
+    live = utils.air_aggregates().snapshot()
+    fresh = AirAggregates(records).snapshot()
+    problems = []
+    for part in ("regions", "months", "latest"):
+        a, b = live[part], fresh[part]
+        for key in sorted(set(a) | set(b)):
+            if a.get(key) != b.get(key):
+                problems.append((part, key, a.get(key), b.get(key)))
+    return problems
+
+
+def rebuild():
+    utils.repo.drop_view("air", "aggregates")
+    return utils.air_aggregates()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    cmd = argv[0] if argv else "check"
+    if cmd == "rebuild":
+        agg = rebuild()
+        print(f"Rebuilt aggregates for {len(agg.regions)} regions.")
+        return 0
+    if cmd == "check":
+        problems = check()
+        for part, key, live, fresh in problems:
+            print(f"{part} {key}: live={live} recomputed={fresh}")
+        print("Aggregates consistent." if not problems else f"{len(problems)} mismatches.")
+        return 1 if problems else 0
+    print("usage: python aggregates.py [check|rebuild]")
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import os
+import sys
+import argparse
+import datetime
+import utils
+import storage
+
+# Holds the day of the last sweep_daily().
+SWEEP_MARKER = ".alerts-swept"
+
+
+def today():
+    return datetime.date.today().isoformat()
+
+
+def in_force(region=None, day=None):
+    """Active alerts covering day (default today), for one region or all."""
+    return utils.get_backend().alerts_in_force(day or today(), region)
+
+
+def sweep(day=None):
+    """Move every alert that expired before day (default today) to the archive.
+
+    Alerts are copied to the archive before they are deleted from the live
+    set, so a crash in between leaves a duplicate that the next sweep
+    removes, never a lost alert. Returns the number of alerts moved.
+    """
+    utils.ensure_data_dir()
+    expired = utils.get_backend().expired_alerts(day or today())
+    if not expired:
+        return 0
+    utils.insert_records("alerts_archive", expired)
+    utils.delete_records("alerts", [a["alert_id"] for a in expired])
+    return len(expired)
+
+
+def sweep_daily():
+    """sweep() unless one already ran today; cheap enough to call at startup."""
+    utils.ensure_data_dir()
+    marker = os.path.join(utils.DATA_DIR, SWEEP_MARKER)
+    day = today()
+    try:
+        with open(marker, "r", encoding="utf-8") as f:
+            if f.read().strip() == day:
+                return 0
+    except OSError:
+        pass
+    moved = sweep(day)
+    storage.atomic_write(marker, day)
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Alerts in force, and archiving of expired ones.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("sweep", help="move expired alerts to the archive (run daily, e.g. from cron)")
+    p.add_argument("--date", help="sweep alerts that expired before this day (default today)")
+    p = sub.add_parser("active", help="list alerts in force")
+    p.add_argument("--region")
+    p.add_argument("--date", help="YYYY-MM-DD (default today)")
+    args = parser.parse_args(argv)
+    if args.command == "sweep":
+        print(f"Archived {sweep(args.date)} expired alerts.")
+    else:
+        rows = [[a["alert_id"], a["region"], a["AQI_level"], a["issue_date"], a["expiry_date"]]
+                for a in in_force(args.region, args.date)]
+        utils.print_table(rows, headers=["ID", "Region", "Level", "Issued", "Expires"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import utils
+import citizen
+import alerting
+
+# Datasets the API reads; a change to any of them drops every cached response.
+DATASETS = ("air", "alerts", "guidelines")
+
+# How often (seconds) the data files are checked for changes, at most.
+REFRESH_INTERVAL = 0.5
+# Idle keep-alive connections are closed after this many seconds.
+KEEPALIVE_TIMEOUT = 15
+MAX_HEADER_BYTES = 16 * 1024
+MAX_CACHED = 4096
+
+REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 431: "Request Header Fields Too Large",
+           500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _arg(query, name, required=True):
+    value = query.get(name, [""])[0].strip()
+    if required and not value:
+        raise HTTPError(400, f"missing query parameter: {name}")
+    return value
+
+
+def current(query):
+    region = _arg(query, "region")
+    record, alerts = citizen.current_aqi(region)
+    if record is None:
+        raise HTTPError(404, f"no AQI data for region: {region}")
+    return {"region": region, "record": record, "alerts": alerts}
+
+
+def latest(query):
+    return citizen.search("latest")
+
+
+def history(query):
+    given = [by for by in ("date", "region", "pollutant") if _arg(query, by, required=False)]
+    if len(given) != 1:
+        raise HTTPError(400, "give exactly one of: date, region, pollutant")
+    return citizen.search(given[0], _arg(query, given[0]))
+
+
+def alerts(query):
+    return citizen.active_alerts(_arg(query, "region", required=False) or None,
+                                 _arg(query, "date", required=False) or None)
+
+
+def guidelines(query):
+    return utils.load_json("guidelines")
+
+
+ROUTES = {
+    "/aqi/current": current,
+    "/aqi/latest": latest,
+    "/aqi/history": history,
+    "/alerts": alerts,
+    "/guidelines": guidelines,
+}
+
+
+class Snapshot:
+    """Rendered responses, valid for one version of the data files.
+
+    Bodies are computed once per (path, query) and kept with their ETag until
+    a dataset's version changes, which is checked at most every `interval`
+    seconds. Reads go through the process-wide repository, so the records
+    themselves are parsed once and shared between requests.
+
+    Checks and handlers run on one worker thread, off the event loop, so a
+    slow lookup does not stall other connections and the repository and
+    backend are only ever used from that thread. Concurrent requests for the
+    same (path, query) share one computation.
+    """
+
+    def __init__(self, interval=REFRESH_INTERVAL):
+        self.interval = interval
+        self.versions = None
+        self.checked = 0.0
+        self.responses = {}
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api")
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self.checked < self.interval:
+            return
+        self.checked = now
+        db = utils.get_backend()
+        # the day is part of the version: alerts go out of force at midnight
+        versions = [db.version(name) for name in DATASETS] + [alerting.today()]
+        if versions != self.versions:
+            self.versions = versions
+            self.responses.clear()
+
+    def render(self, key):
+        # On the worker thread.
+        self.refresh()
+        hit = self.responses.get(key)
+        if hit is not None:
+            return hit
+        path, query_string = key
+        handler = ROUTES.get(path)
+        if handler is None:
+            raise HTTPError(404, f"unknown path: {path}")
+        body = (json.dumps(handler(parse_qs(query_string)), default=str) + "\n").encode("utf-8")
+        etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        if len(self.responses) >= MAX_CACHED:
+            self.responses.clear()
+        self.responses[key] = (etag, body)
+        return etag, body
+
+    async def get(self, path, query_string):
+        key = (path, query_string)
+        if time.monotonic() - self.checked < self.interval:
+            hit = self.responses.get(key)
+            if hit is not None:
+                return hit
+        fut = self.pending.get(key)
+        if fut is None:
+            fut = asyncio.get_running_loop().run_in_executor(self.executor, self.render, key)
+            self.pending[key] = fut
+            fut.add_done_callback(lambda f: self.pending.pop(key, None) if self.pending.get(key) is f else None)
+        # shielded: one client hanging up must not cancel the others' result
+        return await asyncio.shield(fut)
+
+
+def _response(status, body=b"", headers=(), keep_alive=True, head=False):
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+             "Content-Type: application/json; charset=utf-8",
+             f"Content-Length: {len(body)}",
+             "Connection: " + ("keep-alive" if keep_alive else "close")]
+    lines.extend(f"{k}: {v}" for k, v in headers)
+    out = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+    return out if head or status == 304 else out + body
+
+
+def _error(message):
+    return (json.dumps({"error": message}) + "\n").encode("utf-8")
+
+
+async def _read_request(reader):
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split()
+    if len(parts) != 3:
+        raise HTTPError(400, "malformed request line")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    length = int(headers.get("content-length") or 0)
+    if length:
+        # Nothing here takes a body; read it only to keep the stream in sync.
+        await reader.readexactly(length)
+    return parts[0].upper(), parts[1], parts[2].upper(), headers
+
+
+def _wants_keep_alive(version, headers):
+    conn = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        return conn == "keep-alive"
+    return conn != "close"
+
+
+async def handle(snapshot, method, target, headers):
+    """Return (status, body, extra headers) for one request."""
+    if method not in ("GET", "HEAD"):
+        return 405, _error("read-only API: use GET"), [("Allow", "GET, HEAD")]
+    url = urlsplit(target)
+    try:
+        etag, body = await snapshot.get(url.path.rstrip("/") or "/", url.query)
+    except HTTPError as e:
+        return e.status, _error(str(e)), []
+    cache = [("ETag", etag), ("Cache-Control", "no-cache")]
+    tags = [t.strip() for t in headers.get("if-none-match", "").split(",")]
+    if etag in tags or "*" in tags:
+        return 304, b"", cache
+    return 200, body, cache
+
+
+async def serve_connection(snapshot, reader, writer):
+    try:
+        while True:
+            try:
+                method, target, version, headers = await _read_request(reader)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                break
+            except asyncio.LimitOverrunError:
+                writer.write(_response(431, _error("headers too large"), keep_alive=False))
+                break
+            except (HTTPError, ValueError) as e:
+                writer.write(_response(400, _error(str(e)), keep_alive=False))
+                break
+            keep_alive = _wants_keep_alive(version, headers)
+            try:
+                status, body, extra = await handle(snapshot, method, target, headers)
+            except Exception as e:
+                status, body, extra = 500, _error(str(e)), []
+            writer.write(_response(status, body, extra, keep_alive, head=method == "HEAD"))
+            await writer.drain()
+            if not keep_alive:
+                break
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def start(host="127.0.0.1", port=8080, interval=REFRESH_INTERVAL):
+    utils.ensure_data_dir()
+    snapshot = Snapshot(interval)
+    return await asyncio.start_server(lambda r, w: serve_connection(snapshot, r, w),
+                                      host, port, limit=MAX_HEADER_BYTES)
+
+
+async def serve(host, port, interval):
+    server = await start(host, port, interval)
+    addrs = ", ".join(f"{s.getsockname()[0]}:{s.getsockname()[1]}" for s in server.sockets)
+    print(f"Serving the AQI API on {addrs}")
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Read-only HTTP API over the portal's data.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--refresh", type=float, default=REFRESH_INTERVAL,
+                        help="seconds between checks for changed data files")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, args.refresh))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,539 @@
+import os
+import sys
+import json
+import sqlite3
+import argparse
+import threading
+import contextlib
+import utils
+import metrics
+import repository
+from indexes import region_key, alert_interval, contact_key, natural_key
+
+SQLITE_FILE = "portal.db"
+
+
+class JsonBackend:
+    """The flat-file store: data/*.json snapshots plus append-only logs.
+
+    Parsed datasets live in utils.repo; queries are answered from its
+    incrementally maintained views (index, aggregates, columns).
+    """
+
+    name = "json"
+
+    def load(self, name):
+        utils.ensure_data_dir()
+        return utils.repo.get(name)
+
+    def save(self, name, data):
+        utils.ensure_data_dir()
+        store = utils.get_store(name)
+        with store.locked():
+            store.compact(data)
+            utils.repo.stored(name, data)
+
+    @contextlib.contextmanager
+    def transaction(self, name):
+        utils.ensure_data_dir()
+        store = utils.get_store(name)
+        with store.locked():
+            data = store.load()
+            yield data
+            self.save(name, data)
+
+    def _compact_if_needed(self, name, store):
+        if store.needs_compaction():
+            with store.locked():
+                data = utils.repo.peek(name)
+                self.save(name, data if data is not None else store.load())
+
+    def compact(self, name):
+        """Fold the log into the snapshot if it has outgrown it (see
+        storage.COMPACT_RATIO); for writers that insert with compact=False."""
+        utils.ensure_data_dir()
+        self._compact_if_needed(name, utils.get_store(name))
+
+    def insert(self, name, records, compact=True):
+        utils.ensure_data_dir()
+        store = utils.get_store(name)
+        with store.locked():
+            current = utils.repo.peek(name) is not None
+            store.put(records)
+            utils.repo.applied(name, puts=records, was_current=current)
+        if compact:
+            self._compact_if_needed(name, store)
+
+    def delete(self, name, keys):
+        utils.ensure_data_dir()
+        store = utils.get_store(name)
+        with store.locked():
+            current = utils.repo.peek(name) is not None
+            store.delete(keys)
+            utils.repo.applied(name, deletes=keys, was_current=current)
+        self._compact_if_needed(name, store)
+
+    def count(self, name):
+        return len(self.load(name))
+
+    def version(self, name):
+        store = utils.get_store(name)
+        return list(repository.file_signature(store.path, store.log_path))
+
+    def get(self, name, key):
+        if name == "air":
+            return utils.air_index().get(key)
+        if name == "citizens":
+            return utils.citizen_index().get(key)
+        if name == "alerts":
+            return utils.alert_index().get(key)
+        return utils.find_by_id(self.load(name), utils.KEYS[name], key)
+
+    def tail(self, name, mark=None):
+        """(records, everything, mark): the records written since mark, or
+        every record (everything=True) if there is no mark or it no longer
+        applies, and the mark to pass next time.
+
+        The mark is the snapshot's signature, the log offset read to and the
+        key of the last record written. Without a compaction since, only the
+        log after the offset is read; after one, the snapshot from that last
+        record on. Records rewritten in place before a compaction are not
+        seen again; deleting and re-adding the last record may hide the
+        records written between.
+        """
+        utils.ensure_data_dir()
+        store = utils.get_store(name)
+        key = utils.KEYS[name]
+        with store.locked(shared=True):
+            snap = store.snapshot_signature()
+            found = None
+            if mark and mark.get("snapshot") == snap and mark.get("log", 0) <= store.log_size():
+                found, offset = {}, mark["log"]
+            elif mark and mark.get("last") is not None:
+                after = store.snapshot_from(mark["last"])
+                if after is not None:
+                    found, offset = {r.get(key): r for r in after[1:]}, 0
+            if found is None:
+                records = self.load(name)
+                return records, True, {"snapshot": snap, "log": store.log_size(),
+                                       "last": records[-1].get(key) if records else None}
+            entries, offset = store.read_log_from(offset)
+            last = next(reversed(found), mark["last"])
+            for entry in entries:
+                if entry.get("op") == "put":
+                    last = entry["rec"].get(key)
+                    found.pop(last, None)
+                    found[last] = entry["rec"]
+                elif entry.get("op") == "del":
+                    found.pop(entry.get("id"), None)
+            return list(found.values()), False, {"snapshot": snap, "log": offset, "last": last}
+
+    def peek_records(self, name, keys):
+        """{key: stored record} for the keys that have one, but only if the
+        dataset is in memory already ({} otherwise)."""
+        if utils.repo.peek(name) is None:
+            return {}
+        found = {}
+        for key in keys:
+            rec = self.get(name, key)
+            if rec is not None:
+                found[key] = rec
+        return found
+
+    def register_citizen(self, rec, stem):
+        # Allocation and insert happen under the exclusive lock, so two
+        # processes registering namesakes cannot both get the same id.
+        utils.ensure_data_dir()
+        with utils.get_store("citizens").locked():
+            rec["citizen_id"] = utils.citizen_index().allocate(stem)
+            self.insert("citizens", [rec])
+        return rec["citizen_id"]
+
+    def citizen_by_contact(self, contact):
+        return utils.citizen_index().with_contact(contact)
+
+    def citizens_in_region(self, region):
+        return utils.citizen_index().in_region(region)
+
+    def air_by_natural_key(self, keys):
+        """{key: stored record} for the natural keys that have one."""
+        natural, air = utils.air_natural_index(), utils.air_index()
+        found = {}
+        for key in keys:
+            rid = natural.first(key)
+            if rid is not None:
+                found[key] = air.get(rid)
+        return found
+
+    def records_on_date(self, date):
+        return metrics.scanned(utils.air_index().on_date(date))
+
+    def records_between(self, start, end):
+        return metrics.scanned(utils.air_index().date_range(start, end))
+
+    def records_for_region(self, region):
+        return metrics.scanned(utils.air_index().region(region))
+
+    def records_with_pollutant(self, pollutant):
+        return metrics.scanned(utils.air_index().with_pollutant(pollutant))
+
+    def latest_for_region(self, region):
+        return utils.air_index().latest(region)
+
+    def latest_per_region(self):
+        return metrics.scanned(utils.air_aggregates().latest_per_region())
+
+    def region_totals(self):
+        # one precomputed total per region
+        return metrics.scanned(utils.air_aggregates().region_totals())
+
+    def month_totals(self, region):
+        return metrics.scanned(utils.air_aggregates().month_totals(region))
+
+    def alerts_in_force(self, day, region=None):
+        return utils.alert_index().in_force(day, region)
+
+    def expired_alerts(self, before):
+        return utils.alert_index().expired(before)
+
+    def pollutant_peaks(self):
+        cols = utils.air_columns()
+        if cols is not None:
+            return cols.pollutant_max_by_region()
+        peaks = {}
+        for r in self.load("air"):
+            peak = peaks.setdefault(r["region"], {})
+            for k, v in r.get("pollutants", {}).items():
+                v = utils.safe_float(v, None)
+                if v is not None and (k not in peak or v > peak[k]):
+                    peak[k] = v
+        return peaks
+
+
+# Columns pulled out of each document so they can be indexed and queried;
+# the full record is kept as JSON in `doc` so nothing is lost on export.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, n INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS air (
+    record_id TEXT PRIMARY KEY, region TEXT, region_key TEXT, date TEXT,
+    month TEXT, aqi REAL, doc TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS air_region_date ON air (region_key, date);
+CREATE INDEX IF NOT EXISTS air_date ON air (date);
+CREATE TABLE IF NOT EXISTS air_pollutants (
+    record_id TEXT NOT NULL REFERENCES air (record_id) ON DELETE CASCADE,
+    name TEXT NOT NULL, value REAL, PRIMARY KEY (record_id, name));
+CREATE INDEX IF NOT EXISTS air_pollutants_name ON air_pollutants (name, value);
+CREATE TABLE IF NOT EXISTS citizens (
+    citizen_id TEXT PRIMARY KEY, location_key TEXT, contact TEXT, doc TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS citizens_location ON citizens (location_key);
+CREATE INDEX IF NOT EXISTS citizens_contact ON citizens (contact);
+CREATE INDEX IF NOT EXISTS citizens_id_nocase ON citizens (citizen_id COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS pollutants (pollutant_id TEXT PRIMARY KEY, name TEXT, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS alerts (
+    alert_id TEXT PRIMARY KEY, region_key TEXT, status TEXT, issue_date TEXT,
+    expiry_date TEXT, doc TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS alerts_region ON alerts (region_key, status, issue_date, expiry_date);
+CREATE INDEX IF NOT EXISTS alerts_expiry ON alerts (expiry_date);
+CREATE TABLE IF NOT EXISTS alerts_archive (alert_id TEXT PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS guidelines (guide_id TEXT PRIMARY KEY, doc TEXT NOT NULL);
+"""
+
+
+def _columns(name, rec):
+    if name == "air":
+        date = str(rec.get("date", ""))
+        return {"region": rec.get("region"), "region_key": region_key(rec.get("region")), "date": date,
+                "month": utils.month_key(date), "aqi": utils.safe_float(rec.get("AQI", 0))}
+    if name == "citizens":
+        return {"location_key": region_key(rec.get("location")), "contact": contact_key(rec.get("contact"))}
+    if name == "pollutants":
+        return {"name": rec.get("name")}
+    if name == "alerts":
+        # normalized dates: "" for no issue date, OPEN_ENDED for no expiry
+        issue, expiry = alert_interval(rec)
+        return {"region_key": region_key(rec.get("region")), "status": rec.get("status"),
+                "issue_date": issue, "expiry_date": expiry}
+    return {}
+
+
+class SqliteBackend:
+    """Every dataset in one SQLite database (WAL mode), queried with SQL.
+
+    Rows keep their insertion order through the rowid, and an upsert keeps a
+    record's rowid, so load() returns records in the same order as the JSON
+    store would. Each thread gets its own connection (sqlite3 connections
+    cannot be shared between threads), e.g. the API's worker thread.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("AQ_SQLITE_PATH") or os.path.join(utils.DATA_DIR, SQLITE_FILE)
+        self._local = threading.local()
+        self._cache = {}
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _write(self, name):
+        conn = self.conn
+        nested = conn.in_transaction
+        if not nested:
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("INSERT INTO versions (name, n) VALUES (?, 1) "
+                         "ON CONFLICT (name) DO UPDATE SET n = n + 1", (name,))
+            if not nested:
+                conn.execute("COMMIT")
+        except BaseException:
+            if not nested:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._cache.pop(name, None)
+
+    def count(self, name):
+        return self.conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+
+    def version(self, name):
+        row = self.conn.execute("SELECT n FROM versions WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def load(self, name):
+        # Cached per dataset until its version counter moves, which any
+        # process's write does.
+        ver = self.version(name)
+        hit = self._cache.get(name)
+        if hit is not None and hit[0] == ver:
+            return hit[1]
+        data = [json.loads(doc) for (doc,) in self.conn.execute(f"SELECT doc FROM {name} ORDER BY rowid")]
+        self._cache[name] = (ver, data)
+        return data
+
+    def _upsert(self, conn, name, records):
+        key = utils.KEYS[name]
+        for rec in records:
+            cols = {key: rec.get(key), **_columns(name, rec), "doc": json.dumps(rec, default=str)}
+            names = ", ".join(cols)
+            marks = ", ".join("?" for _ in cols)
+            updates = ", ".join(f"{c} = excluded.{c}" for c in cols if c != key)
+            conn.execute(f"INSERT INTO {name} ({names}) VALUES ({marks}) "
+                         f"ON CONFLICT ({key}) DO UPDATE SET {updates}", list(cols.values()))
+            if name == "air":
+                conn.execute("DELETE FROM air_pollutants WHERE record_id = ?", (rec.get(key),))
+                conn.executemany(
+                    "INSERT INTO air_pollutants (record_id, name, value) VALUES (?, ?, ?)",
+                    [(rec.get(key), p, utils.safe_float(v, None))
+                     for p, v in (rec.get("pollutants") or {}).items()])
+
+    def save(self, name, data):
+        with self._write(name) as conn:
+            conn.execute(f"DELETE FROM {name}")
+            self._upsert(conn, name, data)
+
+    def compact(self, name):
+        pass
+
+    def insert(self, name, records, compact=True):
+        with self._write(name) as conn:
+            self._upsert(conn, name, records)
+
+    def delete(self, name, keys):
+        with self._write(name) as conn:
+            conn.executemany(f"DELETE FROM {name} WHERE {utils.KEYS[name]} = ?", [(k,) for k in keys])
+
+    @contextlib.contextmanager
+    def transaction(self, name):
+        with self._write(name):
+            data = [json.loads(doc) for (doc,) in self.conn.execute(f"SELECT doc FROM {name} ORDER BY rowid")]
+            yield data
+            self.save(name, data)
+
+    def get(self, name, key):
+        if name == "citizens":
+            # case-insensitive, as ids are allocated; an exact match first
+            row = self.conn.execute("SELECT doc FROM citizens WHERE citizen_id = ? COLLATE NOCASE "
+                                    "ORDER BY citizen_id = ? DESC, rowid LIMIT 1", (key, key)).fetchone()
+        else:
+            row = self.conn.execute(f"SELECT doc FROM {name} WHERE {utils.KEYS[name]} = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _docs(self, sql, params=()):
+        return [json.loads(doc) for (doc,) in self.conn.execute(sql, params)]
+
+    def tail(self, name, mark=None):
+        """Like JsonBackend.tail. The mark is the last rowid and its key: new
+        rows get higher rowids, and a rewrite of the table is noticed by the
+        key at that rowid changing. An upsert keeps its rowid, so updated
+        records are not seen again."""
+        key = utils.KEYS[name]
+        since = 0
+        if mark and mark.get("rowid"):
+            row = self.conn.execute(f"SELECT {key} FROM {name} WHERE rowid = ?", (mark["rowid"],)).fetchone()
+            if row is not None and row[0] == mark.get("last"):
+                since = mark["rowid"]
+        rows = self.conn.execute(f"SELECT rowid, {key}, doc FROM {name} WHERE rowid > ? ORDER BY rowid",
+                                 (since,)).fetchall()
+        if rows:
+            mark = {"rowid": rows[-1][0], "last": rows[-1][1]}
+        elif not since:
+            mark = None
+        return [json.loads(doc) for _, _, doc in rows], not since, mark
+
+    def peek_records(self, name, keys):
+        key = utils.KEYS[name]
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            marks = ", ".join("?" for _ in chunk)
+            for doc in self._docs(f"SELECT doc FROM {name} WHERE {key} IN ({marks})", chunk):
+                found[doc.get(key)] = doc
+        return found
+
+    def register_citizen(self, rec, stem):
+        # BEGIN IMMEDIATE serializes writers, so the id found free stays free.
+        with self._write("citizens") as conn:
+            # the stem and every stem_<suffix> in one query, as for CitizenIndex.allocate
+            pattern = stem.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "\\_%"
+            taken = {cid.casefold() for (cid,) in conn.execute(
+                "SELECT citizen_id FROM citizens WHERE citizen_id = ? COLLATE NOCASE "
+                "OR citizen_id LIKE ? ESCAPE '\\'", (stem, pattern))}
+            cid, n = stem, 2
+            while cid.casefold() in taken:
+                cid, n = f"{stem}_{n}", n + 1
+            rec["citizen_id"] = cid
+            self._upsert(conn, "citizens", [rec])
+        return cid
+
+    def citizen_by_contact(self, contact):
+        docs = self._docs("SELECT doc FROM citizens WHERE contact = ? ORDER BY rowid LIMIT 1", (contact_key(contact),))
+        return docs[0] if docs else None
+
+    def citizens_in_region(self, region):
+        return self._docs("SELECT doc FROM citizens WHERE location_key = ? ORDER BY rowid", (region_key(region),))
+
+    def air_by_natural_key(self, keys):
+        # (region_key, date) is indexed; the station is checked on the few rows it finds
+        found = {}
+        for key in keys:
+            for doc in self._docs("SELECT doc FROM air WHERE region_key = ? AND date = ? ORDER BY rowid", key[:2]):
+                if natural_key(doc) == key:
+                    found[key] = doc
+                    break
+        return found
+
+    def records_on_date(self, date):
+        return metrics.scanned(self._docs("SELECT doc FROM air WHERE date = ? ORDER BY rowid", (date,)))
+
+    def records_between(self, start, end):
+        return metrics.scanned(
+            self._docs("SELECT doc FROM air WHERE date BETWEEN ? AND ? ORDER BY date, rowid", (start, end)))
+
+    def records_for_region(self, region):
+        return metrics.scanned(
+            self._docs("SELECT doc FROM air WHERE region_key = ? ORDER BY date, rowid", (region_key(region),)))
+
+    def records_with_pollutant(self, pollutant):
+        return metrics.scanned(self._docs("SELECT a.doc FROM air a JOIN air_pollutants p ON p.record_id = a.record_id "
+                                          "WHERE p.name = ? ORDER BY a.rowid", (pollutant,)))
+
+    def latest_for_region(self, region):
+        docs = self._docs("SELECT doc FROM air WHERE region_key = ? ORDER BY date DESC, rowid LIMIT 1",
+                          (region_key(region),))
+        return docs[0] if docs else None
+
+    def latest_per_region(self):
+        # the window functions read every row; n says how many there were
+        rows = self.conn.execute(
+            "SELECT doc, n FROM (SELECT doc, ROW_NUMBER() OVER (PARTITION BY region_key ORDER BY date DESC, rowid) AS rn, "
+            "MIN(rowid) OVER (PARTITION BY region_key) AS first, COUNT(*) OVER () AS n FROM air) "
+            "WHERE rn = 1 ORDER BY first").fetchall()
+        metrics.scanned(rows[0][1] if rows else 0)
+        return [json.loads(doc) for doc, _ in rows]
+
+    def region_totals(self):
+        rows = self.conn.execute(
+            "SELECT region, SUM(aqi), COUNT(*) FROM air GROUP BY region ORDER BY MIN(rowid)").fetchall()
+        metrics.scanned(sum(n for _, _, n in rows))
+        return rows
+
+    def month_totals(self, region):
+        rows = self.conn.execute(
+            "SELECT month, SUM(aqi), COUNT(*) FROM air WHERE region_key = ? GROUP BY month ORDER BY month",
+            (region_key(region),)).fetchall()
+        metrics.scanned(sum(n for _, _, n in rows))
+        return rows
+
+    def alerts_in_force(self, day, region=None):
+        sql = ("SELECT doc FROM alerts WHERE status = 'active' AND issue_date <= ? AND expiry_date >= ? "
+               "AND issue_date <= expiry_date")
+        params = [day, day]
+        if region is not None:
+            sql += " AND region_key = ?"
+            params.append(region_key(region))
+        return self._docs(sql + " ORDER BY issue_date, rowid", params)
+
+    def expired_alerts(self, before):
+        return self._docs("SELECT doc FROM alerts WHERE expiry_date < ? ORDER BY expiry_date, rowid", (before,))
+
+    def pollutant_peaks(self):
+        peaks = {}
+        for region, name, value in self.conn.execute(
+                "SELECT a.region, p.name, MAX(p.value) FROM air a LEFT JOIN air_pollutants p "
+                "ON p.record_id = a.record_id AND p.value IS NOT NULL "
+                "GROUP BY a.region, p.name ORDER BY MIN(a.rowid)"):
+            peak = peaks.setdefault(region, {})
+            if name is not None:
+                peak[name] = value
+        return peaks
+
+
+def create(kind):
+    if kind == "json":
+        return JsonBackend()
+    if kind == "sqlite":
+        return SqliteBackend()
+    raise ValueError(f"Unknown storage backend {kind!r} (use 'json' or 'sqlite').")
+
+
+def migrate(src, dst):
+    """Copy every dataset from one backend to another; returns row counts."""
+    counts = {}
+    for name in utils.FILES:
+        data = src.load(name)
+        dst.save(name, data)
+        counts[name] = len(data)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move data between the JSON files and SQLite.")
+    parser.add_argument("command", choices=["migrate", "export"],
+                        help="migrate: data/*.json -> SQLite; export: SQLite -> data/*.json")
+    parser.add_argument("--db", help=f"SQLite file (default data/{SQLITE_FILE})")
+    args = parser.parse_args(argv)
+    sqlite = SqliteBackend(args.db)
+    if args.command == "migrate":
+        counts = migrate(JsonBackend(), sqlite)
+    else:
+        counts = migrate(sqlite, JsonBackend())
+    for name, n in counts.items():
+        print(f"{name}: {n} records")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import builtins
+import datetime
+import tempfile
+import platform
+import contextlib
+import subprocess
+import statistics
+import utils
+
+
+def generate(regions, days, start=datetime.date(2023, 1, 1), seed=42):
+    """Yield one synthetic air record per region per day, in the live schema."""
+    rng = random.Random(seed)
+    names = [f"Region-{i:05d}" for i in range(regions)]
+    for d in range(days):
+        date = (start + datetime.timedelta(days=d)).isoformat()
+        for name in names:
+            yield utils.sample_air_record(name, date, rng)
+
+
+def use_data_dir(data_dir):
+    # Point utils and a fresh backend at data_dir; a SQLite database goes
+    # there too, whatever AQ_SQLITE_PATH says.
+    utils.DATA_DIR = data_dir
+    utils._backend = None
+    if utils.BACKEND == "sqlite":
+        import backends
+        utils._backend = backends.SqliteBackend(os.path.join(data_dir, backends.SQLITE_FILE))
+    utils.repo.invalidate()
+
+
+def write_dataset(data_dir, regions, days, seed=42):
+    # Sample pollutants, guidelines, citizens and alerts, plus the synthetic
+    # air records, all written through the configured backend.
+    use_data_dir(data_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        utils.create_sample_data()
+    records = list(generate(regions, days, seed=seed))
+    utils.save_json("air", records)
+    utils.repo.invalidate()
+    return len(records)
+
+
+def stored_bytes():
+    # Size of the air data as the backend keeps it.
+    backend = utils.get_backend()
+    if backend.name == "sqlite":
+        paths = (backend.path, backend.path + "-wal")
+    else:
+        store = utils.get_store("air")
+        paths = (store.path, store.log_path)
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+def write_import_files(tmp, rows):
+    names = [p["name"] for p in utils.load_json("pollutants")]
+    records = list(generate(max(1, rows // 30), 30, start=datetime.date(2030, 1, 1), seed=7))[:rows]
+    csv_path = os.path.join(tmp, "import.csv")
+    with open(csv_path, "w", encoding="utf-8") as f:
+        f.write(",".join(["region", "date", "AQI"] + names) + "\n")
+        for r in records:
+            f.write(",".join([r["region"], r["date"], str(r["AQI"])] +
+                             [str(r["pollutants"].get(n, "")) for n in names]) + "\n")
+    json_path = os.path.join(tmp, "import.json")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(records, f)
+    return csv_path, json_path
+
+
+@contextlib.contextmanager
+def scripted(answers):
+    # Feed canned answers to input() and swallow the printed tables.
+    it = iter(answers)
+    old = builtins.input
+    builtins.input = lambda prompt="": next(it)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        builtins.input = old
+
+
+def timed(fn, repeat, setup=None):
+    # One untimed call first, so lazily built indexes are not charged to run 1.
+    if setup is None:
+        fn()
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {"runs": repeat, "min": min(runs), "median": statistics.median(runs), "max": max(runs)}
+
+
+def interactive(fn, answers, *args):
+    def run():
+        with scripted(answers):
+            fn(*args)
+    return run
+
+
+def cases(tmp, import_rows):
+    import admin
+    import citizen
+    import ingest
+    air = utils.load_json("air")
+    region = air[len(air) // 2]["region"]
+    date = air[len(air) // 2]["date"]
+    # a fresh backend as well: SQLite keeps its own cache of loaded datasets
+    cold = lambda: use_data_dir(tmp)
+    csv_path, json_path = write_import_files(tmp, import_rows)
+    return [
+        ("load_json.air.cold", lambda: utils.load_json("air"), cold),
+        ("load_json.air.warm", lambda: utils.load_json("air"), None),
+        ("save_json.air", lambda: utils.save_json("air", utils.load_json("air")), None),
+        ("insert_record.air", lambda: utils.insert_record("air", utils.sample_air_record(region, date)), None),
+        ("search.date", interactive(citizen.search_historical_data, ["1", date]), None),
+        ("search.region", interactive(citizen.search_historical_data, ["2", region]), None),
+        ("search.pollutant", interactive(citizen.search_historical_data, ["3", "PM2.5"]), None),
+        ("search.latest_per_region", interactive(citizen.search_historical_data, ["4"]), None),
+        ("view_current_aqi", interactive(citizen.view_current_aqi, [], {"location": region}), None),
+        ("reports.top_regions", interactive(admin.generate_reports, ["1"]), None),
+        ("reports.monthly_trend", interactive(admin.generate_reports, ["2", region]), None),
+        ("reports.alerts", interactive(admin.generate_reports, ["3"]), None),
+        ("reports.pollutant_peaks", interactive(admin.generate_reports, ["4"]), None),
+        ("reports.percentiles", interactive(admin.generate_reports, ["5"]), None),
+        ("reports.heatmap", interactive(admin.generate_reports, ["6"]), None),
+        ("import.csv", lambda: ingest.import_file(csv_path, progress=None), None),
+        ("import.json", lambda: ingest.import_file(json_path, progress=None), None),
+    ]
+
+
+def revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=utils.BASE_DIR,
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run(regions, days, repeat, only=None, import_rows=10000, seed=42):
+    tmp = tempfile.mkdtemp(prefix="aq-bench-")
+    old_dir = utils.DATA_DIR
+    try:
+        start = time.perf_counter()
+        records = write_dataset(tmp, regions, days, seed)
+        generated = time.perf_counter() - start
+        results = {}
+        for name, fn, setup in cases(tmp, import_rows):
+            if only and not any(name.startswith(o) for o in only):
+                continue
+            results[name] = timed(fn, repeat, setup)
+        return {
+            "meta": {
+                "revision": revision(),
+                "python": platform.python_version(),
+                "backend": utils.BACKEND,
+                "regions": regions,
+                "days": days,
+                "records": records,
+                "air_bytes": stored_bytes(),
+                "import_rows": import_rows,
+                "repeat": repeat,
+                "generate_seconds": generated,
+            },
+            "results": results,
+        }
+    finally:
+        utils.DATA_DIR = old_dir
+        utils._backend = None
+        utils.repo.invalidate()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def startup_cases(data_dir):
+    # Python snippets, each run in a fresh interpreter. "bootstrap" is what
+    # main.py does before showing the menu, against an existing data dir.
+    boot = (f"import utils; utils.DATA_DIR = {data_dir!r}; import main, alerting; "
+            "utils.ensure_sample_data(); alerting.sweep_daily()")
+    return [
+        ("startup.python", "pass"),
+        ("startup.import_main", "import main"),
+        ("startup.import_cli", "import cli"),
+        ("startup.import_admin", "import admin"),
+        ("startup.bootstrap", boot),
+    ]
+
+
+def import_micros(code):
+    # Sum of the top-level cumulative times reported by -X importtime.
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=utils.BASE_DIR,
+                         capture_output=True, text=True, check=True)
+    total = 0
+    for line in out.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit() and not parts[2].startswith("  "):
+            total += int(parts[1])
+    return total
+
+
+def run_startup(repeat):
+    """Wall time of short-lived interpreters importing the entry points."""
+    tmp = tempfile.mkdtemp(prefix="aq-bench-")
+    try:
+        subprocess.run([sys.executable, "-c", startup_cases(tmp)[-1][1]], cwd=utils.BASE_DIR,
+                       capture_output=True, check=True)
+        results = {}
+        for name, code in startup_cases(tmp):
+            res = timed(lambda: subprocess.run([sys.executable, "-c", code], cwd=utils.BASE_DIR, check=True), repeat)
+            res["import_us"] = import_micros(code)
+            results[name] = res
+        return {"meta": {"revision": revision(), "python": platform.python_version(), "repeat": repeat},
+                "results": results}
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def compare(base, new):
+    rows = []
+    for name, res in new["results"].items():
+        old = base.get("results", {}).get(name)
+        ratio = res["median"] / old["median"] if old and old["median"] else None
+        rows.append([name, old and round(old["median"], 6), round(res["median"], 6),
+                     ratio and f"{ratio:.2f}x"])
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the portal's hot paths on synthetic data.")
+    parser.add_argument("--regions", type=int, default=100)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--import-rows", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--only", nargs="*", help="benchmark name prefixes to run, e.g. search reports")
+    parser.add_argument("--out", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="earlier results file to compare medians against")
+    parser.add_argument("--startup", action="store_true",
+                        help="measure interpreter startup and import time of the entry points instead")
+    args = parser.parse_args(argv)
+    if args.startup:
+        result = run_startup(args.repeat)
+    else:
+        result = run(args.regions, args.days, args.repeat, args.only, args.import_rows, args.seed)
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            base = json.load(f)
+        utils.print_table(compare(base, result), headers=["Benchmark", "Before (s)", "After (s)", "Ratio"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
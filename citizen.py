@@ -2,32 +2,58 @@
 from collections import defaultdict
 import datetime
 import utils
+import rollups
+import alerting
+import metrics
+import segments
+import readings
 
 load_json = utils.load_json
 save_json = utils.save_json
+insert_record = utils.insert_record
+update_record = utils.update_record
 find_by_id = utils.find_by_id
 print_table = utils.print_table
+backend = utils.get_backend
 
 
+def id_stem(name):
+    # "Mary-Jane Watson" -> "cit_maryjane"; clashes become cit_maryjane_2, ...
+    first = (name.split() or [""])[0]
+    return "cit_" + ("".join(ch for ch in first.casefold() if ch.isalnum()) or "citizen")
+
+
+def register(name, age="", location="", contact=""):
+    """Store a new citizen under a unique id and return the record."""
+    citizen = {"citizen_id": None, "name": name, "age": age, "location": location, "contact": contact}
+    backend().register_citizen(citizen, id_stem(name))
+    return citizen
+
+
+def lookup(key):
+    # Login accepts a citizen_id or the contact given at registration.
+    key = key.strip()
+    return backend().get("citizens", key) or backend().citizen_by_contact(key) if key else None
+
+
+def in_region(region):
+    """Every citizen registered in region, for fanning out alerts."""
+    return backend().citizens_in_region(region)
+
+
+@metrics.profiled
 def register_citizen():
-    citizens = load_json("citizens")
     print("Register new citizen")
     name = input("Name: ").strip()
     age = input("Age: ").strip()
     location = input("Location / Region: ").strip()
     contact = input("Contact (email/phone): ").strip()
-    n=name.split()
-    nn="cit_"+n[0]
-    citizen = {"citizen_id": nn, "name": name, "age": age, "location": location, "contact": contact}
-    citizens.append(citizen)
-    save_json("citizens", citizens)
+    citizen = register(name, age, location, contact)
     print("Registered. Your Citizen ID:", citizen["citizen_id"])
 
 
 def citizen_login():
-    citizens = load_json("citizens")
-    cid = input("Enter Citizen ID: ").strip()
-    c = find_by_id(citizens, "citizen_id", cid)
+    c = lookup(input("Enter Citizen ID or contact: "))
     if c:
         citizen_menu(c)
     else:
@@ -60,46 +86,64 @@ def citizen_menu(citizen):
             print("Invalid choice.")
 
 
+def active_alerts(region=None, day=None):
+    return alerting.in_force(region, day)
+
+
+@metrics.timed("current_aqi")
+def current_aqi(region):
+    """Latest reading for region and the alerts in force there today, or (None, [])."""
+    r = readings.latest(region)
+    if not r:
+        return None, []
+    return r, active_alerts(region)
+
+
+# Historical search modes: name -> backend query method. "latest" takes no value.
+# Every search also covers sealed months (segments.py).
+SEARCHES = {
+    "date": "records_on_date",
+    "region": "records_for_region",
+    "pollutant": "records_with_pollutant",
+    "latest": "latest_per_region",
+}
+
+
+@metrics.timed("search", records=True)
+def search(by, value=None):
+    if by == "latest":
+        return readings.latest_per_region()
+    query = getattr(backend(), SEARCHES[by])
+    return segments.merge(query(value), segments.SEARCHES[by](value))
+
+
+@metrics.profiled
 def view_current_aqi(citizen):
     region = citizen.get("location","")
-    air = load_json("air")
-    region_records = [r for r in air if r["region"].lower() == region.lower()]
-    if not region_records:
+    r, alerts = current_aqi(region)
+    if not r:
         print(f"No AQI data for region: {region}")
         return
-    region_records.sort(key=lambda r: r["date"], reverse=True)
-    r = region_records[0]
-    print_table([[r["date"], r["region"], r["AQI"], r.get("pollutants",{})]], headers=["Date","Region","AQI","Pollutants"])
-    alerts = load_json("alerts")
+    print_table([[r["date"], r["region"], r["AQI"], r.get("health_risk",""), r.get("pollutants",{})]], headers=["Date","Region","AQI","Health risk","Pollutants"])
     for a in alerts:
-        if a["region"].lower() == region.lower() and a["status"] == "active":
-            print(f"ALERT: {a['AQI_level']} issued on {a['issue_date']} (id {a['alert_id']})")
+        print(f"ALERT: {a['AQI_level']} issued on {a['issue_date']} (id {a['alert_id']})")
 
 
+@metrics.profiled
 def search_historical_data():
-    air = load_json("air")
-    if not air:
+    if not readings.exists():
         print("No air quality data available.")
         return
     print("Search by:1.Date\n2.Region\n3.Pollutant\n4.All Regions (latest AQI per region)\n5.Back")
     ch = input("Choice: ").strip()
-    results = []
     if ch == "1":
-        d = input("Date (YYYY-MM-DD): ").strip()
-        results = [r for r in air if r["date"] == d]
+        results = search("date", input("Date (YYYY-MM-DD): ").strip())
     elif ch == "2":
-        reg = input("Region: ").strip().lower()
-        results = [r for r in air if r["region"].lower() == reg]
+        results = search("region", input("Region: ").strip())
     elif ch == "3":
-        pol = input("Pollutant name (e.g. PM2.5): ").strip()
-        results = [r for r in air if pol in r.get("pollutants",{})]
+        results = search("pollutant", input("Pollutant name (e.g. PM2.5): ").strip())
     elif ch == "4":
-        latest = {}
-        for r in air:
-            key = r["region"]
-            if key not in latest or r["date"] > latest[key]["date"]:
-                latest[key] = r
-        results = list(latest.values())
+        results = search("latest")
     else:
         return
     if not results:
@@ -109,10 +153,19 @@ def search_historical_data():
     print_table(rows, headers=["ID","Date","Region","AQI","Pollutants"])
 
 
+@metrics.profiled
 def view_trends():
-    print("Trend view (text-only). Use Generate Reports to see aggregated stats.")
+    region = input("Region: ").strip()
+    tier = {"1": "daily", "2": "monthly", "3": "yearly"}.get(input("Granularity: 1.Daily 2.Monthly 3.Yearly: ").strip(), "monthly")
+    metric = input("Measure (AQI or pollutant name, blank for AQI): ").strip() or "AQI"
+    rows = rollups.trend(region, tier, metric)
+    if not rows:
+        print("No data for that region.")
+        return
+    print_table(rows, headers=["Period", "Readings", "Min", "Mean", "Max", "P50", "P90", "P99"])
 
 
+@metrics.profiled
 def access_guidelines():
     guides = load_json("guidelines")
     if not guides:
@@ -122,17 +175,20 @@ def access_guidelines():
     print_table(rows, headers=["ID","AQI Range","Precautions"])
 
 
+@metrics.profiled
 def manage_profile(citizen):
-    citizens = load_json("citizens")
-    found = find_by_id(citizens, "citizen_id", citizen["citizen_id"])
+    found = backend().get("citizens", citizen["citizen_id"])
     if not found:
         print("Profile not found.")
         return
+    # the stored record is shared with the cache; edit a copy and write that
+    found = dict(found)
     found["name"] = input(f"Name [{found['name']}]: ").strip() or found["name"]
     age = input(f"Age [{found.get('age','')}]: ").strip()
     if age != "":
         found["age"] = age
     found["location"] = input(f"Location [{found.get('location','')}]: ").strip() or found.get("location")
     found["contact"] = input(f"Contact [{found.get('contact','')}]: ").strip() or found.get("contact")
-    save_json("citizens", citizens)
+    update_record("citizens", found)
+    citizen.update(found)
     print("Profile updated.")
@@ -0,0 +1,275 @@
+import os
+import sys
+import csv
+import json
+import shlex
+import argparse
+import utils
+import admin
+import citizen
+import alerting
+import rollups
+import metrics
+
+
+FORMATS = ("json", "csv")
+
+
+class CommandError(Exception):
+    pass
+
+
+def query_current(args):
+    record, alerts = citizen.current_aqi(args.region)
+    if record is None:
+        raise CommandError(f"no AQI data for region: {args.region}")
+    return {"region": args.region, "record": record, "alerts": alerts}
+
+
+def query_history(args):
+    for by in ("date", "region", "pollutant"):
+        if getattr(args, by):
+            return citizen.search(by, getattr(args, by))
+
+
+def query_latest(args):
+    return citizen.search("latest")
+
+
+def query_guidelines(args):
+    return utils.load_json("guidelines")
+
+
+def report_top_regions(args):
+    return [{"region": r, "avg_aqi": avg, "records": n} for r, avg, n in admin.region_averages()]
+
+
+def report_monthly(args):
+    return [{"month": m, "avg_aqi": avg} for m, avg in admin.monthly_trend(args.region)]
+
+
+def report_alerts(args):
+    return utils.load_json("alerts")
+
+
+def report_peaks(args):
+    return [{"region": region, **peak} for region, peak in admin.pollutant_peaks().items()]
+
+
+def report_percentiles(args):
+    import reports
+    keys = ["measure", "readings", "min", "mean"] + [f"p{p}" for p in reports.PERCENTILES] + ["max"]
+    return [dict(zip(keys, row)) for row in reports.pollutant_table(reports.aggregate(args.workers))]
+
+
+def report_heatmap(args):
+    import reports
+    months, rows = reports.heatmap(reports.aggregate(args.workers))
+    return [dict(zip(["region"] + months, row)) for row in rows]
+
+
+def import_data(args):
+    progress = None if args.quiet else (lambda msg: print(msg, file=sys.stderr))
+    try:
+        return admin.bulk_import(args.path, args.workers, progress, args.dedup)
+    except FileNotFoundError:
+        raise CommandError(f"no data files at: {args.path}") from None
+
+
+def alerts_active(args):
+    return alerting.in_force(args.region, args.date)
+
+
+def alerts_issue(args):
+    return admin.issue_alert(args.region, args.level, args.expiry)
+
+
+def alerts_withdraw(args):
+    alert = admin.withdraw_alert(args.alert_id)
+    if alert is None:
+        raise CommandError(f"no alert with id: {args.alert_id}")
+    return alert
+
+
+def alerts_sweep(args):
+    return {"archived": alerting.sweep(args.date)}
+
+
+def alerts_scan(args):
+    import exceedance
+    return exceedance.run(args.full)
+
+
+def rollup_build(args):
+    return {"regions": rollups.build()}
+
+
+def rollup_age(args):
+    return {"aged": rollups.age_out(args.days)}
+
+
+def rollup_trend(args):
+    keys = ["period"] + rollups.FIELDS
+    return [dict(zip(keys, row)) for row in rollups.trend(args.region, args.tier, args.metric, args.start, args.end)]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Non-interactive access to the portal.")
+    parser.add_argument("--format", choices=FORMATS, default="json", help="output format (default json)")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="collect timings and write them here on exit (.prom for Prometheus, else JSON)")
+    parser.add_argument("--profile", action="store_true",
+                        help="run the command under cProfile and tracemalloc (reports go to profiles/)")
+    # --format is also accepted after the command; left unset there, so the
+    # one before the command (or the default) stands
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument("--format", choices=FORMATS, default=argparse.SUPPRESS, help="output format (default json)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def group(name, help):
+        return sub.add_parser(name, help=help).add_subparsers(dest="action", required=True)
+
+    def leaf(parent, name, func, help=None):
+        p = parent.add_parser(name, help=help, parents=[output])
+        p.set_defaults(func=func)
+        return p
+
+    q = group("query", "citizen lookups")
+    leaf(q, "current", query_current, "latest reading and alerts for a region").add_argument("--region", required=True)
+    p = leaf(q, "history", query_history, "readings by date, region or pollutant")
+    by = p.add_mutually_exclusive_group(required=True)
+    by.add_argument("--date")
+    by.add_argument("--region")
+    by.add_argument("--pollutant")
+    leaf(q, "latest", query_latest, "latest reading per region")
+    leaf(q, "guidelines", query_guidelines, "health guidelines")
+
+    r = group("report", "admin reports")
+    leaf(r, "top-regions", report_top_regions, "average AQI per region, highest first")
+    leaf(r, "monthly", report_monthly, "monthly average AQI for a region").add_argument("--region", required=True)
+    leaf(r, "alerts", report_alerts, "every live alert")
+    leaf(r, "peaks", report_peaks, "peak pollutant levels per region")
+    leaf(r, "percentiles", report_percentiles, "per-pollutant distribution over all readings").add_argument(
+        "--workers", type=int, default=None, help="processes (default: one per CPU)")
+    leaf(r, "heatmap", report_heatmap, "mean AQI per region and month").add_argument(
+        "--workers", type=int, default=None, help="processes (default: one per CPU)")
+
+    p = sub.add_parser("import", help="bulk import a file, directory or glob", parents=[output])
+    p.set_defaults(func=import_data)
+    p.add_argument("path")
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--quiet", action="store_true", help="no progress on stderr")
+    p.add_argument("--dedup", action="store_true", help="skip or update readings already stored")
+
+    a = group("alerts", "alert management")
+    p = leaf(a, "active", alerts_active, "alerts in force")
+    p.add_argument("--region")
+    p.add_argument("--date", help="YYYY-MM-DD (default today)")
+    p = leaf(a, "issue", alerts_issue, "issue an alert")
+    p.add_argument("--region", required=True)
+    p.add_argument("--level", required=True)
+    p.add_argument("--expiry", default="", help="YYYY-MM-DD (default never)")
+    leaf(a, "withdraw", alerts_withdraw, "withdraw an alert").add_argument("alert_id")
+    leaf(a, "sweep", alerts_sweep, "archive expired alerts").add_argument("--date")
+    leaf(a, "scan", alerts_scan, "raise alerts for safe-limit exceedances").add_argument("--full", action="store_true")
+
+    ro = group("rollup", "rollup tiers")
+    leaf(ro, "build", rollup_build, "recompute the tiers")
+    leaf(ro, "age", rollup_age, "fold old raw readings into daily rollups").add_argument("--days", type=int, required=True)
+    p = leaf(ro, "trend", rollup_trend, "one region's rollups")
+    p.add_argument("--region", required=True)
+    p.add_argument("--tier", choices=rollups.TIERS, default="monthly")
+    p.add_argument("--metric", default="AQI")
+    p.add_argument("--start")
+    p.add_argument("--end")
+
+    p = sub.add_parser("batch", help="run one command per line from a file ('-' for stdin)", parents=[output])
+    p.add_argument("file")
+    return parser
+
+
+def write(data, fmt, out):
+    if fmt == "json":
+        out.write(json.dumps(data, default=str) + "\n")
+        return
+    rows = data if isinstance(data, list) else [data]
+    headers = []
+    for row in rows:
+        headers.extend(k for k in row if k not in headers)
+    w = csv.DictWriter(out, fieldnames=headers, lineterminator="\n")
+    w.writeheader()
+    for row in rows:
+        w.writerow({k: json.dumps(v, default=str) if isinstance(v, (dict, list)) else v for k, v in row.items()})
+
+
+def execute(args, out=None):
+    try:
+        data = args.func(args)
+    except (CommandError, ValueError, OSError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    write(data, args.format, out or sys.stdout)
+    return 0
+
+
+def run_batch(parser, lines, fmt, out=None):
+    """Run each non-blank, non-comment line as a command in this process.
+
+    Datasets are loaded once and stay cached across lines. A line without
+    its own --format (before or after the command) uses the batch's.
+    Returns 1 if any line failed.
+    """
+    status = 0
+    for n, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            argv = shlex.split(line)
+            if "--format" not in argv:
+                argv = ["--format", fmt] + argv
+            args = parser.parse_args(argv)
+        except (ValueError, SystemExit):
+            print(f"error: line {n}: cannot run {line!r}", file=sys.stderr)
+            status = 1
+            continue
+        if args.command == "batch":
+            print(f"error: line {n}: batches do not nest", file=sys.stderr)
+            status = 1
+            continue
+        status = execute(args, out) or status
+    return status
+
+
+def dispatch(parser, args):
+    if args.command != "batch":
+        return execute(args)
+    if args.file == "-":
+        return run_batch(parser, sys.stdin, args.format)
+    with open(args.file, "r", encoding="utf-8") as f:
+        return run_batch(parser, f, args.format)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    utils.ensure_data_dir()
+    if args.metrics:
+        metrics.enable()
+    try:
+        if args.profile:
+            with metrics.capture("-".join(filter(None, [args.command, getattr(args, "action", None)]))):
+                return dispatch(parser, args)
+        return dispatch(parser, args)
+    except BrokenPipeError:
+        # The reader went away (e.g. `| head`): stop quietly, with stdout on
+        # /dev/null so the interpreter's final flush does not fail as well.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        if args.metrics:
+            metrics.write(args.metrics)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+from utils import safe_float
+
+
+class _Dictionary:
+    # Dictionary encoding: value <-> dense integer code, in first-seen order.
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class AirColumns:
+    """Column-oriented copy of the air records backed by NumPy arrays.
+
+    Region and date are dictionary-encoded, AQI is int16 and every pollutant
+    gets a float32 column with NaN where a record has no reading. Deleted rows
+    are only masked out; the arrays are packed again when the view is rebuilt.
+    """
+
+    def __init__(self, records=(), pollutants=()):
+        self.regions = _Dictionary()
+        self.dates = _Dictionary()
+        self.row_of = {}
+        self.size = 0
+        records = list(records)
+        cap = max(16, len(records))
+        self.region = np.zeros(cap, dtype=np.int32)
+        self.date = np.zeros(cap, dtype=np.int32)
+        self.aqi = np.zeros(cap, dtype=np.int16)
+        self.valid = np.zeros(cap, dtype=bool)
+        self.pollutants = {}
+        for name in pollutants:
+            self._column(name)
+        for rec in records:
+            self.put(rec)
+
+    def __len__(self):
+        return len(self.row_of)
+
+    def _column(self, name):
+        col = self.pollutants.get(name)
+        if col is None:
+            col = self.pollutants[name] = np.full(len(self.valid), np.nan, dtype=np.float32)
+        return col
+
+    def _grow(self):
+        cap = len(self.valid) * 2
+        for attr in ("region", "date", "aqi", "valid"):
+            old = getattr(self, attr)
+            new = np.zeros(cap, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, attr, new)
+        for name, old in self.pollutants.items():
+            new = np.full(cap, np.nan, dtype=np.float32)
+            new[:len(old)] = old
+            self.pollutants[name] = new
+
+    def put(self, rec):
+        rid = rec.get("record_id")
+        row = self.row_of.get(rid)
+        if row is None:
+            if self.size == len(self.valid):
+                self._grow()
+            row = self.row_of[rid] = self.size
+            self.size += 1
+        self.region[row] = self.regions.encode(str(rec.get("region", "")))
+        self.date[row] = self.dates.encode(str(rec.get("date", "")))
+        self.aqi[row] = max(-32768, min(32767, int(safe_float(rec.get("AQI", 0)))))
+        self.valid[row] = True
+        for col in self.pollutants.values():
+            col[row] = np.nan
+        for name, val in (rec.get("pollutants") or {}).items():
+            try:
+                self._column(name)[row] = float(val)
+            except (TypeError, ValueError):
+                pass
+
+    def delete(self, rid):
+        row = self.row_of.pop(rid, None)
+        if row is not None:
+            self.valid[row] = False
+
+    def _live(self):
+        return np.flatnonzero(self.valid[:self.size])
+
+    def pollutant_max_by_region(self):
+        """{region: {pollutant: max level}}, skipping missing readings."""
+        rows = self._live()
+        codes = self.region[rows]
+        n = len(self.regions.values)
+        present = np.bincount(codes, minlength=n) > 0
+        out = {self.regions.values[c]: {} for c in np.flatnonzero(present)}
+        for name, col in self.pollutants.items():
+            peak = np.full(n, -np.inf, dtype=np.float64)
+            np.fmax.at(peak, codes, col[rows])
+            for c in np.flatnonzero(present & np.isfinite(peak)):
+                # shortest float32 repr, so 138.3 reads back as 138.3
+                out[self.regions.values[c]][name] = float(str(np.float32(peak[c])))
+        return out
@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import datetime
+import utils
+import storage
+import columnar
+import alerting
+from indexes import region_key
+
+np = columnar.np
+
+SCAN_FILE = "exceedance_scan.json"
+ALERT_LEVEL = "Safe limit exceeded"
+
+
+def scan_path():
+    return os.path.join(utils.DATA_DIR, SCAN_FILE)
+
+
+def read_state():
+    try:
+        with open(scan_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_state(state):
+    storage.atomic_write(scan_path(), json.dumps(state, separators=(",", ":")))
+
+
+def limits():
+    """{pollutant name: safe limit} for every pollutant with a numeric limit."""
+    out = {}
+    for p in utils.load_json("pollutants"):
+        limit = utils.safe_float(p.get("safe_limit"), None)
+        if p.get("name") and limit is not None:
+            out[p["name"]] = limit
+    return out
+
+
+def _add(found, region, date, name, value):
+    if not region or not date:
+        return
+    hit = found.setdefault((region_key(region), date), {"region": region, "exceeded": {}})
+    if value > hit["exceeded"].get(name, float("-inf")):
+        hit["exceeded"][name] = value
+
+
+def _scan_columns(cols, rows, limit_of, found):
+    # One vectorized comparison per pollutant over the given rows; only the
+    # rows that exceed are looked at individually.
+    for name, limit in limit_of.items():
+        col = cols.pollutants.get(name)
+        if col is None:
+            continue
+        hits = rows[col[rows] > np.float32(limit)]
+        for row in hits:
+            _add(found, cols.regions.values[cols.region[row]], cols.dates.values[cols.date[row]],
+                 name, float(str(col[row])))
+
+
+def _column_rows(records, everything):
+    # (AirColumns, rows holding records) on the JSON backend, or None. An
+    # incremental scan uses the columns only if air is in memory already:
+    # loading all of it for a few new records would cost more than it saves.
+    if utils.get_backend().name != "json" or (not everything and utils.repo.peek("air") is None):
+        return None
+    cols = utils.air_columns()
+    if cols is None:
+        return None
+    if everything:
+        return (cols, cols._live()) if len(cols) == len(records) else None
+    try:
+        rows = np.fromiter((cols.row_of[r.get("record_id")] for r in records), dtype=np.int64, count=len(records))
+    except KeyError:
+        return None
+    return cols, rows
+
+
+def _scan_matrix(records, limit_of, found):
+    # Readings x pollutants matrix compared against the limit vector at once;
+    # the matrix itself is filled one record at a time.
+    names = list(limit_of)
+    values = np.array([[utils.safe_float((r.get("pollutants") or {}).get(n), np.nan) for n in names]
+                       for r in records], dtype=np.float64).reshape(len(records), len(names))
+    rows, cols = np.nonzero(values > np.array([limit_of[n] for n in names]))
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        _add(found, records[i].get("region"), records[i].get("date"), names[j], float(values[i, j]))
+
+
+def _scan_loop(records, limit_of, found):
+    for r in records:
+        for name, val in (r.get("pollutants") or {}).items():
+            val = utils.safe_float(val, None)
+            if name in limit_of and val is not None and val > limit_of[name]:
+                _add(found, r.get("region"), r.get("date"), name, val)
+
+
+def scan(records, limit_of=None, everything=False):
+    """{(region key, date): {"region", "exceeded": {pollutant: worst value}}}.
+
+    Covers every region and date where at least one reading is above its
+    pollutant's safe limit. everything=True says records is the whole air
+    dataset. On the JSON backend records are scanned from the air columns
+    (columnar.AirColumns): always for everything, and for new records when
+    air is in memory. Otherwise (SQLite, or a cold incremental scan) they
+    are copied into a matrix record by record and only the comparison is
+    vectorized.
+    """
+    limit_of = limits() if limit_of is None else limit_of
+    records = list(records)
+    found = {}
+    if not records or not limit_of:
+        return found
+    if np is None:
+        _scan_loop(records, limit_of, found)
+        return found
+    columns = _column_rows(records, everything)
+    if columns is not None:
+        _scan_columns(*columns, limit_of, found)
+    else:
+        _scan_matrix(records, limit_of, found)
+    return found
+
+
+def alert_id(fold, date):
+    # Derived from the region and date, so a rescan finds the same alert
+    # instead of issuing a second one.
+    return "auto_" + hashlib.sha1(f"{fold}|{date}".encode("utf-8")).hexdigest()[:12]
+
+
+def _expiry(date):
+    try:
+        return (datetime.date.fromisoformat(date) + datetime.timedelta(days=1)).isoformat()
+    except ValueError:
+        return ""
+
+
+def apply(found, today=None):
+    """Issue or refresh one automatic alert per (region, date). Returns (issued, refreshed).
+
+    Dates whose alert would already have expired by today are skipped: the
+    alert would only be swept into the archive.
+    """
+    today = today or alerting.today()
+    backend = utils.get_backend()
+    writes = []
+    issued = 0
+    for (fold, date), hit in found.items():
+        expiry = _expiry(date)
+        if expiry < today:
+            continue
+        aid = alert_id(fold, date)
+        old = backend.get("alerts", aid)
+        if old is None:
+            issued += 1
+            writes.append({"alert_id": aid, "region": hit["region"], "AQI_level": ALERT_LEVEL,
+                           "status": "active", "issue_date": date, "expiry_date": expiry,
+                           "source": "auto", "exceeded": hit["exceeded"]})
+            continue
+        # Keep the worst level seen and whatever status an admin set.
+        exceeded = dict(old.get("exceeded") or {})
+        for name, val in hit["exceeded"].items():
+            if val > exceeded.get(name, float("-inf")):
+                exceeded[name] = val
+        if exceeded != old.get("exceeded"):
+            writes.append(dict(old, exceeded=exceeded))
+    if writes:
+        utils.insert_records("alerts", writes)
+    return issued, len(writes) - issued
+
+
+def run(full=False):
+    """Scan the air records written since the last run (all of them if full).
+
+    The watermark is the backend's tail mark (see JsonBackend.tail), so only
+    the new end of the log or table is read. If it no longer applies, or the
+    limits changed, everything is rescanned, which is safe because alerts
+    are deduplicated.
+    """
+    utils.ensure_data_dir()
+    limit_of = limits()
+    state = read_state()
+    mark = state.get("mark") if not full and state.get("limits") == limit_of else None
+    records, everything, mark = utils.get_backend().tail("air", mark)
+    found = scan(records, limit_of, everything)
+    issued, refreshed = apply(found)
+    write_state({"mark": mark, "limits": limit_of})
+    return {"scanned": len(records), "exceedances": len(found), "issued": issued, "refreshed": refreshed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Raise alerts for readings above their pollutant's safe limit.")
+    parser.add_argument("--full", action="store_true", help="rescan every record, not just new ones")
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.full)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+import re
+import math
+import sys
+import json
+import argparse
+from bisect import bisect_right
+import utils
+
+# "101-200", "0 - 50", "301+" / "301-500"; the upper bound is optional.
+RANGE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*(?:[-–]\s*(\d+(?:\.\d+)?)|\+)?\s*$")
+
+
+def risk_label(guide):
+    # "Unhealthy: Sensitive groups should..." -> "Unhealthy"
+    text = str(guide.get("precautions") or "")
+    head = text.split(":", 1)[0].strip()
+    return head if ":" in text and head else str(guide.get("AQI_range") or "")
+
+
+class Classifier:
+    """AQI -> health risk, from the guideline ranges parsed once.
+
+    The lower bounds of the ranges are kept as a sorted breakpoint array; a
+    value belongs to the last range starting at or below it, so gaps between
+    ranges (100 < AQI < 101) fall into the lower one and values past the top
+    range take the most severe label. Values below the first range, and
+    non-numeric AQI, get "".
+    """
+
+    def __init__(self, guidelines=()):
+        ranges = []
+        for g in guidelines:
+            m = RANGE.match(str(g.get("AQI_range") or ""))
+            if m:
+                ranges.append((float(m.group(1)), risk_label(g)))
+        ranges.sort(key=lambda r: r[0])
+        self.starts = [lo for lo, _ in ranges]
+        self.labels = [label for _, label in ranges]
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    def classify(self, aqi):
+        value = utils.safe_float(aqi, None)
+        if value is None or math.isnan(value):
+            return ""
+        i = bisect_right(self.starts, value) - 1
+        return self.labels[i] if i >= 0 else ""
+
+    def classify_many(self, values):
+        """Labels for a sequence (or NumPy array) of AQI values."""
+        # NumPy is only loaded here, so classifying one value stays cheap
+        from columnar import np
+        if np is None:
+            return [self.classify(v) for v in values]
+        values = np.asarray(values, dtype=np.float64)
+        idx = np.searchsorted(np.asarray(self.starts, dtype=np.float64), values, side="right") - 1
+        labels = [""] + self.labels
+        # index 0 of `labels` is "" for values below the first range and NaN
+        idx = np.where(np.isnan(values), -1, idx) + 1
+        return [labels[i] for i in idx.tolist()]
+
+
+_cached = None
+
+
+def classifier():
+    # Rebuilt only when the guidelines change.
+    global _cached
+    version = (utils.DATA_DIR, utils.BACKEND, str(utils.get_backend().version("guidelines")))
+    if _cached is None or _cached[0] != version:
+        _cached = (version, Classifier(utils.load_json("guidelines")))
+    return _cached[1]
+
+
+def classify(aqi):
+    return classifier().classify(aqi)
+
+
+def labels(records):
+    """Health risk for each record's AQI, or None without usable guidelines."""
+    c = classifier()
+    if not c:
+        return None
+    return c.classify_many([utils.safe_float(r.get("AQI"), math.nan) for r in records])
+
+
+def fill(records):
+    # Classify new records in place before they are written. Without
+    # guidelines whatever health_risk they came with is kept.
+    records = list(records)
+    for rec, label in zip(records, labels(records) or ()):
+        rec["health_risk"] = label
+    return records
+
+
+def backfill(batch_size=50000):
+    """Classify every stored air record; returns how many were updated."""
+    utils.ensure_data_dir()
+    air = utils.load_json("air")
+    # loaded records are shared with the cache, so write changed copies
+    changed = [dict(rec, health_risk=label) for rec, label in zip(air, labels(air) or ())
+               if rec.get("health_risk") != label]
+    for i in range(0, len(changed), batch_size):
+        utils.insert_records("air", changed[i:i + batch_size])
+    return len(changed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Health-risk classification of air records.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("backfill", help="fill health_risk on all stored records from the guidelines")
+    p = sub.add_parser("classify", help="print the health risk for AQI values")
+    p.add_argument("aqi", nargs="+")
+    args = parser.parse_args(argv)
+    if args.command == "backfill":
+        print(json.dumps({"updated": backfill()}))
+    else:
+        for aqi, label in zip(args.aqi, classifier().classify_many([utils.safe_float(a, math.nan) for a in args.aqi])):
+            print(f"{aqi}\t{label}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
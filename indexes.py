@@ -0,0 +1,418 @@
+import datetime
+from bisect import bisect_left, bisect_right, insort
+
+
+def region_key(region):
+    return str(region or "").casefold()
+
+
+class AirIndex:
+    """Secondary indexes over air records, kept in step with every write.
+
+    Region and date lists hold (date, seq, record_id) tuples in sorted order,
+    where seq is the record's insertion order, so ties on date keep the order
+    records had in the file.
+    """
+
+    def __init__(self, records=()):
+        self.by_id = {}
+        self._keys = {}
+        self._seq = 0
+        self.by_region = {}
+        self.dates = []
+        self.by_pollutant = {}
+        dupes = []
+        for rec in records:
+            if rec.get("record_id") in self._keys:
+                dupes.append(rec)
+            else:
+                self._add(rec, sort=False)
+        self.dates.sort()
+        for lst in self.by_region.values():
+            lst.sort()
+        for rec in dupes:
+            self.put(rec)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def _add(self, rec, seq=None, sort=True):
+        rid = rec.get("record_id")
+        if seq is None:
+            seq = self._seq
+            self._seq += 1
+        region = region_key(rec.get("region"))
+        entry = (str(rec.get("date", "")), seq, rid)
+        names = tuple(rec.get("pollutants") or {})
+        self.by_id[rid] = rec
+        self._keys[rid] = (region, entry, names)
+        lst = self.by_region.setdefault(region, [])
+        if sort:
+            insort(lst, entry)
+            insort(self.dates, entry)
+        else:
+            lst.append(entry)
+            self.dates.append(entry)
+        for name in names:
+            ids = self.by_pollutant.setdefault(name, [])
+            if sort:
+                insort(ids, (seq, rid))
+            else:
+                ids.append((seq, rid))
+
+    def _remove(self, rid):
+        keys = self._keys.pop(rid, None)
+        if keys is None:
+            return None
+        region, entry, names = keys
+        del self.by_id[rid]
+        lst = self.by_region[region]
+        del lst[bisect_left(lst, entry)]
+        if not lst:
+            del self.by_region[region]
+        del self.dates[bisect_left(self.dates, entry)]
+        for name in names:
+            ids = self.by_pollutant[name]
+            del ids[bisect_left(ids, (entry[1],))]
+            if not ids:
+                del self.by_pollutant[name]
+        return entry[1]
+
+    def put(self, rec):
+        seq = self._remove(rec.get("record_id"))
+        self._add(rec, seq)
+
+    def delete(self, rid):
+        self._remove(rid)
+
+    def get(self, rid):
+        return self.by_id.get(rid)
+
+    def _records(self, entries):
+        return [self.by_id[e[2]] for e in entries]
+
+    def region(self, region):
+        return self._records(self.by_region.get(region_key(region), []))
+
+    def latest(self, region):
+        lst = self.by_region.get(region_key(region))
+        if not lst:
+            return None
+        # first record (in file order) carrying the most recent date
+        return self.by_id[lst[bisect_left(lst, (lst[-1][0],))][2]]
+
+    def latest_per_region(self):
+        return [self.latest(region) for region in self.by_region]
+
+    def date_range(self, start, end):
+        lo = bisect_left(self.dates, (start,))
+        hi = bisect_right(self.dates, (end, float("inf")))
+        return self._records(self.dates[lo:hi])
+
+    def on_date(self, date):
+        return self.date_range(date, date)
+
+    def with_pollutant(self, name):
+        return [self.by_id[rid] for _, rid in self.by_pollutant.get(name, [])]
+
+
+# Alerts with a blank or unparseable expiry date never expire.
+OPEN_ENDED = "9999-12-31"
+
+
+def alert_day(value):
+    """value as a canonical YYYY-MM-DD string, or None if it is not a date."""
+    try:
+        return datetime.datetime.strptime(str(value or "").strip(), "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        return None
+
+
+def alert_interval(rec):
+    # (first day, last day) an alert is in force; a missing issue date
+    # counts as always having been issued.
+    return alert_day(rec.get("issue_date")) or "", alert_day(rec.get("expiry_date")) or OPEN_ENDED
+
+
+class _Node:
+    __slots__ = ("center", "by_start", "by_end", "left", "right")
+
+
+def _build(intervals):
+    # Centered interval tree over (start, end, seq, id) tuples: each node keeps
+    # the intervals that contain its center, sorted by start and by end, and
+    # the rest go left or right. The center is the median endpoint, so the
+    # depth stays logarithmic.
+    if not intervals:
+        return None
+    points = sorted(p for iv in intervals for p in iv[:2])
+    node = _Node()
+    node.center = points[len(points) // 2]
+    here, left, right = [], [], []
+    for iv in intervals:
+        if iv[1] < node.center:
+            left.append(iv)
+        elif iv[0] > node.center:
+            right.append(iv)
+        else:
+            here.append(iv)
+    node.by_start = sorted(here)
+    node.by_end = sorted(here, key=lambda iv: iv[1], reverse=True)
+    node.left = _build(left)
+    node.right = _build(right)
+    return node
+
+
+def _stab(node, day):
+    out = []
+    while node is not None:
+        if day < node.center:
+            for iv in node.by_start:
+                if iv[0] > day:
+                    break
+                out.append(iv)
+            node = node.left
+        elif day > node.center:
+            for iv in node.by_end:
+                if iv[1] < day:
+                    break
+                out.append(iv)
+            node = node.right
+        else:
+            out.extend(node.by_start)
+            break
+    return out
+
+
+class AlertIndex:
+    """Active alerts by region as interval trees over issue..expiry dates.
+
+    "Which alerts are in force in region R on day D" walks one tree, so it is
+    O(log n + matches). A write only marks its region's tree stale; the tree
+    is rebuilt on the next lookup there. Expiry dates of every alert, active
+    or not, are also kept sorted for the archive sweep.
+    """
+
+    def __init__(self, records=()):
+        self.by_id = {}
+        self._keys = {}
+        self._seq = 0
+        self.regions = {}
+        self.trees = {}
+        self.stale = set()
+        self.expiries = []
+        dupes = []
+        for rec in records:
+            if rec.get("alert_id") in self._keys:
+                dupes.append(rec)
+            else:
+                self._add(rec, sort=False)
+        self.expiries.sort()
+        for rec in dupes:
+            self.put(rec)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def _add(self, rec, seq=None, sort=True):
+        aid = rec.get("alert_id")
+        if seq is None:
+            seq = self._seq
+            self._seq += 1
+        fold = region_key(rec.get("region"))
+        start, end = alert_interval(rec)
+        active = rec.get("status") == "active" and start <= end
+        self.by_id[aid] = rec
+        self._keys[aid] = (fold, start, end, seq, active)
+        if active:
+            self.regions.setdefault(fold, {})[seq] = (start, end, seq, aid)
+            self.stale.add(fold)
+        if end != OPEN_ENDED:
+            if sort:
+                insort(self.expiries, (end, seq, aid))
+            else:
+                self.expiries.append((end, seq, aid))
+
+    def _remove(self, aid):
+        keys = self._keys.pop(aid, None)
+        if keys is None:
+            return None
+        fold, start, end, seq, active = keys
+        del self.by_id[aid]
+        if active:
+            del self.regions[fold][seq]
+            if not self.regions[fold]:
+                del self.regions[fold]
+            self.stale.add(fold)
+        if end != OPEN_ENDED:
+            del self.expiries[bisect_left(self.expiries, (end, seq, aid))]
+        return seq
+
+    def put(self, rec):
+        seq = self._remove(rec.get("alert_id"))
+        self._add(rec, seq)
+
+    def delete(self, aid):
+        self._remove(aid)
+
+    def get(self, aid):
+        return self.by_id.get(aid)
+
+    def _tree(self, fold):
+        if fold in self.stale:
+            self.trees[fold] = _build(list(self.regions.get(fold, {}).values()))
+            self.stale.discard(fold)
+        return self.trees.get(fold)
+
+    def in_force(self, day, region=None):
+        """Active alerts covering day, for one region or all, by issue date."""
+        folds = list(self.regions) if region is None else [region_key(region)]
+        hits = []
+        for fold in folds:
+            hits.extend(_stab(self._tree(fold), day))
+        hits.sort(key=lambda iv: (iv[0], iv[2]))
+        return [self.by_id[iv[3]] for iv in hits]
+
+    def expired(self, before):
+        """Every alert whose expiry date is earlier than before."""
+        return [self.by_id[aid] for _, _, aid in self.expiries[:bisect_left(self.expiries, (before,))]]
+
+
+def contact_key(contact):
+    return str(contact or "").strip().casefold()
+
+
+def _add_member(groups, key, member):
+    groups.setdefault(key, {})[member] = None
+
+
+def _drop_member(groups, key, member):
+    members = groups.get(key)
+    if members is not None:
+        members.pop(member, None)
+        if not members:
+            del groups[key]
+
+
+class CitizenIndex:
+    """Citizens by id, by contact and by region, each a dict lookup.
+
+    Ids are also indexed case-insensitively, so allocate() never hands out an
+    id that differs from an existing one only in case. Members of a contact
+    or region keep registration order.
+    """
+
+    def __init__(self, records=()):
+        self.by_id = {}
+        self.by_fold = {}
+        self.by_contact = {}
+        self.by_region = {}
+        self._next = {}
+        for rec in records:
+            self.put(rec)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def _groups(self):
+        return ((self.by_contact, "contact", contact_key), (self.by_region, "location", region_key))
+
+    def _remove(self, cid):
+        rec = self.by_id.pop(cid, None)
+        if rec is None:
+            return
+        _drop_member(self.by_fold, str(cid).casefold(), cid)
+        for groups, field, key in self._groups():
+            _drop_member(groups, key(rec.get(field)), cid)
+
+    def put(self, rec):
+        cid = rec.get("citizen_id")
+        old = self.by_id.get(cid)
+        self.by_id[cid] = rec
+        if old is None:
+            _add_member(self.by_fold, str(cid).casefold(), cid)
+        for groups, field, key in self._groups():
+            new = key(rec.get(field))
+            if old is not None:
+                if key(old.get(field)) == new:
+                    continue  # keeps the citizen's place in the group
+                _drop_member(groups, key(old.get(field)), cid)
+            if new or groups is self.by_region:
+                _add_member(groups, new, cid)
+
+    def delete(self, cid):
+        self._remove(cid)
+
+    def get(self, cid):
+        """The citizen with id cid, matched case-insensitively if no id is
+        exactly cid."""
+        rec = self.by_id.get(cid)
+        if rec is None:
+            for match in self.by_fold.get(str(cid).casefold(), ()):
+                return self.by_id[match]
+        return rec
+
+    def with_contact(self, contact):
+        """The earliest registered citizen with this contact, or None."""
+        for cid in self.by_contact.get(contact_key(contact), ()):
+            return self.by_id[cid]
+        return None
+
+    def in_region(self, region):
+        return [self.by_id[cid] for cid in self.by_region.get(region_key(region), ())]
+
+    def allocate(self, stem):
+        """stem if it is free, else the first free stem_2, stem_3, ..."""
+        if stem.casefold() not in self.by_fold:
+            return stem
+        n = self._next.get(stem, 2)
+        while f"{stem}_{n}".casefold() in self.by_fold:
+            n += 1
+        # remembered so a run of namesakes does not rescan from _2
+        self._next[stem] = n + 1
+        return f"{stem}_{n}"
+
+
+def natural_key(rec):
+    """(region, date, station) of an air reading: what makes two rows the same
+    reading, whatever their record_id. Region and station are case-folded."""
+    return (region_key(rec.get("region")), str(rec.get("date", "")),
+            str(rec.get("station") or "").strip().casefold())
+
+
+class NaturalKeyIndex:
+    """Air record ids by natural_key(), for deduplicating imports.
+
+    Records imported before deduplication existed can share a key; first()
+    returns the earliest of them.
+    """
+
+    def __init__(self, records=()):
+        self.by_key = {}
+        self._key_of = {}
+        for rec in records:
+            self.put(rec)
+
+    def __len__(self):
+        return len(self._key_of)
+
+    def put(self, rec):
+        rid = rec.get("record_id")
+        key = natural_key(rec)
+        old = self._key_of.get(rid)
+        if old == key:
+            return
+        if old is not None:
+            _drop_member(self.by_key, old, rid)
+        self._key_of[rid] = key
+        _add_member(self.by_key, key, rid)
+
+    def delete(self, rid):
+        key = self._key_of.pop(rid, None)
+        if key is not None:
+            _drop_member(self.by_key, key, rid)
+
+    def first(self, key):
+        for rid in self.by_key.get(key, ()):
+            return rid
+        return None
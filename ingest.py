@@ -0,0 +1,414 @@
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import hashlib
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import utils
+import storage
+import health
+import metrics
+import segments
+from indexes import natural_key
+
+safe_float = utils.safe_float
+
+BATCH_SIZE = 5000
+CHUNK_SIZE = 1 << 16
+EXTENSIONS = (".csv", ".json", ".jsonl", ".ndjson")
+
+# Fields left out of content_hash(): the natural key, the id and the derived
+# health risk.
+IDENTITY = ("record_id", "region", "date", "station", "health_risk")
+# What an update keeps from the stored reading.
+KEY_FIELDS = ("record_id", "region", "date", "station")
+
+
+def iter_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            yield row
+
+
+def iter_json_lines(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def iter_json_array(path):
+    # Decode one element at a time from a top-level JSON array, reading the
+    # file in fixed-size chunks so memory stays bounded by the largest record.
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = ""
+        pos = 0
+        started = False
+        eof = False
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or (started and buf[pos] == ",")):
+                pos += 1
+            if pos < len(buf):
+                if not started:
+                    if buf[pos] != "[":
+                        raise ValueError("JSON must be a list of records.")
+                    started = True
+                    pos += 1
+                    continue
+                if buf[pos] == "]":
+                    return
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                else:
+                    yield obj
+                    pos = end
+                    continue
+            elif eof:
+                if started:
+                    raise ValueError("Unterminated JSON array.")
+                return
+            chunk = f.read(CHUNK_SIZE)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+
+
+def iter_rows(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return iter_csv(path)
+    if ext in (".jsonl", ".ndjson"):
+        return iter_json_lines(path)
+    if ext == ".json":
+        with open(path, "r", encoding="utf-8") as f:
+            head = f.read(CHUNK_SIZE).lstrip()
+        if head.startswith("{"):
+            return iter_json_lines(path)
+        return iter_json_array(path)
+    raise ValueError("Unsupported file type. Use .json, .jsonl or .csv")
+
+
+def normalize(row, pollutant_names, record_id, own_ids=True):
+    """Turn one CSV row or JSON object into an air record, or None if invalid.
+
+    A row's own record_id is kept only with own_ids; otherwise, and when it
+    has none, the record gets record_id.
+    """
+    if not isinstance(row, dict):
+        return None
+    region = str(row.get("region") or "").strip()
+    date = str(row.get("date") or "").strip() or str(datetime.date.today())
+    station = str(row.get("station") or "").strip()
+    if not region:
+        return None
+    try:
+        datetime.datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        return None
+    levels = {}
+    nested = row.get("pollutants")
+    if isinstance(nested, dict):
+        for name, val in nested.items():
+            if val is not None and val != "":
+                levels[name] = safe_float(val)
+    for name in pollutant_names:
+        if row.get(name) not in (None, ""):
+            levels[name] = safe_float(row[name])
+    rec = {
+        "record_id": (row.get("record_id") if own_ids else None) or record_id,
+        "region": region,
+        "date": date,
+        "AQI": int(safe_float(row.get("AQI", 0))),
+        "pollutants": levels,
+        "health_risk": row.get("health_risk", "") or "",
+    }
+    if station:
+        rec["station"] = station
+    return rec
+
+
+def content_hash(rec):
+    body = {k: v for k, v in rec.items() if k not in IDENTITY}
+    return hashlib.sha1(json.dumps(body, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def stored_readings(keys):
+    """{natural key: stored record} for keys already in the live store or a
+    sealed month; each lookup is a hash probe or an index seek."""
+    keys = list(keys)
+    found = utils.get_backend().air_by_natural_key(keys)
+    sealed = None
+    for key in keys:
+        if key in found or segments.ordinal(key[1]) is None:
+            continue
+        if sealed is None:
+            sealed = {seg.month: seg for seg in segments.catalog()}
+        seg = sealed.get(key[1][:7])
+        for rec in seg.for_region(key[0], key[1], key[1]) if seg else ():
+            if natural_key(rec) == key:
+                found[key] = rec
+                break
+    return found
+
+
+def dedupe(records, counts):
+    """The records that need writing, matched to stored ones by natural key.
+
+    Only the last row for a key counts; the ones before it are skipped. An
+    exact duplicate of a stored reading (same content_hash) is dropped; a
+    changed one is written under the stored record_id, region, date and
+    station, so it updates that reading in place; the rest are new. Adds
+    every row to one of counts' "inserted", "updated" and "skipped".
+    """
+    last = {}
+    for rec in records:
+        key = natural_key(rec)
+        last.pop(key, None)
+        last[key] = rec
+    counts["skipped"] += len(records) - len(last)
+    current = stored_readings(last)
+    writes = []
+    for key, rec in last.items():
+        old = current.get(key)
+        if old is None:
+            counts["inserted"] += 1
+        elif content_hash(old) == content_hash(rec):
+            counts["skipped"] += 1
+            continue
+        else:
+            rec = dict(rec)
+            for field in KEY_FIELDS:
+                if field in old:
+                    rec[field] = old[field]
+                else:
+                    rec.pop(field, None)
+            counts["updated"] += 1
+        writes.append(rec)
+    return writes
+
+
+def _counts():
+    return {"inserted": 0, "updated": 0, "skipped": 0}
+
+
+def import_key(path):
+    st = os.stat(path)
+    raw = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+
+def row_record_id(key, n):
+    return "rec_" + hashlib.sha1(f"{key}:{n}".encode("utf-8")).hexdigest()[:12]
+
+
+def checkpoint_path(key):
+    return os.path.join(utils.DATA_DIR, f".import-{key}.json")
+
+
+def read_checkpoint(key):
+    try:
+        with open(checkpoint_path(key), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_checkpoint(key, state):
+    storage.atomic_write(checkpoint_path(key), json.dumps(state))
+
+
+def _write(records, counts=None):
+    # Commit one batch; with counts, deduplicated against the stored readings
+    # under the air lock, so concurrent imports cannot both insert a reading.
+    if counts is None:
+        utils.insert_records("air", health.fill(records), compact=False)
+        return len(records)
+    with utils.get_store("air").locked():
+        records = dedupe(records, counts)
+        utils.insert_records("air", health.fill(records), compact=False)
+    return len(records)
+
+
+@metrics.timed("import_file")
+def import_file(path, batch_size=BATCH_SIZE, progress=print, dedup=False):
+    """Stream path into the air dataset in batches; returns a stats dict.
+
+    Each committed batch is recorded in a checkpoint next to the data, so an
+    interrupted import of the same (unchanged) file resumes after the last
+    committed batch. Rows without a record_id get one derived from the file
+    and row number, which makes re-committing a batch after a crash an upsert
+    rather than a duplicate.
+
+    With dedup=True rows are matched to stored readings by natural key (see
+    dedupe()), so importing the same export twice changes nothing; the
+    rows' own record_ids are ignored, and the stats also count rows
+    inserted, updated and skipped.
+    """
+    utils.ensure_data_dir()
+    key = import_key(path)
+    state = read_checkpoint(key) or {"path": path, "rows": 0, "imported": 0, "rejected": 0}
+    counts = state.setdefault("dedup", _counts()) if dedup else None
+    skip = state["rows"]
+    if skip and progress:
+        progress(f"Resuming import after row {skip}.")
+    pollutant_names = [p.get("name") for p in utils.load_json("pollutants")]
+    if not dedup:
+        # keep the air dataset out of memory for the duration of the import;
+        # deduplicating needs its natural-key index instead
+        utils.repo.invalidate("air")
+    start = time.time()
+    seen = 0
+    batch = []
+
+    def commit():
+        written = _write(batch, counts)
+        state["rows"] = skip + seen
+        state["imported"] += written
+        write_checkpoint(key, state)
+        batch.clear()
+        if progress:
+            rate = seen / max(time.time() - start, 1e-9)
+            progress(f"  {state['rows']} rows read, {state['imported']} imported ({rate:.0f} rows/s)")
+
+    for n, row in enumerate(iter_rows(path)):
+        if n < skip:
+            continue
+        seen += 1
+        rec = normalize(row, pollutant_names, row_record_id(key, n), own_ids=not dedup)
+        if rec is None:
+            state["rejected"] += 1
+        else:
+            batch.append(rec)
+        if len(batch) >= batch_size:
+            commit()
+    if batch:
+        commit()
+    # batches are written without compacting; fold the log in once, here
+    utils.get_backend().compact("air")
+    state["rows"] = skip + seen
+    if metrics.ENABLED:
+        metrics.add("records_total", seen, op="import_file")
+    if os.path.exists(checkpoint_path(key)):
+        os.remove(checkpoint_path(key))
+    elapsed = time.time() - start
+    stats = {
+        "path": path,
+        "rows": state["rows"],
+        "imported": state["imported"],
+        "rejected": state["rejected"],
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(seen / elapsed, 1) if elapsed else 0.0,
+    }
+    if dedup:
+        stats.update(counts)
+    return stats
+
+
+def parse_file(path, pollutant_names, own_ids=True):
+    # Runs in a worker process: parse and normalize one whole file.
+    key = import_key(path)
+    records = []
+    rows = 0
+    for n, row in enumerate(iter_rows(path)):
+        rows += 1
+        rec = normalize(row, pollutant_names, row_record_id(key, n), own_ids)
+        if rec is not None:
+            records.append(rec)
+    return {"path": path, "rows": rows, "rejected": rows - len(records), "records": records}
+
+
+def expand_paths(target):
+    if os.path.isdir(target):
+        paths = [os.path.join(target, fn) for fn in os.listdir(target)]
+    else:
+        paths = glob.glob(target)
+    return sorted(p for p in paths if os.path.isfile(p) and os.path.splitext(p)[1].lower() in EXTENSIONS)
+
+
+@metrics.timed("import_many")
+def import_many(target, workers=None, progress=print, dedup=False):
+    """Import every data file in a directory or matching a glob.
+
+    Files are parsed in parallel on a process pool; this process is the only
+    writer and commits each file's records as one batch as results arrive.
+    At most two files per worker are in flight, which bounds memory.
+    dedup is as for import_file().
+    """
+    utils.ensure_data_dir()
+    paths = expand_paths(target)
+    pollutant_names = [p.get("name") for p in utils.load_json("pollutants")]
+    if not dedup:
+        utils.repo.invalidate("air")
+    workers = workers or os.cpu_count() or 1
+    totals = {"files": 0, "failed": [], "rows": 0, "imported": 0, "rejected": 0}
+    counts = _counts() if dedup else None
+    start = time.time()
+    pending = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        running = {}
+        while True:
+            while len(running) < workers * 2:
+                path = next(pending, None)
+                if path is None:
+                    break
+                running[ex.submit(parse_file, path, pollutant_names, not dedup)] = path
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                path = running.pop(fut)
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    totals["failed"].append(path)
+                    if progress:
+                        progress(f"  {path}: failed ({e})")
+                    continue
+                written = _write(res["records"], counts)
+                totals["files"] += 1
+                totals["rows"] += res["rows"]
+                totals["imported"] += written
+                totals["rejected"] += res["rejected"]
+                if progress:
+                    rate = totals["rows"] / max(time.time() - start, 1e-9)
+                    progress(f"  {path}: {written} imported ({totals['files']}/{len(paths)} files, {rate:.0f} rows/s)")
+    utils.get_backend().compact("air")
+    if metrics.ENABLED:
+        metrics.add("records_total", totals["rows"], op="import_many")
+    elapsed = time.time() - start
+    totals["seconds"] = round(elapsed, 3)
+    totals["rows_per_sec"] = round(totals["rows"] / elapsed, 1) if elapsed else 0.0
+    if dedup:
+        totals.update(counts)
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import air quality data files.")
+    parser.add_argument("target", help="a .csv/.json/.jsonl file, a directory, or a glob pattern")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes for directories and globs")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per commit for a single file")
+    parser.add_argument("--quiet", action="store_true", help="do not print progress")
+    parser.add_argument("--dedup", action="store_true",
+                        help="skip readings already stored (same region, date and station) and update changed ones")
+    args = parser.parse_args(argv)
+    progress = None if args.quiet else print
+    if os.path.isfile(args.target):
+        stats = import_file(args.target, args.batch_size, progress, args.dedup)
+    else:
+        stats = import_many(args.target, args.workers, progress, args.dedup)
+    print(json.dumps(stats))
+    return 1 if stats.get("failed") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,25 @@
 #made by RANA YASH RAJ PRATAP SINGH
 import sys
 import utils
-import admin
-import citizen
+import alerting
 
 def main_menu():
     utils.ensure_sample_data()
+    alerting.sweep_daily()
     print("=== Air Quality & Pollution Tracking Portal ===")
     while True:
         print("Main Menu:\n1.Admin Login\n2.Citizen Login\n3.Register as New Citizen\n4.Exit")
         ch = input("Choice: ").strip()
+        # role modules are imported on first use, keeping startup cheap
         if ch == "1":
+            import admin
             if admin.admin_login():
                 admin.admin_menu()
         elif ch == "2":
+            import citizen
             citizen.citizen_login()
         elif ch == "3":
+            import citizen
             citizen.register_citizen()
         elif ch == "4":
             print("Goodbye.")
@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import functools
+import contextlib
+
+# AQ_METRICS=1 turns collection on; AQ_METRICS_FILE=path.json|path.prom writes
+# the numbers there when the process exits. AQ_PROFILE=action[,action...] (or
+# "all") runs cProfile and tracemalloc around those menu actions.
+ENABLED = os.environ.get("AQ_METRICS", "") not in ("", "0")
+PROFILE = {a.strip() for a in os.environ.get("AQ_PROFILE", "").split(",") if a.strip()}
+PROFILE_DIR = os.environ.get("AQ_PROFILE_DIR") or os.path.join(os.path.dirname(__file__), "profiles")
+
+# Latency histogram bucket bounds in seconds (Prometheus "le" labels).
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float("inf"))
+
+_lock = threading.Lock()
+_ops = {}
+_counters = {}
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    with _lock:
+        _ops.clear()
+        _counters.clear()
+
+
+def observe(op, seconds, dataset=""):
+    with _lock:
+        stat = _ops.get((op, dataset))
+        if stat is None:
+            stat = _ops[(op, dataset)] = {"calls": 0, "seconds": 0.0, "buckets": [0] * len(BUCKETS)}
+        stat["calls"] += 1
+        stat["seconds"] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                stat["buckets"][i] += 1
+                break
+
+
+def add(counter, value, **labels):
+    key = (counter, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def timed(op, dataset=False, records=False):
+    """Decorator: count calls and latency of fn under op.
+
+    dataset=True labels each call with its first argument (a dataset name);
+    records=True also adds the records the call read to records_total: what
+    the queries under it report through scanned(), or, if none do, the
+    length of a list result. While collection is off the wrapper only checks
+    ENABLED.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            label = str(args[0]) if dataset and args else ""
+            if records:
+                outer, _scan.tally = getattr(_scan, "tally", None), []
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                observe(op, time.perf_counter() - start, label)
+                if records:
+                    tally, _scan.tally = _scan.tally, outer
+            if records:
+                if tally:
+                    add("records_total", sum(tally), op=op, dataset=label)
+                elif isinstance(result, list):
+                    add("records_total", len(result), op=op, dataset=label)
+            return result
+        return wrapper
+    return decorate
+
+
+_scan = threading.local()
+
+
+def scanned(rows):
+    """Count the records a query read (a list of them, or a number) for the
+    innermost timed(records=True) call on this thread; returns rows.
+
+    Outside such a call, or with collection off, it does nothing.
+    """
+    tally = getattr(_scan, "tally", None)
+    if tally is not None:
+        tally.append(rows if isinstance(rows, int) else len(rows))
+    return rows
+
+
+def snapshot():
+    with _lock:
+        ops = [{"op": op, "dataset": ds, "calls": s["calls"], "seconds": s["seconds"],
+                "buckets": {_le(b): n for b, n in zip(BUCKETS, _cumulative(s["buckets"]))}}
+               for (op, ds), s in sorted(_ops.items())]
+        counters = [{"name": name, "labels": dict(labels), "value": v}
+                    for (name, labels), v in sorted(_counters.items())]
+    return {"time": time.time(), "operations": ops, "counters": counters}
+
+
+def _le(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def _cumulative(counts):
+    out, total = [], 0
+    for n in counts:
+        total += n
+        out.append(total)
+    return out
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items() if v != "")
+    return "{" + body + "}" if body else ""
+
+
+def prometheus(snap=None):
+    """The snapshot in the Prometheus text exposition format."""
+    snap = snap or snapshot()
+    lines = ["# HELP aq_operation_seconds Latency of instrumented operations.",
+             "# TYPE aq_operation_seconds histogram"]
+    for s in snap["operations"]:
+        for le, n in s["buckets"].items():
+            lines.append(f"aq_operation_seconds_bucket{_labels(op=s['op'], dataset=s['dataset'], le=le)} {n}")
+        lines.append(f"aq_operation_seconds_sum{_labels(op=s['op'], dataset=s['dataset'])} {s['seconds']}")
+        lines.append(f"aq_operation_seconds_count{_labels(op=s['op'], dataset=s['dataset'])} {s['calls']}")
+    seen = set()
+    for c in snap["counters"]:
+        name = f"aq_{c['name']}"
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_labels(**c['labels'])} {c['value']}")
+    return "\n".join(lines) + "\n"
+
+
+def write(path):
+    # .prom/.txt -> Prometheus text file (e.g. for node_exporter), else JSON.
+    import storage
+    snap = snapshot()
+    if os.path.splitext(path)[1].lower() in (".prom", ".txt"):
+        text = prometheus(snap)
+    else:
+        text = json.dumps(snap, indent=2)
+    storage.atomic_write(path, text)
+
+
+def _write_at_exit():
+    path = os.environ.get("AQ_METRICS_FILE")
+    if ENABLED and path:
+        write(path)
+
+
+atexit.register(_write_at_exit)
+
+
+@contextlib.contextmanager
+def capture(action):
+    """Run the block under cProfile and tracemalloc, saving both reports.
+
+    Writes <action>-<time>.prof (load with pstats or snakeviz) and
+    <action>-<time>-memory.txt (top allocation sites) to PROFILE_DIR, and
+    prints the top functions by cumulative time to stderr.
+    """
+    import io
+    import pstats
+    import cProfile
+    import tracemalloc
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"{action}-{time.strftime('%Y%m%d-%H%M%S')}")
+    prof = cProfile.Profile()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        mem = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+        prof.dump_stats(base + ".prof")
+        with open(base + "-memory.txt", "w", encoding="utf-8") as f:
+            f.write(f"current {current} bytes, peak {peak} bytes\n")
+            for stat in mem.statistics("lineno")[:25]:
+                f.write(f"{stat}\n")
+        out = io.StringIO()
+        pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(15)
+        print(out.getvalue(), file=sys.stderr)
+        print(f"Profile saved to {base}.prof and {base}-memory.txt (peak {peak / 1e6:.1f} MB)", file=sys.stderr)
+
+
+def profiled(fn):
+    """Decorator for menu actions: profile fn when AQ_PROFILE names it."""
+    if not PROFILE:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if "all" not in PROFILE and fn.__name__ not in PROFILE:
+            return fn(*args, **kwargs)
+        with capture(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
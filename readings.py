@@ -0,0 +1,110 @@
+import utils
+import rollups
+import segments
+from indexes import region_key
+
+# Report and latest-reading queries over every air reading. The backends
+# answer for the live store; sealed months (segments.py) are added from the
+# per-segment summaries in the catalog, and readings aged into daily rollups
+# (rollups.py) from the aged totals, so no sealed rows are decoded. A
+# reading left in both the live store and a segment by an interrupted seal
+# counts twice until the next seal removes the live copy.
+
+
+def exists():
+    """True if there is any air reading, live, sealed or aged."""
+    return bool(utils.get_backend().count("air") or segments.catalog() or rollups.aged()["regions"])
+
+
+def _date(rec):
+    return str(rec.get("date", ""))
+
+
+def latest(region):
+    """The latest reading for region (case-insensitive), or None.
+
+    On equal dates the earlier reading wins, and sealed readings are
+    earlier than live ones. If the latest day has been aged, its daily means
+    stand in for a reading (marked "aged"), unless a reading of that day is
+    still stored.
+    """
+    found = utils.get_backend().latest_for_region(region)
+    fold = region_key(region)
+    for seg in reversed(segments.summarized()):
+        if found is not None and _date(found)[:7] > seg.month:
+            break
+        rec = seg.summary["latest"].get(fold)
+        if rec is not None and (found is None or rec["date"] >= _date(found)):
+            found = rec
+    aged = rollups.aged()["latest"].get(fold)
+    if aged is not None and (found is None or aged["date"] > _date(found)):
+        found = aged
+    return found
+
+
+def latest_per_region():
+    best = {}
+    for seg in segments.summarized():
+        for fold, rec in seg.summary["latest"].items():
+            if fold not in best or rec["date"] > best[fold]["date"]:
+                best[fold] = rec
+    for rec in utils.get_backend().latest_per_region():
+        fold = region_key(rec.get("region"))
+        if fold not in best or _date(rec) > _date(best[fold]):
+            best[fold] = rec
+    for fold, rec in rollups.aged()["latest"].items():
+        if fold not in best or rec["date"] > _date(best[fold]):
+            best[fold] = rec
+    return list(best.values())
+
+
+def _add(table, key, total, count):
+    cell = table.setdefault(key, [0, 0])
+    cell[0] += count
+    cell[1] += total
+
+
+def region_averages():
+    """[(region, average AQI, readings)] per region name."""
+    totals = {}
+    for region, (count, total) in rollups.aged()["regions"].items():
+        _add(totals, region, total, count)
+    for seg in segments.summarized():
+        for region, (count, total) in seg.summary["regions"].items():
+            _add(totals, region, total, count)
+    for region, total, count in utils.get_backend().region_totals():
+        _add(totals, region, total, count)
+    return [(region, total / count, count) for region, (count, total) in totals.items()]
+
+
+def monthly_means(region):
+    """[(month, average AQI)] for one region (case-insensitive), by month."""
+    fold = region_key(region)
+    totals = {}
+    for month, (count, total) in rollups.aged()["months"].get(fold, {}).items():
+        _add(totals, month, total, count)
+    for seg in segments.summarized():
+        cell = seg.summary["folds"].get(fold)
+        if cell is not None:
+            _add(totals, seg.month, cell[1], cell[0])
+    for month, total, count in utils.get_backend().month_totals(region):
+        _add(totals, month, total, count)
+    return sorted((month, total / count) for month, (count, total) in totals.items())
+
+
+def pollutant_peaks():
+    """{region: {pollutant: highest level}}."""
+    peaks = {}
+    _max_into(peaks, rollups.aged()["peaks"])
+    for seg in segments.summarized():
+        _max_into(peaks, seg.summary["peaks"])
+    _max_into(peaks, utils.get_backend().pollutant_peaks())
+    return peaks
+
+
+def _max_into(peaks, more):
+    for region, levels in more.items():
+        peak = peaks.setdefault(region, {})
+        for name, val in levels.items():
+            if name not in peak or val > peak[name]:
+                peak[name] = val
@@ -0,0 +1,380 @@
+import os
+import sys
+import json
+import math
+import sqlite3
+import argparse
+import functools
+from fractions import Fraction
+from concurrent.futures import ProcessPoolExecutor
+import utils
+import metrics
+import rollups
+import storage
+import segments
+from indexes import region_key
+
+# Every worker reads its own shard: a byte range of about SLICE_BYTES of the
+# JSON snapshot, CHUNK_SIZE rowids of the SQLite table, or one sealed month's
+# segment file. Only the records the log appends are read by this process.
+SLICE_BYTES = 16 << 20
+CHUNK_SIZE = 50000
+
+# Histograms use the rollup sketch buckets, so a percentile is off by at
+# most 1 / 2**BUCKET_BITS of its value (about 0.4%).
+BUCKET_BITS = rollups.SKETCH_BITS
+
+PERCENTILES = (50, 90, 99)
+
+# month_key parses the date; readings share few enough dates to memoize it.
+_month_key = functools.lru_cache(maxsize=1 << 16)(utils.month_key)
+
+
+class Stats:
+    """Count, exact sum, min, max and optionally a histogram of values.
+
+    Every float is a fraction with a power-of-two denominator, so the sum is
+    kept as integer numerators per denominator: exact, and the same however
+    the values are split between partials.
+    """
+
+    __slots__ = ("n", "sums", "lo", "hi", "hist")
+
+    def __init__(self, hist=False):
+        self.n = 0
+        self.sums = {}
+        self.lo = math.inf
+        self.hi = -math.inf
+        self.hist = {} if hist else None
+
+    def add(self, v):
+        num, den = v.as_integer_ratio()
+        self.n += 1
+        sums = self.sums
+        sums[den] = sums.get(den, 0) + num
+        if v < self.lo:
+            self.lo = v
+        if v > self.hi:
+            self.hi = v
+        hist = self.hist
+        if hist is not None:
+            b = rollups.sketch_key(v)
+            hist[b] = hist.get(b, 0) + 1
+
+    def merge(self, other):
+        self.n += other.n
+        for den, num in other.sums.items():
+            self.sums[den] = self.sums.get(den, 0) + num
+        self.lo = min(self.lo, other.lo)
+        self.hi = max(self.hi, other.hi)
+        if self.hist is not None:
+            for b, c in other.hist.items():
+                self.hist[b] = self.hist.get(b, 0) + c
+
+    @classmethod
+    def totals(cls, n, total, lo=math.inf, hi=-math.inf, sketch=None):
+        """Stats from a count, a sum and optionally a rollup sketch."""
+        s = cls(hist=sketch is not None)
+        s.n = n
+        num, den = float(total).as_integer_ratio()
+        s.sums[den] = num
+        s.lo, s.hi = lo, hi
+        if sketch is not None:
+            s.hist = {int(k): c for k, c in sketch.items()}
+        return s
+
+    def mean(self):
+        return float(sum(Fraction(num, den) for den, num in self.sums.items()) / self.n)
+
+    def percentile(self, p):
+        # nearest rank over the buckets, clamped to the exact min and max
+        need = max(1, math.ceil(p / 100.0 * self.n))
+        seen = 0
+        for b in sorted(self.hist):
+            seen += self.hist[b]
+            if seen >= need:
+                return min(max(rollups.sketch_value(b), self.lo), self.hi)
+        return self.hi
+
+
+class Partial:
+    """Mergeable report aggregates over one shard of the air readings.
+
+    regions: AQI per region name (as the top-regions report groups them);
+    cells: AQI per (case-folded region, month); metrics: AQI and each
+    pollutant with histograms; names: first spelling seen of each folded
+    region. Merging partials of consecutive shards in order gives exactly
+    the partial of all their readings.
+    """
+
+    def __init__(self):
+        self.regions = {}
+        self.cells = {}
+        self.metrics = {}
+        self.names = {}
+
+    def add(self, rec):
+        region = rec.get("region")
+        fold = region_key(region)
+        self.names.setdefault(fold, region)
+        aqi = utils.safe_float(rec.get("AQI", 0), None)
+        if aqi is not None and math.isfinite(aqi):
+            aqi += 0.0  # -0.0 -> 0.0, so min/max never depend on order
+            month = _month_key(str(rec.get("date", "")))
+            for table, key in ((self.regions, region), (self.cells, (fold, month))):
+                s = table.get(key)
+                if s is None:
+                    s = table[key] = Stats()
+                s.add(aqi)
+            self._metric("AQI").add(aqi)
+        for name, val in (rec.get("pollutants") or {}).items():
+            val = utils.safe_float(val, None)
+            if val is not None and math.isfinite(val):
+                self._metric(name).add(val + 0.0)
+
+    def _metric(self, name):
+        s = self.metrics.get(name)
+        if s is None:
+            s = self.metrics[name] = Stats(hist=True)
+        return s
+
+    def merge(self, other):
+        for mine, theirs in ((self.regions, other.regions), (self.cells, other.cells), (self.metrics, other.metrics)):
+            for key, s in theirs.items():
+                if key in mine:
+                    mine[key].merge(s)
+                else:
+                    mine[key] = s
+        for fold, name in other.names.items():
+            self.names.setdefault(fold, name)
+        return self
+
+
+def _aged():
+    # The readings aged into daily rollups, from their totals.
+    doc = rollups.aged()
+    part = Partial()
+    for fold, rec in doc["latest"].items():
+        part.names[fold] = rec["region"]
+    for region, (n, total) in doc["regions"].items():
+        part.regions[region] = Stats.totals(n, total)
+    for fold, months in doc["months"].items():
+        for month, (n, total) in months.items():
+            part.cells[(fold, month)] = Stats.totals(n, total)
+    for name, (n, total, lo, hi, sketch) in doc["metrics"].items():
+        part.metrics[name] = Stats.totals(n, total, lo, hi, sketch)
+    return part
+
+
+def _live_rows(task):
+    kind = task[0]
+    if kind == "sqlite":
+        _, path, lo, hi = task[:4]
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            docs = conn.execute("SELECT doc FROM air WHERE rowid BETWEEN ? AND ? ORDER BY rowid", (lo, hi)).fetchall()
+        finally:
+            conn.close()
+        return [json.loads(doc) for (doc,) in docs], set()
+    store = storage.RecordLog(task[1], utils.KEYS["air"])
+    if kind == "slice":
+        rows = store.read_slice(task[2], task[3])
+    else:
+        rows = store._read_snapshot()
+    return store.replay(rows, store._read_log())
+
+
+def _shard(task):
+    # Runs in a worker: ("segment", path, ids to skip), or a live shard
+    # ("slice", path, start, end, sealed months), ("snapshot", path, sealed
+    # months) or ("sqlite", path, first rowid, last rowid, sealed months).
+    # Returns the Partial, the snapshot keys the log touched and the ids of
+    # readings in sealed months, whose sealed copies the segments skip.
+    part = Partial()
+    if task[0] == "segment":
+        seg = segments.Segment(task[1])
+        rows = [r for r in seg.records() if r["record_id"] not in task[2]]
+        seg.close()
+        touched = set()
+    else:
+        rows, touched = _live_rows(task)
+    sealed = _in_months(rows, task[-1]) if task[0] != "segment" else {}
+    for rec in rows:
+        part.add(rec)
+    return part, touched, sealed
+
+
+def _in_months(rows, months):
+    ids = {}
+    for rec in rows:
+        month = str(rec.get("date", ""))[:7]
+        if month in months:
+            ids.setdefault(month, set()).add(rec.get("record_id"))
+    return ids
+
+
+def _live_tasks(months):
+    # Shards of the live store in load() order; no records are read here.
+    backend = utils.get_backend()
+    if backend.name == "sqlite":
+        lo, hi = backend.conn.execute("SELECT MIN(rowid), MAX(rowid) FROM air").fetchone()
+        if lo is None:
+            return []
+        return [("sqlite", backend.path, i, min(i + CHUNK_SIZE - 1, hi), months)
+                for i in range(lo, hi + 1, CHUNK_SIZE)]
+    store = utils.get_store("air")
+    ranges = store.slices(SLICE_BYTES)
+    if ranges is None:
+        return [("snapshot", store.path, months)]
+    return [("slice", store.path, start, end, months) for start, end in ranges]
+
+
+def _appended(touched, months):
+    # The records the JSON log adds after the snapshot's (read here: the log
+    # is kept small by compaction), as one last shard.
+    if utils.get_backend().name != "json":
+        return Partial(), {}
+    store = utils.get_store("air")
+    rows = store.appended(store._read_log(), touched)
+    part = Partial()
+    for rec in rows:
+        part.add(rec)
+    return part, _in_months(rows, months)
+
+
+@metrics.timed("report.aggregate")
+def aggregate(workers=None):
+    """The Partial of every air reading, live, sealed and aged.
+
+    Live shards run first, as they report which readings have sealed copies
+    to skip; the partials are then merged in the order segments.merge()
+    lists the readings, sealed months first. With workers > 1 the shards run
+    on a process pool; workers=1 runs the same shards one after another in
+    this process. Both give identical results. Default: one worker per CPU.
+    The air lock is held shared throughout, so writers wait.
+    """
+    utils.ensure_data_dir()
+    workers = workers or os.cpu_count() or 1
+    with utils.get_store("air").locked(shared=True):
+        catalog = segments.catalog()
+        months = {seg.month for seg in catalog}
+        tasks = _live_tasks(months)
+        if workers > 1 and len(tasks) + len(catalog) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                return _run(tasks, catalog, months, ex.map)
+        return _run(tasks, catalog, months, map)
+
+
+def _run(tasks, catalog, months, run):
+    live = list(run(_shard, tasks))
+    touched = set().union(*(t for _, t, _ in live))
+    tail, tail_sealed = _appended(touched, months)
+    skip = {}
+    for sealed in [s for _, _, s in live] + [tail_sealed]:
+        for month, ids in sealed.items():
+            skip.setdefault(month, set()).update(ids)
+    total = _aged()
+    for part, _, _ in run(_shard, [("segment", seg.path, skip.get(seg.month, set())) for seg in catalog]):
+        total.merge(part)
+    for part, _, _ in live:
+        total.merge(part)
+    return total.merge(tail)
+
+
+def serial():
+    """Every reading added to one Partial in order, after the aged totals:
+    the reference result."""
+    utils.ensure_data_dir()
+    total = _aged()
+    for rec in segments.merge(utils.load_json("air"), segments.records()):
+        total.add(rec)
+    return total
+
+
+def top_regions(agg):
+    """[[region, average AQI, readings]], highest average first."""
+    rows = [[region, round(s.mean(), 1), s.n] for region, s in agg.regions.items()]
+    rows.sort(key=lambda x: x[1], reverse=True)
+    return rows
+
+
+def monthly_trend(agg, region):
+    fold = region_key(region)
+    return sorted((month, s.mean()) for (f, month), s in agg.cells.items() if f == fold)
+
+
+def pollutant_table(agg):
+    """Per measure (AQI first, then pollutants by name), over all regions:
+    [name, readings, min, mean, p50, p90, p99, max]. Percentiles come from
+    the histograms, so they are approximate; the other columns are exact."""
+    names = sorted(agg.metrics, key=lambda n: (n != "AQI", n))
+    return [[n, s.n, s.lo, round(s.mean(), 2), *(round(s.percentile(p), 2) for p in PERCENTILES), s.hi]
+            for n, s in ((n, agg.metrics[n]) for n in names)]
+
+
+def heatmap(agg):
+    """(months, rows): one row per region, [region, mean AQI per month...],
+    with "" where a region has no readings that month."""
+    months = sorted({month for _, month in agg.cells})
+    rows = []
+    for fold in sorted(agg.names, key=lambda f: str(agg.names[f])):
+        cells = [agg.cells.get((fold, m)) for m in months]
+        if any(cells):
+            rows.append([agg.names[fold]] + [round(c.mean(), 1) if c else "" for c in cells])
+    return months, rows
+
+
+def _reports(agg):
+    return {
+        "top_regions": top_regions(agg),
+        "monthly": {name: monthly_trend(agg, name) for name in agg.names.values()},
+        "pollutants": pollutant_table(agg),
+        "heatmap": heatmap(agg),
+    }
+
+
+def verify(workers=None):
+    """Compare the pooled reports with serial(); returns the differing reports.
+
+    The top-regions and monthly reports are also checked against the
+    summaries behind admin's reports (readings.py).
+    """
+    import readings
+    expected = _reports(serial())
+    got = _reports(aggregate(workers))
+    problems = [name for name in expected if expected[name] != got[name]]
+    summed = [[r, round(avg, 1), n] for r, avg, n in readings.region_averages()]
+    summed.sort(key=lambda x: x[1], reverse=True)
+    if summed != got["top_regions"]:
+        problems.append("top_regions (summaries)")
+    if any(readings.monthly_means(name) != rows for name, rows in got["monthly"].items()):
+        problems.append("monthly (summaries)")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parallel reports over all air readings, live and sealed.")
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: one per CPU)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("percentiles", help="per-pollutant distribution across all regions")
+    sub.add_parser("heatmap", help="mean AQI per region and month")
+    sub.add_parser("top-regions", help="average AQI per region, highest first")
+    sub.add_parser("verify", help="check the parallel results against the serial computation")
+    args = parser.parse_args(argv)
+    if args.command == "verify":
+        problems = verify(args.workers)
+        print(json.dumps({"ok": not problems, "mismatches": problems}))
+        return 1 if problems else 0
+    agg = aggregate(args.workers)
+    if args.command == "percentiles":
+        utils.print_table(pollutant_table(agg), headers=["Measure", "Readings", "Min", "Mean", "P50", "P90", "P99", "Max"])
+    elif args.command == "heatmap":
+        months, rows = heatmap(agg)
+        utils.print_table(rows, headers=["Region"] + months)
+    else:
+        utils.print_table(top_regions(agg), headers=["Region", "Average AQI", "Records"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import os
+from collections import OrderedDict
+
+
+def file_signature(*paths):
+    sig = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            sig.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append(None)
+    return tuple(sig)
+
+
+class DataRepository:
+    """Process-wide cache of parsed datasets.
+
+    Each entry is stamped with the (mtime, size) of its snapshot and log, and
+    is re-read whenever those change, so edits made by another process are
+    picked up on the next get(). Entries are evicted least-recently-used once
+    their combined on-disk size passes max_bytes. A dataset larger than
+    max_bytes on its own is pinned rather than dropped, outside the budget
+    and at most one at a time, so its views are not rebuilt on every query.
+    """
+
+    def __init__(self, store_factory, max_bytes):
+        self.store_factory = store_factory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total = 0
+        self._views = {}
+
+    def _signature(self, store):
+        return file_signature(store.path, store.log_path)
+
+    def get(self, name):
+        store = self.store_factory(name)
+        sig = self._signature(store)
+        entry = self._entries.get(name)
+        if entry is not None and entry["sig"] == sig:
+            self._entries.move_to_end(name)
+            return entry["data"]
+        data = store.load()
+        self._put(name, sig, data)
+        return data
+
+    def register_view(self, name, view_name, factory):
+        """Attach a derived structure to a dataset.
+
+        factory(records) builds the view; afterwards it is kept current through
+        its put(rec) and delete(key) methods, and rebuilt whenever the dataset
+        is re-read from disk.
+        """
+        self._views[(name, view_name)] = factory
+
+    def view(self, name, view_name):
+        data = self.get(name)
+        entry = self._entries.get(name)
+        factory = self._views[(name, view_name)]
+        if entry is None:
+            return factory(data)
+        views = entry["views"]
+        if view_name not in views:
+            views[view_name] = factory(data)
+        return views[view_name]
+
+    def drop_view(self, name, view_name):
+        entry = self._entries.get(name)
+        if entry is not None:
+            entry["views"].pop(view_name, None)
+
+    def peek(self, name):
+        # Cached data for name, only if it is still current on disk.
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        if entry["sig"] != self._signature(self.store_factory(name)):
+            self.invalidate(name)
+            return None
+        return entry["data"]
+
+    def _put(self, name, sig, data):
+        self.invalidate(name)
+        self._entries[name] = {"sig": sig, "data": data, "cost": 0, "pinned": False, "pos": None, "views": {}}
+        self._charge(name, sum(s[1] for s in sig if s))
+
+    def _charge(self, name, cost):
+        # Reprice name's entry, then evict least-recently-used entries until
+        # the unpinned ones fit in max_bytes again.
+        entry = self._entries[name]
+        if not entry["pinned"]:
+            self._total -= entry["cost"]
+        entry["cost"] = cost
+        entry["pinned"] = cost > self.max_bytes
+        if entry["pinned"]:
+            for other in [n for n, e in self._entries.items() if e["pinned"] and n != name]:
+                self.invalidate(other)
+        else:
+            self._total += cost
+        for old in [n for n, e in self._entries.items() if not e["pinned"] and n != name]:
+            if self._total <= self.max_bytes:
+                break
+            self.invalidate(old)
+
+    def invalidate(self, name=None):
+        if name is None:
+            self._entries.clear()
+            self._total = 0
+            return
+        entry = self._entries.pop(name, None)
+        if entry is not None and not entry["pinned"]:
+            self._total -= entry["cost"]
+
+    def stored(self, name, data):
+        # Called after data was written in full: cache it as the current view.
+        self._put(name, self._signature(self.store_factory(name)), data)
+
+    def applied(self, name, puts=(), deletes=(), was_current=False):
+        """Fold records just appended to the log into the cached copy.
+
+        was_current says whether the cache matched disk before the write; if
+        it did not, or nothing is cached, the entry is simply dropped.
+        """
+        entry = self._entries.get(name)
+        if entry is None or not was_current:
+            self.invalidate(name)
+            return
+        data = entry["data"]
+        store = self.store_factory(name)
+        key = store.key
+        if entry["pos"] is None:
+            entry["pos"] = {r.get(key): i for i, r in enumerate(data)}
+        pos = entry["pos"]
+        views = entry["views"].values()
+        for rec in puts:
+            k = rec.get(key)
+            if k in pos:
+                data[pos[k]] = rec
+            else:
+                pos[k] = len(data)
+                data.append(rec)
+            for v in views:
+                v.put(rec)
+        if deletes:
+            gone = set(deletes)
+            data[:] = [r for r in data if r.get(key) not in gone]
+            entry["pos"] = None
+            for k in deletes:
+                for v in views:
+                    v.delete(k)
+        entry["sig"] = self._signature(store)
+        self._charge(name, sum(s[1] for s in entry["sig"] if s))
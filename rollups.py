@@ -0,0 +1,548 @@
+import os
+import sys
+import json
+import math
+import hashlib
+import argparse
+import datetime
+import utils
+import storage
+import segments
+from indexes import region_key
+
+TIERS = ("daily", "monthly", "yearly")
+FIELDS = ["n", "min", "mean", "max", "p50", "p90", "p99"]
+PERCENTILES = (50, 90, 99)
+
+# Totals of the readings aged out of the live store, and the state of an
+# age_out() in progress. Small: the reports read it whole.
+ROLLUP_FILE = "air_rollups.json"
+# One file of tiers per region, and the journal of (region, day)s written
+# since their tiers were last brought up to date.
+ROLLUP_DIR = "rollups"
+PENDING_FILE = "pending.log"
+EVERYTHING = "*"
+# The versions of the live store and the segments the tiers (with the
+# journal) were last known to cover; a write that bypassed the journal
+# shows up as a version moving while the journal is empty.
+STAMP_FILE = "stamp.json"
+
+# Sketch buckets keep this many mantissa bits, so a percentile is off by at
+# most 1 / 2**SKETCH_BITS of its value (about 0.4%).
+SKETCH_BITS = 7
+_SPAN = 1 << SKETCH_BITS
+
+
+def rollup_path():
+    return os.path.join(utils.DATA_DIR, ROLLUP_FILE)
+
+
+def rollup_dir():
+    return os.path.join(utils.DATA_DIR, ROLLUP_DIR)
+
+
+def pending_path():
+    return os.path.join(rollup_dir(), PENDING_FILE)
+
+
+def stamp_path():
+    return os.path.join(rollup_dir(), STAMP_FILE)
+
+
+def region_path(fold):
+    return os.path.join(rollup_dir(), hashlib.sha1(fold.encode("utf-8")).hexdigest()[:16] + ".json")
+
+
+def bucket(tier, day):
+    return {"daily": day, "monthly": day[:7], "yearly": day[:4]}[tier]
+
+
+def valid_day(date):
+    try:
+        datetime.datetime.strptime(date, "%Y-%m-%d")
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def sketch_key(v):
+    # Exponent, then the top mantissa bits; ordered like the values, with
+    # negatives below 0 below positives.
+    m, e = math.frexp(v)
+    if v > 0:
+        return (e + 1100) * _SPAN + int(m * _SPAN)
+    return int(m * _SPAN) - (e + 1100) * _SPAN if v else 0
+
+
+def sketch_value(key):
+    if key == 0:
+        return 0.0
+    e, m = divmod(abs(key), _SPAN)
+    mid = math.ldexp((m + 0.5) / _SPAN, e - 1100)
+    return mid if key > 0 else -mid
+
+
+# A summary is [count, sum, min, max, sketch]: the sketch counts values per
+# bucket (keys as strings, as JSON stores them), so it stays a few hundred
+# entries at most however many readings it covers.
+
+def summary():
+    return [0, 0.0, None, None, {}]
+
+
+def add(s, v):
+    s[0] += 1
+    s[1] += v
+    if s[2] is None or v < s[2]:
+        s[2] = v
+    if s[3] is None or v > s[3]:
+        s[3] = v
+    k = str(sketch_key(v))
+    s[4][k] = s[4].get(k, 0) + 1
+
+
+def merge(s, other):
+    if not other[0]:
+        return s
+    s[0] += other[0]
+    s[1] += other[1]
+    if s[2] is None or other[2] < s[2]:
+        s[2] = other[2]
+    if s[3] is None or other[3] > s[3]:
+        s[3] = other[3]
+    for k, c in other[4].items():
+        s[4][k] = s[4].get(k, 0) + c
+    return s
+
+
+def row(s):
+    """[n, min, mean, max, p50, p90, p99]; percentiles from the sketch."""
+    n, total, lo, hi, sketch = s
+    out = [n, lo, round(total / n, 2), hi]
+    keys = sorted(int(k) for k in sketch)
+    for p in PERCENTILES:
+        # nearest rank, clamped to the exact min and max
+        need = max(1, math.ceil(p / 100.0 * n))
+        seen = 0
+        for k in keys:
+            seen += sketch[str(k)]
+            if seen >= need:
+                out.append(round(min(max(sketch_value(k), lo), hi), 2))
+                break
+    return out
+
+
+def metrics(rec):
+    yield "AQI", utils.safe_float(rec.get("AQI", 0))
+    for name, val in (rec.get("pollutants") or {}).items():
+        val = utils.safe_float(val, None)
+        if val is not None and math.isfinite(val):
+            yield name, val
+
+
+def _add_reading(per_day, rec):
+    for metric, val in metrics(rec):
+        s = per_day.get(metric)
+        if s is None:
+            s = per_day[metric] = summary()
+        add(s, val)
+
+
+def _blank_doc():
+    return {"version": 2, "aging": None, "regions": {}, "months": {}, "peaks": {}, "metrics": {}, "latest": {}}
+
+
+def read_rollups():
+    try:
+        with open(rollup_path(), "r", encoding="utf-8") as f:
+            doc = json.load(f)
+    except (OSError, ValueError):
+        return _blank_doc()
+    return doc
+
+
+def write_rollups(doc):
+    storage.atomic_write(rollup_path(), json.dumps(doc, separators=(",", ":")))
+
+
+def aged():
+    """Totals of the aged readings: AQI [count, sum] per region name and per
+    case-folded region and month, pollutant peaks per region name, a summary
+    per measure, and per case-folded region the latest aged day as a
+    reading. A round of age_out() still in progress is not in them yet."""
+    return read_rollups()
+
+
+def read_region(fold):
+    try:
+        with open(region_path(fold), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"fold": fold, "region": None, "aged_round": None, "aged": {},
+                "daily": {}, "monthly": {}, "yearly": {}}
+
+
+def write_region(fold, state):
+    if not state["daily"] and not state["aged"]:
+        try:
+            os.remove(region_path(fold))
+        except FileNotFoundError:
+            pass
+        return
+    os.makedirs(rollup_dir(), exist_ok=True)
+    storage.atomic_write(region_path(fold), json.dumps(state, separators=(",", ":")))
+
+
+def _journal(entry):
+    os.makedirs(rollup_dir(), exist_ok=True)
+    with open(pending_path(), "a", encoding="utf-8") as f:
+        # the leading newline keeps a line torn by a crash from swallowing this one
+        f.write("\n" + json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_journal():
+    # (everything?, {(fold, day)})
+    pairs = set()
+    try:
+        with open(pending_path(), "r", encoding="utf-8") as f:
+            lines = f.readlines()
+    except OSError:
+        return False, pairs
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue  # a torn trailing line: its write never happened
+        if entry == EVERYTHING:
+            return True, pairs
+        pairs.update(map(tuple, entry))
+    return False, pairs
+
+
+def _rewrite_journal(pairs):
+    if pairs:
+        storage.atomic_write(pending_path(), json.dumps(sorted(pairs)) + "\n")
+    else:
+        try:
+            os.remove(pending_path())
+        except FileNotFoundError:
+            pass
+
+
+def touched(records=(), ids=()):
+    """Journal the (region, day)s that writing records and deleting ids
+    will change. utils' air writers call it under the air lock, before
+    writing.
+
+    Previous versions of the records are looked up only if they are at hand
+    (always on SQLite, when air is cached on JSON); otherwise an update is
+    taken to keep its region and day, as imports' updates do.
+    """
+    ids = list(ids) + [r.get("record_id") for r in records]
+    pairs = set()
+    for rec in list(records) + list(utils.get_backend().peek_records("air", ids).values()):
+        day = rec.get("date")
+        if valid_day(day):
+            pairs.add((region_key(rec.get("region")), day))
+    if pairs:
+        _journal(sorted(pairs))
+
+
+def replaced():
+    """Journal that the whole air dataset is being rewritten."""
+    _journal(EVERYTHING)
+
+
+def _versions():
+    # through JSON, so it compares equal to what _read_stamp() returns
+    return json.loads(json.dumps([utils.get_backend().version("air"), segments.version()]))
+
+
+def _read_stamp():
+    try:
+        with open(stamp_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_stamp(versions):
+    os.makedirs(rollup_dir(), exist_ok=True)
+    storage.atomic_write(stamp_path(), json.dumps(versions))
+
+
+def _days(fold):
+    # Every day fold has a live or sealed reading on.
+    days = {r.get("date") for r in utils.get_backend().records_for_region(fold)}
+    days.update(r["date"] for r in segments.for_region(fold))
+    return {d for d in days if valid_day(d)}
+
+
+def _roll_up(state, months):
+    # Recompute the monthly and yearly buckets covering months from the
+    # buckets below them.
+    for tier, source, keys in (("monthly", "daily", set(months)),
+                               ("yearly", "monthly", {m[:4] for m in months})):
+        fresh = {}
+        for key, per_metric in state[source].items():
+            b = bucket(tier, key)
+            if b in keys:
+                target = fresh.setdefault(b, {})
+                for metric, s in per_metric.items():
+                    merge(target.setdefault(metric, summary()), s)
+        for b in keys:
+            if b in fresh:
+                state[tier][b] = fresh[b]
+            else:
+                state[tier].pop(b, None)
+
+
+def _refresh(fold, days):
+    # Recompute fold's daily buckets for days from its live and sealed
+    # readings and aged summaries, then the months and years above them.
+    state = read_region(fold)
+    live = [r for r in utils.get_backend().records_for_region(fold) if r.get("date") in days]
+    canonical = sorted(d for d in days if segments.ordinal(d) is not None)
+    sealed = segments.for_region(fold, canonical[0], canonical[-1]) if canonical else []
+    daily = {}
+    for rec in segments.merge(live, [r for r in sealed if r["date"] in days]):
+        state["region"] = state["region"] or rec.get("region")
+        _add_reading(daily.setdefault(rec["date"], {}), rec)
+    for day in days:
+        per_metric = daily.get(day, {})
+        for metric, s in state["aged"].get(day, {}).items():
+            merge(per_metric.setdefault(metric, summary()), s)
+        if per_metric:
+            state["daily"][day] = per_metric
+        else:
+            state["daily"].pop(day, None)
+    _roll_up(state, {bucket("monthly", d) for d in days})
+    write_region(fold, state)
+
+
+def settle(fold=None):
+    """Bring one region's tiers (default: every region's) up to date with
+    the journal, recomputing only the days written since.
+
+    Falls back to build() if the tiers were never built or the air data
+    changed behind the journal's back, and to recomputing all of fold's days
+    if its region file is missing.
+    """
+    utils.ensure_data_dir()
+    with utils.get_store("air").locked():
+        doc = read_rollups()
+        if doc.get("aging"):
+            _age(doc, doc["aging"])
+        everything, pairs = _read_journal()
+        stamp, versions = _read_stamp(), _versions()
+        # never built, or the air data changed without going through the journal
+        if everything or stamp is None or (not pairs and stamp != versions):
+            build()
+            return
+        todo = {}
+        for f, day in pairs:
+            if fold is None or f == fold:
+                todo.setdefault(f, set()).add(day)
+        if fold is not None and fold not in todo and not os.path.exists(region_path(fold)):
+            days = _days(fold)
+            if days:
+                todo[fold] = days
+        for f, days in todo.items():
+            _refresh(f, days)
+        if todo:
+            _rewrite_journal({p for p in pairs if p[0] not in todo})
+        if stamp != versions:
+            _write_stamp(versions)
+
+
+def _region_files():
+    try:
+        names = os.listdir(rollup_dir())
+    except OSError:
+        return []
+    return [os.path.join(rollup_dir(), n) for n in names if n.endswith(".json") and n != STAMP_FILE]
+
+
+def build():
+    """Recompute every tier from the raw and sealed readings plus the aged
+    daily summaries; returns the number of regions."""
+    utils.ensure_data_dir()
+    with utils.get_store("air").locked():
+        doc = read_rollups()
+        if doc.get("aging"):
+            _age(doc, doc["aging"])
+        states = {}
+        for path in _region_files():
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            state["daily"], state["monthly"], state["yearly"] = {}, {}, {}
+            states[state["fold"]] = state
+        for rec in segments.merge(utils.load_json("air"), segments.records()):
+            day = rec.get("date")
+            if not valid_day(day):
+                continue
+            fold = region_key(rec.get("region"))
+            state = states.get(fold)
+            if state is None:
+                state = states[fold] = read_region(fold)
+                state["daily"], state["monthly"], state["yearly"] = {}, {}, {}
+            state["region"] = state["region"] or rec.get("region")
+            _add_reading(state["daily"].setdefault(day, {}), rec)
+        for fold, state in states.items():
+            for day, per_metric in state["aged"].items():
+                target = state["daily"].setdefault(day, {})
+                for metric, s in per_metric.items():
+                    merge(target.setdefault(metric, summary()), s)
+            _roll_up(state, {bucket("monthly", d) for d in state["daily"]})
+            write_region(fold, state)
+        _rewrite_journal(set())
+        _write_stamp(_versions())
+        return sum(1 for state in states.values() if state["daily"])
+
+
+def trend(region, tier="monthly", metric="AQI", start=None, end=None):
+    """[(bucket, n, min, mean, max, p50, p90, p99)] for one region and tier."""
+    fold = region_key(region)
+    settle(fold)
+    per_bucket = read_region(fold)[tier]
+    rows = []
+    for key in sorted(per_bucket):
+        if metric not in per_bucket[key]:
+            continue
+        if (start and key < start) or (end and key > end):
+            continue
+        rows.append([key] + row(per_bucket[key][metric]))
+    return rows
+
+
+def _cell(table, key, total):
+    cell = table.setdefault(key, [0, 0.0])
+    cell[0] += 1
+    cell[1] += total
+
+
+def _totals(records):
+    # What the reports need from a round of aged readings (see aged()).
+    delta = {"regions": {}, "months": {}, "peaks": {}, "metrics": {}}
+    for rec in records:
+        region = rec.get("region")
+        aqi = utils.safe_float(rec.get("AQI", 0))
+        _cell(delta["regions"], region, aqi)
+        _cell(delta["months"].setdefault(region_key(region), {}), utils.month_key(rec["date"]), aqi)
+        _add_reading(delta["metrics"], rec)
+        peak = delta["peaks"].setdefault(region, {})
+        for name, val in metrics(rec):
+            if name != "AQI" and (name not in peak or val > peak[name]):
+                peak[name] = val
+    return delta
+
+
+def _add_totals(doc, delta):
+    for name, (n, total) in delta["regions"].items():
+        cell = doc["regions"].setdefault(name, [0, 0.0])
+        cell[0] += n
+        cell[1] += total
+    for fold, months in delta["months"].items():
+        mine = doc["months"].setdefault(fold, {})
+        for month, (n, total) in months.items():
+            cell = mine.setdefault(month, [0, 0.0])
+            cell[0] += n
+            cell[1] += total
+    for name, levels in delta["peaks"].items():
+        peak = doc["peaks"].setdefault(name, {})
+        for pollutant, val in levels.items():
+            if pollutant not in peak or val > peak[pollutant]:
+                peak[pollutant] = val
+    for metric, s in delta["metrics"].items():
+        merge(doc["metrics"].setdefault(metric, summary()), s)
+
+
+def _aged_reading(state):
+    # The latest aged day of a region, shaped like a reading.
+    day = max(state["aged"])
+    means = {m: s[1] / s[0] for m, s in state["aged"][day].items()}
+    return {"record_id": None, "region": state["region"], "date": day,
+            "AQI": round(means.pop("AQI", 0)), "pollutants": {m: round(v, 2) for m, v in means.items()},
+            "readings": state["aged"][day].get("AQI", [0])[0], "aged": True}
+
+
+def _age(doc, aging):
+    # Finish a round: fold its readings into each region's aged days (once;
+    # the region file records the round), delete them from the live store,
+    # then add the round's totals. Each step can be repeated after a crash.
+    ids = set(aging["ids"])
+    by_fold = {}
+    for rec in utils.get_backend().records_between("", aging["cutoff"]):
+        if rec.get("record_id") in ids:
+            by_fold.setdefault(region_key(rec.get("region")), []).append(rec)
+    for fold in aging["folds"]:
+        state = read_region(fold)
+        if state.get("aged_round") != aging["round"]:
+            for rec in by_fold.get(fold, []):
+                state["region"] = state["region"] or rec.get("region")
+                _add_reading(state["aged"].setdefault(rec["date"], {}), rec)
+            state["aged_round"] = aging["round"]
+            write_region(fold, state)
+        if state["aged"]:
+            doc["latest"][fold] = _aged_reading(state)
+    # journaled here as delete_records may not see the records' days
+    pairs = {(fold, rec["date"]) for fold, recs in by_fold.items() for rec in recs}
+    if pairs:
+        _journal(sorted(pairs))
+    utils.delete_records("air", aging["ids"])
+    _add_totals(doc, aging["delta"])
+    doc["aging"] = None
+    write_rollups(doc)
+
+
+def age_out(retention_days, today=None):
+    """Fold raw readings older than retention_days into daily summaries.
+
+    The readings to age and their totals are recorded before anything else
+    is written, so a crash part way is finished by the next settle(),
+    build() or age_out() without counting anything twice. Returns the
+    number of readings removed.
+    """
+    today = today or datetime.date.today()
+    cutoff = (today - datetime.timedelta(days=retention_days)).isoformat()
+    utils.ensure_data_dir()
+    with utils.get_store("air").locked():
+        doc = read_rollups()
+        if doc.get("aging"):
+            _age(doc, doc["aging"])
+        old = [r for r in utils.get_backend().records_between("", cutoff)
+               if valid_day(r.get("date")) and r["date"] < cutoff]
+        if not old:
+            return 0
+        doc["aging"] = {"cutoff": cutoff, "round": utils.gen_id("age"),
+                        "ids": [r["record_id"] for r in old],
+                        "folds": sorted({region_key(r.get("region")) for r in old}),
+                        "delta": _totals(old)}
+        write_rollups(doc)
+        _age(doc, doc["aging"])
+        return len(old)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or age AQI rollup tiers.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("build", help="recompute the daily/monthly/yearly tiers")
+    age = sub.add_parser("age", help="replace raw readings older than --days with daily rollups")
+    age.add_argument("--days", type=int, required=True)
+    args = parser.parse_args(argv)
+    if args.cmd == "build":
+        print(f"Built rollups for {build()} regions.")
+    else:
+        print(f"Aged out {age_out(args.days)} readings.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
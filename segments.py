@@ -0,0 +1,531 @@
+import os
+import re
+import sys
+import json
+import mmap
+import math
+import struct
+import argparse
+import datetime
+import utils
+import metrics
+import storage
+import repository
+from indexes import region_key
+
+# Sealed months of air readings, one binary file per month under
+# data/segments/ (air-YYYY-MM.seg). All numbers are little-endian:
+#
+#   header    magic, version, row/pollutant/region counts, section offsets
+#   columns   string number of each pollutant name
+#   rows      fixed width, sorted by date: date (proleptic ordinal), then the
+#             string numbers of region, record_id, health_risk and extras,
+#             flags, AQI (float64) and one float64 per pollutant (NaN = none)
+#   regions   per case-folded region, sorted: its string, first posting, count
+#   postings  row numbers grouped by region, ascending (so by date) in each
+#   strings   count, count + 1 end offsets, then the UTF-8 text
+#
+# What a row cannot hold exactly (a non-numeric AQI, pollutant values that
+# are not floats, any other keys) goes into "extras", a JSON object laid
+# over the decoded record, so sealing and unsealing round-trip every record.
+MAGIC = b"AQSEG\x00\r\n"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIQQQQ")
+ROW = "<iIIIIId"
+REGION = struct.Struct("<III")
+U32 = struct.Struct("<I")
+I32 = struct.Struct("<i")
+NONE = 0xFFFFFFFF
+
+# Row flags.
+AQI_INT = 1          # AQI was an int
+NO_AQI = 2           # AQI is not in the row (absent, or kept in extras)
+NO_POLLUTANTS = 4    # likewise for the pollutants mapping
+
+CORE = ("record_id", "region", "date", "AQI", "pollutants", "health_risk")
+SEGMENT_NAME = re.compile(r"^air-(\d{4}-\d{2})\.seg$")
+
+# Per-segment summaries (see summarize()), keyed by month and stamped with
+# the segment file's signature, so reports never have to decode sealed rows.
+CATALOG_FILE = "catalog.json"
+
+
+def segment_dir():
+    return os.path.join(utils.DATA_DIR, "segments")
+
+
+def segment_path(month):
+    return os.path.join(segment_dir(), f"air-{month}.seg")
+
+
+def catalog_path():
+    return os.path.join(segment_dir(), CATALOG_FILE)
+
+
+def ordinal(date):
+    # Only dates in canonical YYYY-MM-DD form, so they decode unchanged.
+    try:
+        d = datetime.date.fromisoformat(date)
+    except (TypeError, ValueError):
+        return None
+    return d.toordinal() if d.isoformat() == date else None
+
+
+def sealable(rec):
+    return (type(rec.get("record_id")) is str and type(rec.get("region")) is str
+            and ordinal(rec.get("date")) is not None)
+
+
+def _exact_pollutants(pols):
+    return isinstance(pols, dict) and all(
+        type(k) is str and type(v) is float and not math.isnan(v) for k, v in pols.items())
+
+
+def encode(records):
+    """The bytes of a segment holding records, which must all be sealable()."""
+    strings = {}
+
+    def intern(s):
+        i = strings.get(s)
+        if i is None:
+            i = strings[s] = len(strings)
+        return i
+
+    records = sorted(records, key=lambda r: r["date"])
+    columns = {}
+    for rec in records:
+        if _exact_pollutants(rec.get("pollutants")):
+            for name in rec["pollutants"]:
+                columns.setdefault(name, len(columns))
+    row = struct.Struct(ROW + "d" * len(columns))
+    rows = bytearray(row.size * len(records))
+    postings = {}
+    for n, rec in enumerate(records):
+        extras = {k: v for k, v in rec.items() if k not in CORE}
+        flags = 0
+        aqi = rec.get("AQI")
+        if type(aqi) is int and abs(aqi) <= 2 ** 53:
+            flags |= AQI_INT
+        elif type(aqi) is not float or math.isnan(aqi):
+            flags |= NO_AQI
+            if "AQI" in rec:
+                extras["AQI"] = aqi
+            aqi = math.nan
+        values = [math.nan] * len(columns)
+        pols = rec.get("pollutants")
+        if _exact_pollutants(pols):
+            for name, v in pols.items():
+                values[columns[name]] = v
+        else:
+            flags |= NO_POLLUTANTS
+            if "pollutants" in rec:
+                extras["pollutants"] = pols
+        risk = rec.get("health_risk")
+        if type(risk) is str:
+            risk = intern(risk)
+        else:
+            if "health_risk" in rec:
+                extras["health_risk"] = risk
+            risk = NONE
+        extra = intern(json.dumps(extras, default=str)) if extras else NONE
+        row.pack_into(rows, n * row.size, ordinal(rec["date"]), intern(rec["region"]),
+                      intern(rec["record_id"]), risk, extra, flags, float(aqi), *values)
+        postings.setdefault(region_key(rec["region"]), []).append(n)
+    head = [intern(name) for name in columns]
+    regions = bytearray()
+    post = []
+    for fold in sorted(postings):
+        regions += REGION.pack(intern(fold), len(post), len(postings[fold]))
+        post.extend(postings[fold])
+    blobs = [s.encode("utf-8") for s in strings]
+    ends, total = [0], 0
+    for b in blobs:
+        total += len(b)
+        ends.append(total)
+    table = struct.pack(f"<I{len(ends)}I", len(blobs), *ends) + b"".join(blobs)
+    rows_at = HEADER.size + 4 * len(head)
+    regions_at = rows_at + len(rows)
+    postings_at = regions_at + len(regions)
+    strings_at = postings_at + 4 * len(post)
+    return b"".join([
+        HEADER.pack(MAGIC, VERSION, len(records), len(columns), len(postings),
+                    rows_at, regions_at, postings_at, strings_at),
+        struct.pack(f"<{len(head)}I", *head), bytes(rows), bytes(regions),
+        struct.pack(f"<{len(post)}I", *post), table,
+    ])
+
+
+def _bisect(n, key_at, target):
+    # First i in [0, n) with key_at(i) >= target; key_at must be ascending.
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key_at(mid) < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class Segment:
+    """One sealed month, read through mmap.
+
+    Opening reads only the header, the pollutant names and the region
+    directory; rows and strings are decoded on demand, so a date or region
+    query touches just the pages holding its rows, and processes reading the
+    same segment share them in the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        m = SEGMENT_NAME.match(os.path.basename(path))
+        self.month = m.group(1) if m else None
+        self.signature = None
+        self.summary = None
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, self.size, npol, nregions,
+             self.rows_at, regions_at, postings_at, strings_at) = HEADER.unpack_from(self.buf, 0)
+        except struct.error:
+            magic = version = None
+        if magic != MAGIC or version != VERSION:
+            self.buf.close()
+            raise ValueError(f"{path} is not an air segment")
+        self.row = struct.Struct(ROW + "d" * npol)
+        self.strings_at = strings_at + 4
+        self.text_at = self.strings_at + 4 * (U32.unpack_from(self.buf, strings_at)[0] + 1)
+        self._strings = {}
+        self.columns = [self.string(i) for i in struct.unpack_from(f"<{npol}I", self.buf, HEADER.size)]
+        self.regions = {}
+        for i in range(nregions):
+            fold, first, count = REGION.unpack_from(self.buf, regions_at + i * REGION.size)
+            self.regions[self.string(fold)] = (postings_at + 4 * first, count)
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        self.buf.close()
+
+    def string(self, i):
+        s = self._strings.get(i)
+        if s is None:
+            start, end = struct.unpack_from("<II", self.buf, self.strings_at + 4 * i)
+            s = self._strings[i] = self.buf[self.text_at + start:self.text_at + end].decode("utf-8")
+        return s
+
+    def _date(self, n):
+        return I32.unpack_from(self.buf, self.rows_at + n * self.row.size)[0]
+
+    def record(self, n):
+        date, region, rid, risk, extra, flags, aqi, *values = self.row.unpack_from(
+            self.buf, self.rows_at + n * self.row.size)
+        rec = {"record_id": self.string(rid), "region": self.string(region),
+               "date": datetime.date.fromordinal(date).isoformat()}
+        if not flags & NO_AQI:
+            rec["AQI"] = int(aqi) if flags & AQI_INT else aqi
+        if not flags & NO_POLLUTANTS:
+            rec["pollutants"] = {name: v for name, v in zip(self.columns, values) if not math.isnan(v)}
+        if risk != NONE:
+            rec["health_risk"] = self.string(risk)
+        if extra != NONE:
+            rec.update(json.loads(self.string(extra)))
+        return rec
+
+    def records(self):
+        return [self.record(n) for n in range(self.size)]
+
+    def between(self, start=None, end=None):
+        """Records dated start..end inclusive (YYYY-MM-DD; None = open)."""
+        lo = _bisect(self.size, self._date, ordinal(start)) if start else 0
+        hi = _bisect(self.size, self._date, ordinal(end) + 1) if end else self.size
+        return [self.record(n) for n in range(lo, hi)]
+
+    def for_region(self, region, start=None, end=None):
+        at, count = self.regions.get(region_key(region), (0, 0))
+
+        def row_at(i):
+            return U32.unpack_from(self.buf, at + 4 * i)[0]
+
+        def date_at(i):
+            return self._date(row_at(i))
+
+        lo = _bisect(count, date_at, ordinal(start)) if start else 0
+        hi = _bisect(count, date_at, ordinal(end) + 1) if end else count
+        return [self.record(row_at(i)) for i in range(lo, hi)]
+
+    def with_pollutant(self, name):
+        # Reads only the flags and the one column, then decodes the matches.
+        col = self.columns.index(name) if name in self.columns else None
+        fields = struct.Struct("<20xI8x" + ("" if col is None else "8x" * col + "d"))
+        out = []
+        for n in range(self.size):
+            flags, *value = fields.unpack_from(self.buf, self.rows_at + n * self.row.size)
+            if flags & NO_POLLUTANTS:
+                rec = self.record(n)
+                if isinstance(rec.get("pollutants"), dict) and name in rec["pollutants"]:
+                    out.append(rec)
+            elif value and not math.isnan(value[0]):
+                out.append(self.record(n))
+        return out
+
+
+_open = {}
+
+
+def _months():
+    try:
+        names = os.listdir(segment_dir())
+    except OSError:
+        return []
+    return sorted(m.group(1) for m in map(SEGMENT_NAME.match, names) if m)
+
+
+def catalog(start=None, end=None):
+    """Open segments in month order, only those overlapping start..end.
+
+    Segments stay mapped between calls and are reopened when their file
+    changes.
+    """
+    months = _months()
+    live = {segment_path(m) for m in months}
+    for path in [p for p in _open if os.path.dirname(p) == segment_dir() and p not in live]:
+        del _open[path]
+    out = []
+    for month in months:
+        if (start and month < start[:7]) or (end and month > end[:7]):
+            continue
+        path = segment_path(month)
+        sig = repository.file_signature(path)
+        cached = _open.get(path)
+        if cached is None or cached[0] != sig:
+            try:
+                cached = _open[path] = (sig, Segment(path))
+            except FileNotFoundError:
+                continue
+            cached[1].signature = list(sig[0])
+        out.append(cached[1])
+    return out
+
+
+def summarize(records):
+    """What the reports and latest lookups need from a month of readings.
+
+    regions: [count, AQI sum] per region name, as the top-regions report
+    groups them; folds: the same per case-folded region, for the monthly
+    trend; peaks: the highest level of each pollutant per region name;
+    latest: the latest reading per case-folded region (on equal dates the
+    earlier one, as in the live store).
+    """
+    regions, folds, peaks, latest = {}, {}, {}, {}
+    for rec in records:
+        region = rec["region"]
+        fold = region_key(region)
+        aqi = utils.safe_float(rec.get("AQI", 0))
+        for table, key in ((regions, region), (folds, fold)):
+            cell = table.setdefault(key, [0, 0.0])
+            cell[0] += 1
+            cell[1] += aqi
+        peak = peaks.setdefault(region, {})
+        pols = rec.get("pollutants")
+        for name, val in (pols.items() if isinstance(pols, dict) else ()):
+            val = utils.safe_float(val, None)
+            if val is not None and not math.isnan(val) and (name not in peak or val > peak[name]):
+                peak[name] = val
+        cur = latest.get(fold)
+        if cur is None or rec["date"] > cur["date"]:
+            latest[fold] = rec
+    return {"regions": regions, "folds": folds, "peaks": peaks, "latest": latest}
+
+
+def _read_catalog():
+    try:
+        with open(catalog_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_catalog(entries):
+    try:
+        storage.atomic_write(catalog_path(), json.dumps(entries, separators=(",", ":")))
+    except OSError:
+        pass  # a read-only data dir: summaries are recomputed next time
+
+
+def summarized(start=None, end=None):
+    """catalog(start, end), with each segment's summary filled in.
+
+    Summaries come from the catalog file; one whose segment has changed or
+    is missing is recomputed from the rows and saved back.
+    """
+    segs = catalog(start, end)
+    missing = [seg for seg in segs if seg.summary is None]
+    if missing:
+        entries = _read_catalog()
+        changed = False
+        for seg in missing:
+            entry = entries.get(seg.month)
+            if entry is None or entry.get("signature") != seg.signature:
+                entry = entries[seg.month] = {"signature": seg.signature, "summary": summarize(seg.records())}
+                changed = True
+            seg.summary = entry["summary"]
+        if changed:
+            months = set(_months())
+            _write_catalog({m: e for m, e in entries.items() if m in months})
+    return segs
+
+
+def version():
+    # Changes whenever a segment is written or removed.
+    months = _months()
+    return [[m, *sig] for m, sig in zip(months, repository.file_signature(*map(segment_path, months))) if sig]
+
+
+def between(start=None, end=None):
+    return metrics.scanned([rec for seg in catalog(start, end) for rec in seg.between(start, end)])
+
+
+def on_date(date):
+    return between(date, date) if ordinal(date) is not None else []
+
+
+def for_region(region, start=None, end=None):
+    return metrics.scanned([rec for seg in catalog(start, end) for rec in seg.for_region(region, start, end)])
+
+
+def with_pollutant(name):
+    # every row's flags and value are read, matching or not
+    segs = catalog()
+    metrics.scanned(sum(len(seg) for seg in segs))
+    return [rec for seg in segs for rec in seg.with_pollutant(name)]
+
+
+def records():
+    return [rec for seg in catalog() for rec in seg.records()]
+
+
+# Sealed counterparts of the citizen searches (see citizen.SEARCHES).
+SEARCHES = {"date": on_date, "region": for_region, "pollutant": with_pollutant}
+
+
+def merge(live, sealed):
+    """sealed + live, dropping sealed copies of readings that are also live.
+
+    A reading is in both only if seal() or unseal() stopped halfway; the
+    live copy is the current one.
+    """
+    if not sealed:
+        return live
+    ids = {r.get("record_id") for r in live}
+    return [r for r in sealed if r["record_id"] not in ids] + list(live)
+
+
+def _month_range(month):
+    return f"{month}-01", f"{month}-31"
+
+
+def _seal(month, live):
+    path = segment_path(month)
+    merged = {}
+    try:
+        seg = Segment(path)
+    except FileNotFoundError:
+        pass
+    else:
+        for rec in seg.records():
+            merged[rec["record_id"]] = rec
+        seg.close()
+    for rec in live:
+        merged[rec["record_id"]] = rec
+    os.makedirs(segment_dir(), exist_ok=True)
+    storage.atomic_write(path, encode(merged.values()))
+    entries = _read_catalog()
+    sig = repository.file_signature(path)[0]
+    if sig is not None:
+        entries[month] = {"signature": list(sig), "summary": summarize(
+            sorted(merged.values(), key=lambda r: r["date"]))}
+        _write_catalog(entries)
+    utils.delete_records("air", [r["record_id"] for r in live])
+    return len(live)
+
+
+def seal(month):
+    """Move month's (YYYY-MM) air readings from the live store to its segment.
+
+    Readings already sealed for the month are kept, and replaced by a live
+    reading with the same record_id. The segment is written before the
+    readings are deleted, so a crash in between leaves duplicates that
+    merge() hides and the next seal() removes. Readings without a canonical
+    date, a region or a record_id stay live. Returns the number moved.
+    """
+    utils.ensure_data_dir()
+    with utils.get_store("air").locked():
+        live = [r for r in utils.get_backend().records_between(*_month_range(month)) if sealable(r)]
+        return _seal(month, live) if live else 0
+
+
+def seal_before(month=None):
+    """Seal every month before month (default: the current one)."""
+    utils.ensure_data_dir()
+    month = month or datetime.date.today().isoformat()[:7]
+    last = (datetime.date.fromisoformat(f"{month}-01") - datetime.timedelta(days=1)).isoformat()
+    with utils.get_store("air").locked():
+        months = {}
+        for rec in utils.get_backend().records_between("0001-01-01", last):
+            if sealable(rec):
+                months.setdefault(rec["date"][:7], []).append(rec)
+        return {m: _seal(m, months[m]) for m in sorted(months)}
+
+
+def unseal(month):
+    """Move a sealed month back into the live store; returns the count."""
+    utils.ensure_data_dir()
+    path = segment_path(month)
+    with utils.get_store("air").locked():
+        try:
+            seg = Segment(path)
+        except FileNotFoundError:
+            return 0
+        sealed = seg.records()
+        seg.close()
+        # live copies are newer than the sealed ones
+        ids = {r.get("record_id") for r in utils.get_backend().records_between(*_month_range(month))}
+        utils.insert_records("air", [r for r in sealed if r["record_id"] not in ids])
+        os.remove(path)
+        storage.fsync_dir(path)
+        _open.pop(path, None)
+    return len(sealed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Binary monthly segments of historical air readings.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("seal", help="move whole months of readings into segments")
+    p.add_argument("--month", help="seal only this month (YYYY-MM)")
+    p.add_argument("--before", help="seal every month before this one (default: the current month)")
+    p = sub.add_parser("unseal", help="move sealed months back into the live store")
+    p.add_argument("month", nargs="*", help="YYYY-MM (default: every sealed month)")
+    sub.add_parser("list", help="sealed months with their size")
+    p = sub.add_parser("query", help="sealed readings by date range and/or region, as JSON lines")
+    p.add_argument("--start")
+    p.add_argument("--end")
+    p.add_argument("--region")
+    args = parser.parse_args(argv)
+    if args.command == "seal":
+        print(json.dumps({args.month: seal(args.month)} if args.month else seal_before(args.before)))
+    elif args.command == "unseal":
+        print(json.dumps({m: unseal(m) for m in args.month or _months()}))
+    elif args.command == "list":
+        rows = [[s.month, len(s), len(s.regions), os.path.getsize(s.path)] for s in catalog()]
+        utils.print_table(rows, headers=["Month", "Readings", "Regions", "Bytes"])
+    else:
+        found = for_region(args.region, args.start, args.end) if args.region else between(args.start, args.end)
+        for rec in found:
+            print(json.dumps(rec))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,345 @@
+import os
+import json
+import mmap
+import threading
+import contextlib
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The log is folded back into the snapshot once it grows past this many bytes
+# or past this fraction of the snapshot size, whichever is larger.
+COMPACT_MIN_BYTES = 1 << 20
+COMPACT_RATIO = 0.5
+
+# Snapshots are written with indent=2, so every top-level record, and only
+# those, starts a line with two spaces and a brace: json.dumps escapes the
+# newlines inside strings.
+RECORD_START = b"\n  {"
+
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False):
+    """Advisory fcntl lock on path, re-entrant within a process.
+
+    Nested acquisitions by the same thread reuse the lock already held, so a
+    transaction can call code that locks again. Without fcntl (Windows) only
+    the in-process lock is taken.
+    """
+    with _locks_guard:
+        state = _locks.get(path)
+        if state is None:
+            state = _locks[path] = {"mutex": threading.RLock(), "fd": None, "depth": 0, "shared": False}
+    with state["mutex"]:
+        if fcntl is not None:
+            if state["depth"] == 0:
+                state["fd"] = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(state["fd"], fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                state["shared"] = shared
+            elif state["shared"] and not shared:
+                fcntl.flock(state["fd"], fcntl.LOCK_EX)
+                state["shared"] = False
+        state["depth"] += 1
+        try:
+            yield
+        finally:
+            state["depth"] -= 1
+            if state["depth"] == 0 and state["fd"] is not None:
+                fcntl.flock(state["fd"], fcntl.LOCK_UN)
+                os.close(state["fd"])
+                state["fd"] = None
+
+
+def fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, text):
+    # Write to a temp file beside path, fsync it, then rename it into place:
+    # readers and crashes see either the old file or the new one, never half.
+    tmp = f"{path}.{os.getpid()}.tmp"
+    binary = isinstance(text, bytes)
+    with open(tmp, "wb" if binary else "w", encoding=None if binary else "utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(path)
+
+
+class RecordLog:
+    """A JSON snapshot plus an append-only JSON-lines log of put/del entries.
+
+    Writes only append to the log, so they cost O(1) regardless of how many
+    records the snapshot holds. Reads replay the log over the snapshot, and
+    compact() folds everything back into a fresh snapshot.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.log_path = os.path.splitext(path)[0] + ".log"
+        self.lock_path = os.path.splitext(path)[0] + ".lock"
+        self.key = key
+
+    def locked(self, shared=False):
+        return file_lock(self.lock_path, shared)
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r", encoding="utf-8") as f:
+            text = f.read()
+            if metrics.ENABLED:
+                metrics.add("bytes_read_total", os.fstat(f.fileno()).st_size, file=os.path.basename(self.path))
+        if not text.strip():
+            return []
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            # Refuse to treat a damaged file as empty: callers would go on to
+            # overwrite it.
+            raise ValueError(f"{self.path} is not valid JSON ({e})") from None
+
+    def _read_log(self):
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            if metrics.ENABLED:
+                metrics.add("bytes_read_total", os.fstat(f.fileno()).st_size, file=os.path.basename(self.log_path))
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # a torn trailing line from an interrupted append
+                    continue
+
+    def load(self):
+        with self.locked(shared=True):
+            return self._load()
+
+    def _load(self):
+        records = self._read_snapshot()
+        if not isinstance(records, list) or not os.path.exists(self.log_path):
+            return records
+        pos = {r.get(self.key): i for i, r in enumerate(records)}
+        for entry in self._read_log():
+            if entry.get("op") == "put":
+                rec = entry["rec"]
+                k = rec.get(self.key)
+                if k in pos:
+                    records[pos[k]] = rec
+                else:
+                    pos[k] = len(records)
+                    records.append(rec)
+            elif entry.get("op") == "del":
+                i = pos.pop(entry.get("id"), None)
+                if i is not None:
+                    records[i] = None
+        return [r for r in records if r is not None]
+
+    def append(self, entries):
+        lines = "".join(json.dumps(e, default=str) + "\n" for e in entries)
+        if not lines:
+            return
+        with self.locked():
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        if metrics.ENABLED:
+            # json.dumps escapes non-ASCII, so characters are bytes here
+            metrics.add("bytes_written_total", len(lines), file=os.path.basename(self.log_path))
+
+    def put(self, records):
+        self.append({"op": "put", "rec": r} for r in records)
+
+    def delete(self, keys):
+        self.append({"op": "del", "id": k} for k in keys)
+
+    def log_size(self):
+        try:
+            return os.path.getsize(self.log_path)
+        except OSError:
+            return 0
+
+    def snapshot_signature(self):
+        """[inode, size, mtime_ns] of the snapshot; changes on every compaction."""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def read_log_from(self, offset):
+        """(entries appended at or after byte offset, offset of the end).
+
+        A torn trailing line is left for the next read.
+        """
+        try:
+            with open(self.log_path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except OSError:
+            return [], offset
+        data = data[:data.rfind(b"\n") + 1]
+        entries = []
+        for line in data.splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries, offset + len(data)
+
+    def snapshot_from(self, key_value):
+        """The snapshot's records from the last one with key_value to the end,
+        read without parsing the records before it; None if it is not found
+        (or the snapshot is not in the layout compact() writes)."""
+        data = self._mapped()
+        if data is None:
+            return None
+        with data:
+            needle = json.dumps(self.key).encode() + b": " + json.dumps(key_value).encode()
+            at = data.rfind(needle)
+            start = data.rfind(RECORD_START, 0, at) if at >= 0 else -1
+            if start < 0:
+                return None
+            try:
+                records = json.loads(b"[" + data[start + 1:])
+            except ValueError:
+                return None
+        # the id may have matched inside a later record's fields
+        if not records or records[0].get(self.key) != key_value:
+            return None
+        return records
+
+    def _mapped(self):
+        # The snapshot memory-mapped, or None if it is missing or empty.
+        try:
+            with open(self.path, "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+    def slices(self, size):
+        """Byte ranges of the snapshot of about size bytes, each a run of
+        whole records, for readers that split the parsing (see read_slice).
+        None if the snapshot is not in the layout compact() writes."""
+        data = self._mapped()
+        if data is None:
+            return []
+        with data:
+            if data[:16].strip() == b"[]":
+                return []
+            end = data.rfind(b"\n]")
+            if data[:5] != b"[" + RECORD_START or end < 0 or data[end + 2:].strip():
+                return None
+            bounds = [1]
+            while bounds[-1] + size < end:
+                at = data.find(RECORD_START, bounds[-1] + size, end)
+                if at < 0:
+                    break
+                bounds.append(at)
+            bounds.append(end)
+        return list(zip(bounds, bounds[1:]))
+
+    def read_slice(self, start, end):
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            chunk = f.read(end - start)
+        return json.loads(b"[" + chunk.rstrip().rstrip(b",") + b"]")
+
+    def replay(self, records, entries):
+        """Apply the log entries to records from one slice of the snapshot as
+        _load() would; returns (records, keys the log touched)."""
+        final, gone = {}, set()
+        for entry in entries:
+            if entry.get("op") == "put":
+                k = entry["rec"].get(self.key)
+                if k not in gone:
+                    final[k] = entry["rec"]
+            elif entry.get("op") == "del":
+                # a later put of the key goes to the end, not back here
+                gone.add(entry.get("id"))
+                final[entry.get("id")] = None
+        out, touched = [], set()
+        for rec in records:
+            k = rec.get(self.key)
+            if k in final:
+                touched.add(k)
+                rec = final[k]
+            if rec is not None:
+                out.append(rec)
+        return out, touched
+
+    def appended(self, entries, in_snapshot):
+        """The records the log adds after the snapshot's, in _load() order,
+        given the snapshot keys it touches (see replay())."""
+        pos = dict.fromkeys(in_snapshot, -1)
+        added = []
+        for entry in entries:
+            if entry.get("op") == "put":
+                rec = entry["rec"]
+                k = rec.get(self.key)
+                i = pos.get(k)
+                if i is None:
+                    pos[k] = len(added)
+                    added.append(rec)
+                elif i >= 0:
+                    added[i] = rec
+            elif entry.get("op") == "del":
+                i = pos.pop(entry.get("id"), None)
+                if i is not None and i >= 0:
+                    added[i] = None
+        return [r for r in added if r is not None]
+
+    def is_blank(self):
+        # No records, judged by size alone: the smallest non-empty list,
+        # "[{}]", is four bytes.
+        try:
+            snap = os.path.getsize(self.path)
+        except OSError:
+            snap = 0
+        return snap < 4 and not self.log_size()
+
+    def needs_compaction(self):
+        size = self.log_size()
+        if not size:
+            return False
+        try:
+            snap = os.path.getsize(self.path)
+        except OSError:
+            snap = 0
+        return size > max(COMPACT_MIN_BYTES, snap * COMPACT_RATIO)
+
+    def compact(self, records=None):
+        with self.locked():
+            if records is None:
+                records = self._load()
+            text = json.dumps(records, indent=2, default=str)
+            atomic_write(self.path, text)
+            if metrics.ENABLED:
+                metrics.add("bytes_written_total", len(text), file=os.path.basename(self.path))
+            # Dropping the log only after the snapshot is in place keeps a
+            # crash in between harmless: replaying puts and dels is idempotent.
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+        return records
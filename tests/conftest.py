@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def data_dir(request, tmp_path, monkeypatch):
+    """An empty data directory, on each storage backend."""
+    monkeypatch.setattr(utils, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(utils, "BACKEND", request.param)
+    monkeypatch.setattr(utils, "_backend", None)
+    monkeypatch.setattr(utils, "_ensured_dir", None)
+    utils.repo.invalidate()
+    yield str(tmp_path)
+    utils.repo.invalidate()
@@ -0,0 +1,70 @@
+import io
+import json
+import asyncio
+import contextlib
+
+import utils
+import api
+
+
+async def request(port, method, target, headers=()):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    lines = [f"{method} {target} HTTP/1.1", "Host: test", "Connection: close", *headers]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+    raw = await reader.read()
+    writer.close()
+    head, _, body = raw.partition(b"\r\n\r\n")
+    status_line, *fields = head.decode("latin-1").split("\r\n")
+    found = dict(f.split(": ", 1) for f in fields)
+    return int(status_line.split()[1]), found, body
+
+
+def serve(script):
+    async def main():
+        server = await api.start("127.0.0.1", 0, interval=0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await script(port)
+    return asyncio.run(main())
+
+
+def seed():
+    with contextlib.redirect_stdout(io.StringIO()):
+        utils.create_sample_data()
+
+
+def test_etag_and_not_modified(data_dir):
+    seed()
+
+    async def script(port):
+        status, headers, body = await request(port, "GET", "/aqi/latest")
+        assert status == 200 and json.loads(body)
+        etag = headers["ETag"]
+        status, headers, body = await request(port, "GET", "/aqi/latest", [f"If-None-Match: {etag}"])
+        assert (status, body, headers["ETag"]) == (304, b"", etag)
+        status, _, body = await request(port, "GET", "/aqi/latest", ['If-None-Match: "other"'])
+        assert status == 200 and body
+        status, headers, body = await request(port, "HEAD", "/aqi/latest")
+        assert status == 200 and body == b"" and int(headers["Content-Length"]) > 0
+        # a write changes the dataset version, and with it the body and ETag
+        rec = utils.sample_air_record("Delhi", "2099-01-01")
+        utils.insert_record("air", rec)
+        status, headers, body = await request(port, "GET", "/aqi/latest", [f"If-None-Match: {etag}"])
+        assert status == 200 and headers["ETag"] != etag
+        assert rec["record_id"] in {r["record_id"] for r in json.loads(body)}
+
+    serve(script)
+
+
+def test_errors(data_dir):
+    seed()
+
+    async def script(port):
+        assert (await request(port, "GET", "/nowhere"))[0] == 404
+        assert (await request(port, "GET", "/aqi/current"))[0] == 400
+        assert (await request(port, "GET", "/aqi/current?region=Atlantis"))[0] == 404
+        status, headers, _ = await request(port, "POST", "/aqi/latest")
+        assert status == 405 and headers["Allow"] == "GET, HEAD"
+
+    serve(script)
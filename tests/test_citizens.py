@@ -0,0 +1,26 @@
+import utils
+import citizen
+
+
+def register(stem, contact):
+    rec = {"name": stem, "location": "Delhi", "contact": contact}
+    return utils.get_backend().register_citizen(rec, stem)
+
+
+def test_namesakes_get_the_next_free_suffix(data_dir):
+    utils.ensure_data_dir()
+    assert [register("alice", str(n)) for n in range(4)] == ["alice", "alice_2", "alice_3", "alice_4"]
+    assert register("Alice", "x") == "Alice_5"
+    # LIKE wildcards in a stem are taken literally
+    assert register("al_ce", "y") == "al_ce"
+    assert register("al%", "z") == "al%"
+
+
+def test_lookup_ignores_case(data_dir):
+    utils.ensure_data_dir()
+    register("alice", "a@example.com")
+    register("alice", "b@example.com")
+    assert citizen.lookup("ALICE_2")["contact"] == "b@example.com"
+    assert citizen.lookup("Alice")["contact"] == "a@example.com"
+    assert citizen.lookup("A@Example.com")["citizen_id"] == "alice"
+    assert citizen.lookup("bob") is None
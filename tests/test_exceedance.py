@@ -0,0 +1,46 @@
+import io
+import random
+import contextlib
+
+import pytest
+
+import utils
+import exceedance
+
+
+def seed(n=300):
+    rng = random.Random(9)
+    with contextlib.redirect_stdout(io.StringIO()):
+        utils.create_sample_data()
+    records = [utils.sample_air_record(rng.choice(["Delhi", "Pune", "Agra"]), f"2025-01-{rng.randint(1, 28):02d}", rng)
+               for _ in range(n)]
+    utils.get_backend().save("air", records)
+    return records
+
+
+def by_loop(records):
+    found = {}
+    exceedance._scan_loop(records, exceedance.limits(), found)
+    return found
+
+
+def rounded(found):
+    return {k: {n: round(v, 3) for n, v in hit["exceeded"].items()} for k, hit in found.items()}
+
+
+@pytest.mark.skipif(exceedance.np is None, reason="needs numpy")
+def test_scans_agree_with_the_loop(data_dir):
+    records = seed()
+    assert rounded(exceedance.scan(records, everything=True)) == rounded(by_loop(records))
+    new = utils.load_json("air")[-40:]
+    # air is in memory now: the new records are read from its columns
+    assert exceedance._column_rows(new, False) is not None or utils.BACKEND == "sqlite"
+    assert rounded(exceedance.scan(new)) == rounded(by_loop(new))
+
+
+@pytest.mark.skipif(exceedance.np is None, reason="needs numpy")
+def test_cold_incremental_scan_does_not_load_air(data_dir):
+    records = seed()
+    utils.repo.invalidate()
+    assert exceedance._column_rows(records[:5], False) is None
+    assert utils.repo.peek("air") is None
@@ -0,0 +1,72 @@
+import random
+import datetime
+
+from indexes import AlertIndex, alert_interval, region_key, OPEN_ENDED
+
+
+def alert(aid, region, issue, expiry, status="active"):
+    return {"alert_id": aid, "region": region, "issue_date": issue, "expiry_date": expiry,
+            "status": status, "AQI_level": "Poor"}
+
+
+def brute_in_force(records, day, region=None):
+    hits = []
+    for seq, rec in enumerate(records):
+        start, end = alert_interval(rec)
+        if rec.get("status") != "active" or not start <= day <= end:
+            continue
+        if region is None or region_key(rec.get("region")) == region_key(region):
+            hits.append((start, seq, rec))
+    return [rec for _, _, rec in sorted(hits, key=lambda h: (h[0], h[1]))]
+
+
+def brute_expired(records, before):
+    ends = [(alert_interval(r)[1], seq, r) for seq, r in enumerate(records)]
+    return [r for end, _, r in sorted(ends, key=lambda e: e[:2]) if end != OPEN_ENDED and end < before]
+
+
+def test_duplicate_ids_keep_the_last_record():
+    records = [alert("a1", "Delhi", "2025-01-01", "2025-01-10"),
+               alert("a2", "Delhi", "2025-01-03", "2025-01-05"),
+               alert("a1", "Delhi", "2025-01-02", "2025-01-04")]
+    index = AlertIndex(records)
+    assert len(index) == 2
+    assert index.get("a1") is records[2]
+    assert index.in_force("2025-01-08") == []
+    assert index.expired("2025-01-06") == [records[2], records[1]]
+    index.delete("a1")
+    index.delete("a2")
+    assert len(index) == 0
+    assert index.expired("9999-01-01") == []
+
+
+def test_matches_a_scan_through_writes_and_deletes():
+    rng = random.Random(11)
+    base = datetime.date(2025, 1, 1)
+
+    def day(n):
+        return (base + datetime.timedelta(days=n)).isoformat()
+
+    def random_alert(aid):
+        start = rng.randint(0, 40)
+        expiry = rng.choice([day(start + rng.randint(-2, 10)), "", "not a date"])
+        return alert(aid, rng.choice(["Delhi", "delhi", "Pune"]), day(start), expiry,
+                     rng.choice(["active", "active", "archived"]))
+
+    records = [random_alert(f"a{rng.randint(0, 30)}") for _ in range(60)]
+    index = AlertIndex(records)
+    # a repeated id keeps the place of its first record, as on load
+    live = {rec["alert_id"]: rec for rec in records}
+    for step in range(200):
+        if rng.random() < 0.3 and live:
+            aid = rng.choice(sorted(live))
+            index.delete(aid)
+            del live[aid]
+        else:
+            rec = random_alert(f"a{rng.randint(0, 30)}")
+            index.put(rec)
+            live[rec["alert_id"]] = rec
+        d = day(rng.randint(-2, 50))
+        region = rng.choice([None, "DELHI", "Pune"])
+        assert index.in_force(d, region) == brute_in_force(list(live.values()), d, region)
+        assert index.expired(d) == brute_expired(list(live.values()), d)
@@ -0,0 +1,87 @@
+import io
+import json
+import contextlib
+
+import utils
+import ingest
+
+
+def seed():
+    with contextlib.redirect_stdout(io.StringIO()):
+        utils.create_sample_data()
+    utils.get_backend().save("air", [])
+
+
+def write_rows(path, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+    return str(path)
+
+
+def row(region, date, aqi, **extra):
+    return dict({"region": region, "date": date, "AQI": aqi, "PM2.5": aqi / 2}, **extra)
+
+
+def stored():
+    return sorted((r["region"], r["date"], r["AQI"]) for r in utils.load_json("air"))
+
+
+def import_rows(tmp_path, name, rows):
+    return ingest.import_file(write_rows(tmp_path / name, rows), progress=None, dedup=True)
+
+
+def accepted(stats):
+    return stats["rows"] - stats["rejected"]
+
+
+def test_reimport_changes_nothing(data_dir, tmp_path):
+    seed()
+    rows = [row("Delhi", "2025-01-01", 100), row("Pune", "2025-01-01", 80), row("", "2025-01-01", 1)]
+    first = import_rows(tmp_path, "a.jsonl", rows)
+    assert (first["inserted"], first["updated"], first["skipped"], first["imported"]) == (2, 0, 0, 2)
+    second = import_rows(tmp_path, "b.jsonl", rows)
+    assert (second["inserted"], second["updated"], second["skipped"], second["imported"]) == (0, 0, 2, 0)
+    assert stored() == [("Delhi", "2025-01-01", 100), ("Pune", "2025-01-01", 80)]
+
+
+def test_counts_add_up_with_repeated_keys_in_a_batch(data_dir, tmp_path):
+    seed()
+    import_rows(tmp_path, "a.jsonl", [row("Delhi", "2025-01-01", 100)])
+    stats = import_rows(tmp_path, "b.jsonl", [row("Delhi", "2025-01-01", 110), row("delhi", "2025-01-01", 120),
+                                               row("Pune", "2025-01-02", 50), row("Pune", "2025-01-02", 60)])
+    assert (stats["inserted"], stats["updated"], stats["skipped"]) == (1, 1, 2)
+    assert stats["inserted"] + stats["updated"] + stats["skipped"] == accepted(stats)
+    assert stats["imported"] == stats["inserted"] + stats["updated"]
+    assert stored() == [("Delhi", "2025-01-01", 120), ("Pune", "2025-01-02", 60)]
+
+
+def test_update_keeps_the_stored_spelling(data_dir, tmp_path):
+    seed()
+    import_rows(tmp_path, "a.jsonl", [row("Delhi", "2025-01-01", 100, station="North Gate")])
+    stats = import_rows(tmp_path, "b.jsonl", [row("delhi", "2025-01-01", 130, station="north gate")])
+    assert stats["updated"] == 1
+    [rec] = utils.load_json("air")
+    assert (rec["region"], rec["station"], rec["AQI"]) == ("Delhi", "North Gate", 130)
+    assert [r["AQI"] for r in utils.get_backend().records_for_region("Delhi")] == [130]
+
+
+def test_incoming_record_id_cannot_overwrite_another_reading(data_dir, tmp_path):
+    seed()
+    import_rows(tmp_path, "a.jsonl", [row("Delhi", "2025-01-01", 100)])
+    [delhi] = utils.load_json("air")
+    stats = import_rows(tmp_path, "b.jsonl", [row("Pune", "2025-01-01", 70, record_id=delhi["record_id"])])
+    assert stats["inserted"] == 1
+    assert stored() == [("Delhi", "2025-01-01", 100), ("Pune", "2025-01-01", 70)]
+
+
+def test_import_many_counts_add_up(data_dir, tmp_path):
+    seed()
+    incoming = tmp_path / "incoming"
+    incoming.mkdir()
+    write_rows(incoming / "a.jsonl", [row("Delhi", "2025-01-01", 100), row("Delhi", "2025-01-01", 101)])
+    write_rows(incoming / "b.jsonl", [row("Delhi", "2025-01-01", 101), row("Pune", "2025-01-01", 70)])
+    stats = ingest.import_many(str(incoming), workers=1, progress=None, dedup=True)
+    assert stats["inserted"] + stats["updated"] + stats["skipped"] == stats["rows"] - stats["rejected"] == 4
+    assert stats["imported"] == stats["inserted"] + stats["updated"] == 2
+    assert stored() == [("Delhi", "2025-01-01", 101), ("Pune", "2025-01-01", 70)]
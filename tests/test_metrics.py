@@ -0,0 +1,53 @@
+import io
+import random
+import contextlib
+
+import pytest
+
+import utils
+import admin
+import citizen
+import metrics
+
+
+@pytest.fixture
+def collecting(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def records_total(op):
+    return sum(c["value"] for c in metrics.snapshot()["counters"]
+               if c["name"] == "records_total" and c["labels"].get("op") == op)
+
+
+def seed():
+    rng = random.Random(5)
+    with contextlib.redirect_stdout(io.StringIO()):
+        utils.create_sample_data()
+    records = [utils.sample_air_record(region, f"2025-01-{day:02d}", rng)
+               for region in ("Delhi", "Mumbai", "Pune") for day in range(1, 11)]
+    utils.get_backend().save("air", records)
+    return records
+
+
+def test_search_counts_rows_touched_not_table_size(data_dir, collecting):
+    seed()
+    found = citizen.search("region", "Delhi")
+    assert len(found) == 10
+    assert records_total("search") == 10
+
+
+def test_report_counts_grouped_rows(data_dir, collecting):
+    records = seed()
+    admin.region_averages()
+    # the SQLite GROUP BY reads every row; the JSON aggregates one per region
+    assert records_total("report.region_averages") == (len(records) if utils.BACKEND == "sqlite" else 3)
+
+
+def test_label_values_are_escaped():
+    text = metrics.prometheus({"operations": [], "counters": [
+        {"name": "x_total", "labels": {"region": 'a\\b"c\nd'}, "value": 1}]})
+    assert 'aq_x_total{region="a\\\\b\\"c\\nd"} 1' in text
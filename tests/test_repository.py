@@ -0,0 +1,58 @@
+import os
+
+import storage
+from repository import DataRepository
+
+
+class Counted:
+    built = 0
+
+    def __init__(self, records):
+        Counted.built += 1
+        self.keys = {r["id"] for r in records}
+
+    def put(self, rec):
+        self.keys.add(rec["id"])
+
+    def delete(self, key):
+        self.keys.discard(key)
+
+
+def repo_at(path, max_bytes):
+    repo = DataRepository(lambda name: storage.RecordLog(os.path.join(str(path), name + ".json"), "id"), max_bytes)
+    repo.register_view("big", "ids", Counted)
+    return repo
+
+
+def fill(path, name, n):
+    storage.RecordLog(os.path.join(str(path), name + ".json"), "id").compact([{"id": i} for i in range(n)])
+
+
+def test_dataset_over_budget_keeps_its_views(tmp_path):
+    fill(tmp_path, "big", 200)
+    repo = repo_at(tmp_path, 100)
+    Counted.built = 0
+    for _ in range(3):
+        assert len(repo.view("big", "ids").keys) == 200
+    assert Counted.built == 1
+    # writes are folded into the pinned entry and its views
+    store = storage.RecordLog(os.path.join(str(tmp_path), "big.json"), "id")
+    store.put([{"id": 500}])
+    repo.applied("big", puts=[{"id": 500}], was_current=True)
+    assert 500 in repo.view("big", "ids").keys
+    assert Counted.built == 1
+
+
+def test_growth_through_applied_evicts(tmp_path):
+    fill(tmp_path, "a", 3)
+    fill(tmp_path, "b", 3)
+    size = os.path.getsize(tmp_path / "a.json")
+    repo = repo_at(tmp_path, 2 * size + 10)
+    repo.get("a")
+    repo.get("b")
+    assert repo.peek("a") is not None and repo.peek("b") is not None
+    store = storage.RecordLog(os.path.join(str(tmp_path), "b.json"), "id")
+    store.put([{"id": 100}])
+    repo.applied("b", puts=[{"id": 100}], was_current=True)
+    assert repo.peek("a") is None
+    assert [r["id"] for r in repo.peek("b")] == [0, 1, 2, 100]
@@ -0,0 +1,54 @@
+import io
+import os
+import json
+import random
+import contextlib
+
+import utils
+import rollups
+
+
+def seed(days):
+    rng = random.Random(3)
+    with contextlib.redirect_stdout(io.StringIO()):
+        utils.create_sample_data()
+    # written behind the journal's back, like the shipped sample data
+    utils.get_backend().save("air", [utils.sample_air_record(region, day, rng)
+                                     for region in ("Delhi", "Mumbai") for day in days])
+
+
+def months(region):
+    return [row[0] for row in rollups.trend(region)]
+
+
+def test_trend_builds_missing_tiers(data_dir):
+    seed(["2025-01-05", "2025-01-20"])
+    assert months("Delhi") == ["2025-01"]
+    assert months("mumbai") == ["2025-01"]
+
+
+def test_trend_after_import_covers_every_month(data_dir):
+    seed(["2025-01-05"])
+    rng = random.Random(4)
+    utils.insert_records("air", [utils.sample_air_record("Delhi", "2025-02-01", rng)])
+    assert months("Delhi") == ["2025-01", "2025-02"]
+    assert months("Mumbai") == ["2025-01"]
+
+
+def test_unjournaled_write_rebuilds(data_dir):
+    seed(["2025-01-05"])
+    assert months("Delhi") == ["2025-01"]
+    records = utils.get_backend().load("air")
+    extra = dict(records[0], record_id="extra", date="2025-03-01")
+    utils.get_backend().save("air", records + [extra])
+    assert months("Delhi") == ["2025-01", "2025-03"]
+
+
+def test_missing_region_file_is_recomputed(data_dir):
+    seed(["2025-01-05"])
+    assert months("Delhi") == ["2025-01"]
+    with open(rollups.stamp_path(), encoding="utf-8") as f:
+        assert json.load(f)
+    os.remove(rollups.region_path("delhi"))
+    assert months("Delhi") == ["2025-01"]
+    assert rollups.trend("Nowhere") == []
@@ -1,15 +1,11 @@
 #made by SARTHAK KAUSHIK
 import os
 import json
-import uuid
-import random
 import datetime
-from collections import defaultdict
-
-try:
-    from tabulate import tabulate
-except Exception:
-    tabulate = None
+import storage
+import repository
+import indexes
+import metrics
 
 BASE_DIR = os.path.dirname(__file__)
 DATA_DIR = os.path.join(BASE_DIR, "data")
@@ -19,12 +15,35 @@ FILES = {
     "pollutants": "pollutants.json",
     "alerts": "alerts.json",
     "guidelines": "guidelines.json",
+    "alerts_archive": "alerts_archive.json",
+}
+
+# Primary key of each dataset, used by the append-only record log.
+KEYS = {
+    "air": "record_id",
+    "citizens": "citizen_id",
+    "pollutants": "pollutant_id",
+    "alerts": "alert_id",
+    "guidelines": "guide_id",
+    "alerts_archive": "alert_id",
 }
 
 ADMIN_CREDENTIALS = {"username": "admin", "password": "admin123"}
 
+# Upper bound on the on-disk size of datasets kept parsed in memory.
+CACHE_MAX_BYTES = int(os.environ.get("AQ_CACHE_MB", "512")) * 1024 * 1024
+
+# Storage backend: "json" (data/*.json files) or "sqlite" (data/portal.db).
+BACKEND = os.environ.get("AQ_BACKEND", "json")
+_backend = None
+
+_ensured_dir = None
+
 
 def ensure_data_dir():
+    global _ensured_dir
+    if _ensured_dir == DATA_DIR:
+        return
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
     for fn in FILES.values():
@@ -32,30 +51,162 @@ def ensure_data_dir():
         if not os.path.exists(path):
             with open(path, "w", encoding="utf-8") as f:
                 json.dump([], f, indent=2)
+    _ensured_dir = DATA_DIR
+
+
+def get_store(name):
+    return storage.RecordLog(os.path.join(DATA_DIR, FILES[name]), KEYS[name])
+
+
+repo = repository.DataRepository(get_store, CACHE_MAX_BYTES)
+repo.register_view("air", "index", indexes.AirIndex)
+
+
+def air_index():
+    return repo.view("air", "index")
+
+
+repo.register_view("air", "natural", indexes.NaturalKeyIndex)
+
+
+def air_natural_index():
+    return repo.view("air", "natural")
+
+
+repo.register_view("alerts", "index", indexes.AlertIndex)
+repo.register_view("citizens", "index", indexes.CitizenIndex)
+
+
+def citizen_index():
+    return repo.view("citizens", "index")
+
+
+def alert_index():
+    return repo.view("alerts", "index")
+
+
+def _air_columns(records):
+    import columnar
+    return columnar.AirColumns(records, [p.get("name") for p in load_json("pollutants")])
+
+
+repo.register_view("air", "columns", _air_columns)
+
+
+def _air_aggregates(records):
+    import aggregates
+    return aggregates.AirAggregates(records)
+
+
+repo.register_view("air", "aggregates", _air_aggregates)
+
+
+def air_aggregates():
+    return repo.view("air", "aggregates")
+
+
+def air_columns():
+    # None when NumPy is not installed; callers fall back to plain loops.
+    import columnar
+    if columnar.np is None:
+        return None
+    return repo.view("air", "columns")
 
 
+def get_backend():
+    global _backend
+    if _backend is None or _backend.name != BACKEND:
+        import backends
+        _backend = backends.create(BACKEND)
+    return _backend
+
+
+@metrics.timed("load_json", dataset=True, records=True)
 def load_json(name):
-    ensure_data_dir()
-    path = os.path.join(DATA_DIR, FILES[name])
-    with open(path, "r", encoding="utf-8") as f:
-        try:
-            return json.load(f)
-        except Exception:
-            return []
+    return get_backend().load(name)
 
 
+@metrics.timed("save_json", dataset=True)
 def save_json(name, data):
+    if name == "air":
+        ensure_data_dir()
+        import rollups
+        rollups.replaced()
+    get_backend().save(name, data)
+
+
+def transaction(name):
+    """Read-modify-write a whole dataset under its exclusive lock.
+
+        with utils.transaction("alerts") as alerts:
+            alerts.append(...)
+
+    The data is re-read once the lock is held and saved when the block exits
+    normally; on an exception nothing is written.
+    """
+    if name == "air":
+        ensure_data_dir()
+        import rollups
+        rollups.replaced()
+    return get_backend().transaction(name)
+
+
+# Air writes are journaled for the rollup tiers (rollups.touched) under the
+# air lock, before the data changes, so the journal never misses a write.
+
+@metrics.timed("insert_records", dataset=True)
+def insert_records(name, records, compact=True):
+    records = list(records)
+    if name != "air":
+        get_backend().insert(name, records, compact)
+        return
+    ensure_data_dir()
+    import rollups
+    with get_store("air").locked():
+        rollups.touched(records)
+        get_backend().insert(name, records, compact)
+
+
+def insert_record(name, rec):
+    insert_records(name, [rec])
+
+
+def update_record(name, rec):
+    insert_records(name, [rec])
+
+
+def delete_records(name, key_values):
+    key_values = list(key_values)
+    if name != "air":
+        get_backend().delete(name, key_values)
+        return
     ensure_data_dir()
-    path = os.path.join(DATA_DIR, FILES[name])
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, default=str)
+    import rollups
+    with get_store("air").locked():
+        rollups.touched(ids=key_values)
+        get_backend().delete(name, key_values)
+
+
+def delete_record(name, key_value):
+    delete_records(name, [key_value])
 
 
 def gen_id(prefix="id"):
+    import uuid
     return f"{prefix}_{uuid.uuid4().hex[:8]}"
 
 
+# Optional; imported on first use, False if it is not installed.
+tabulate = None
+
+
 def print_table(rows, headers=None):
+    global tabulate
+    if tabulate is None:
+        try:
+            from tabulate import tabulate
+        except Exception:
+            tabulate = False
     if tabulate:
         print(tabulate(rows, headers=headers, tablefmt="grid"))
     else:
@@ -73,12 +224,41 @@ def safe_float(x, default=0.0):
         return default
 
 
+def month_key(date):
+    try:
+        d = datetime.datetime.strptime(date, "%Y-%m-%d")
+        return f"{d.year}-{d.month:02d}"
+    except Exception:
+        return date
+
+
+@metrics.timed("find_by_id")
 def find_by_id(list_obj, key_name, key_value):
     for item in list_obj:
         if item.get(key_name) == key_value:
             return item
     return None
 
+
+@metrics.timed("find_record", dataset=True)
+def find_record(name, key_value):
+    return get_backend().get(name, key_value)
+
+def sample_air_record(city, date, rng=None):
+    if rng is None:
+        import random as rng
+    aqi = rng.randint(50,400)
+    pm25 = round(aqi * rng.uniform(0.3,0.9),1)
+    pm10 = round(aqi * rng.uniform(0.4,1.0),1)
+    no2 = round(aqi * rng.uniform(0.05,0.25),1)
+    co = round(rng.uniform(0.2,5.0) * (aqi/100.0),2)
+    o3 = round(rng.uniform(10,150) * (aqi/200.0),1)
+    so2 = round(rng.uniform(5,80) * (aqi/200.0),1)
+    return {"record_id": gen_id("rec"), "region": city, "date": date, "AQI": aqi,
+            "pollutants": {"PM2.5": pm25, "PM10": pm10, "NO2": no2, "CO": co, "O3": o3, "SO2": so2},
+            "health_risk": ""}
+
+
 def create_sample_data():
     pollutants = [
         {"pollutant_id":"pol_pm25","name":"PM2.5","description":"Fine particulate matter (µg/m³)","safe_limit":60},
@@ -107,23 +287,15 @@ def create_sample_data():
 
     cities = ["Delhi","Mumbai","Kolkata","Chennai","Bengaluru","Hyderabad","Ahmedabad","Pune","Lucknow","Jaipur",
               "Bhopal","Visakhapatnam","Surat","Kanpur","Nagpur","Indore","Thane","Agra","Vadodara","Nashik"]
+    import random
     air = []
-    random.seed(42)
+    rng = random.Random(42)
     for city in cities:
         for day in range(1,16): 
             date = datetime.date(2025,1,day).isoformat()
-            aqi = random.randint(50,400)
-            pm25 = round(aqi * random.uniform(0.3,0.9),1)
-            pm10 = round(aqi * random.uniform(0.4,1.0),1)
-            no2 = round(aqi * random.uniform(0.05,0.25),1)
-            co = round(random.uniform(0.2,5.0) * (aqi/100.0),2)
-            o3 = round(random.uniform(10,150) * (aqi/200.0),1)
-            so2 = round(random.uniform(5,80) * (aqi/200.0),1)
-            rec = {"record_id": gen_id("rec"), "region": city, "date": date, "AQI": aqi,
-                   "pollutants": {"PM2.5": pm25, "PM10": pm10, "NO2": no2, "CO": co, "O3": o3, "SO2": so2},
-                   "health_risk": ""}
-            air.append(rec)
-    save_json("air", air)
+            air.append(sample_air_record(city, date, rng))
+    import health
+    save_json("air", health.fill(air))
 
     alerts = [
         {"alert_id": gen_id("alert"), "region": "Delhi", "AQI_level": "Very Unhealthy", "status": "active", "issue_date": "2025-01-10", "expiry_date": "2025-01-12"},
@@ -134,6 +306,11 @@ def create_sample_data():
 
 
 def ensure_sample_data():
+    # Decided from file sizes, without parsing anything, on the JSON backend.
     ensure_data_dir()
-    if not load_json("pollutants"):
+    if BACKEND == "json":
+        empty = get_store("pollutants").is_blank()
+    else:
+        empty = not get_backend().count("pollutants")
+    if empty:
         create_sample_data()